@@ -0,0 +1,322 @@
+# asgi.py
+# ASGI で動かす場合の入口
+#
+#   uvicorn asgi:app
+#   gunicorn asgi:app -k uvicorn.workers.UvicornWorker
+#
+# /callback（複数クラブのときは /callback/<id>）は署名を確認したらすぐ 200 を返し、イベントの処理はスレッドプールで行う。
+# gspread / line-bot-sdk / requests は同期ライブラリなので、処理をスレッドに逃がして
+# イベントループを塞がないようにしている。その他のパスは Flask アプリ（main.app）に渡す。
+#
+# 同じ送信者（userId、無ければ groupId / roomId）のイベントは届いた順に1つずつ処理する。
+# 会話の状態（user_states など）は送信者ごとに順番に進む前提で書かれているため。
+# 1人の送信者が待たせておける数には上限があり、超えた分は捨てる（他の人の受け付けを詰まらせない）。
+#
+# 200 を返した後は LINE から再送されないので、処理に失敗した webhook は少し待ってから同じ本文で処理し直す
+# （書き込みの前に失敗したイベントだけがもう一度処理される。event_dedup.py）。
+# それでも失敗したものは webhook_dead.jsonl（テナントの保存場所）に本文ごと残す。
+# Flask アプリ用のスレッドは webhook 用と分け、長い応答（/export）で webhook の処理が詰まらないようにしている。
+
+import asyncio
+import contextlib
+import fcntl
+import io
+import json
+import os
+import sys
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+
+import main
+import webhook_capture
+from shared_snapshot import SNAPSHOT_DIR
+
+HANDLER_THREADS = int(os.environ.get("ASGI_HANDLER_THREADS", "32"))
+# Flask アプリ（webhook 以外のパス）を動かすスレッド数
+WSGI_THREADS = int(os.environ.get("ASGI_WSGI_THREADS", "8"))
+# 同時にスレッドで処理できる webhook の数（送信者の順番待ちをしているものは数えない）
+MAX_INFLIGHT = int(os.environ.get("ASGI_MAX_INFLIGHT", "256"))
+# 受け付けて処理を待っている webhook の数の上限。超えたら受け付け（200）を待たせる
+MAX_PENDING = int(os.environ.get("ASGI_MAX_PENDING", "1024"))
+# 1人の送信者について処理を待たせておける webhook の数。超えた分は捨てる
+MAX_PER_SENDER = int(os.environ.get("ASGI_MAX_PER_SENDER", "16"))
+# 処理に失敗した webhook をもう一度処理するまでの秒数と回数
+RETRY_SECONDS = float(os.environ.get("ASGI_RETRY_SECONDS", "5"))
+RETRIES = int(os.environ.get("ASGI_RETRIES", "1"))
+DEAD_LETTER_FILE = "webhook_dead.jsonl"
+# Flask の応答を送るときに先読みしておくチャンク数（/export などの長い応答でメモリを抑える）
+WSGI_BUFFER_CHUNKS = 8
+
+_executor = ThreadPoolExecutor(max_workers=HANDLER_THREADS, thread_name_prefix="webhook")
+_wsgi_executor = ThreadPoolExecutor(max_workers=WSGI_THREADS, thread_name_prefix="wsgi")
+_inflight = None
+_pending = None
+_tasks = set()
+counters = {"accepted": 0, "dropped": 0, "retried": 0, "failed": 0}
+
+
+class _KeyedLocks:
+    """Asyncio locks per key, created on demand and dropped when nobody holds or waits for them."""
+
+    def __init__(self):
+        self._locks = {}            # key -> [asyncio.Lock, 保持・待機中の数]
+
+    def queued(self, key):
+        """How many holders hold or wait for `key`."""
+        entry = self._locks.get(key)
+        return entry[1] if entry else 0
+
+    def reserve(self, keys):
+        """Queues a holder for `keys` right away (before hold() runs). Returns the keys to pass to hold()."""
+        keys = sorted(set(keys))
+        for key in keys:
+            self._locks.setdefault(key, [asyncio.Lock(), 0])[1] += 1
+        return keys
+
+    @contextlib.asynccontextmanager
+    async def hold(self, keys):
+        """Holds the locks of `keys` from reserve() (sorted, so two holders cannot deadlock)."""
+        acquired = []
+        try:
+            for key in keys:
+                # asyncio.Lock は待った順に渡すので、同じ送信者のイベントは届いた順に処理される
+                await self._locks[key][0].acquire()
+                acquired.append(key)
+            yield
+        finally:
+            for key in keys:
+                entry = self._locks[key]
+                if key in acquired:
+                    entry[0].release()
+                entry[1] -= 1
+                if not entry[1]:
+                    del self._locks[key]
+
+
+_senders = _KeyedLocks()
+
+
+def _sender_keys(tenant, body):
+    """(tenant id, sender id) of every event in a webhook body."""
+    try:
+        events = json.loads(body).get("events") or []
+    except (ValueError, AttributeError):
+        return []
+    keys = []
+    for event in events:
+        source = event.get("source") or {}
+        sender = source.get("userId") or source.get("groupId") or source.get("roomId")
+        if sender:
+            keys.append((tenant.id, sender))
+    return keys
+
+
+async def _read_body(receive):
+    chunks = []
+    while True:
+        message = await receive()
+        chunks.append(message.get("body", b""))
+        if not message.get("more_body"):
+            return b"".join(chunks)
+
+
+async def _respond(send, status, body=b"", content_type=b"text/plain; charset=utf-8"):
+    await send({"type": "http.response.start", "status": status, "headers": [(b"content-type", content_type)]})
+    await send({"type": "http.response.body", "body": body})
+
+
+def _handle_sync(tenant, body, signature, received_at, attempt):
+    """Handles one webhook body. Returns None, or the error as text if it failed."""
+    with tenant.activate():
+        if not attempt:
+            webhook_capture.capture(body, received_at)
+        try:
+            main.handler.handle(body, signature)
+        except Exception as e:
+            traceback.print_exc()
+            return f"{type(e).__name__}: {e}"
+    return None
+
+
+def _dead_letter(tenant, body, signature, received_at, error):
+    # 後で調べたり /callback に送り直したりできるよう、署名と本文をそのまま残す
+    item = {"tenant": tenant.id, "body": body, "signature": signature, "error": error,
+            "received_at": received_at, "at": time.time()}
+    directory = tenant.state_dir or SNAPSHOT_DIR
+    try:
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, DEAD_LETTER_FILE), "a", encoding="utf-8") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.write(json.dumps(item, ensure_ascii=False) + "\n")
+    except OSError:
+        traceback.print_exc()
+    print(f"Webhook for tenant {tenant.id!r} moved to {DEAD_LETTER_FILE} ({error})")
+
+
+async def _dispatch(tenant, body, signature, received_at, keys):
+    loop = asyncio.get_running_loop()
+    try:
+        async with _senders.hold(keys):
+            for attempt in range(RETRIES + 1):
+                if attempt:
+                    counters["retried"] += 1
+                    await asyncio.sleep(RETRY_SECONDS)
+                # スレッドの枠は送信者の順番が来てから取る（1人の連投で他の人の処理を止めない）
+                async with _inflight:
+                    error = await loop.run_in_executor(_executor, _handle_sync, tenant, body, signature, received_at, attempt)
+                if error is None:
+                    return
+            counters["failed"] += 1
+            await loop.run_in_executor(_executor, _dead_letter, tenant, body, signature, received_at, error)
+    finally:
+        _pending.release()
+
+
+async def callback(scope, receive, send, tenant_id=None):
+    global _inflight, _pending
+    if scope["method"] != "POST":
+        await _respond(send, 405)
+        return
+    headers = dict(scope["headers"])
+    signature = headers.get(b"x-line-signature", b"").decode()
+    body = (await _read_body(receive)).decode("utf-8")
+    tenant = main.registry.for_webhook(body, signature, tenant_id)
+    if tenant is None:
+        await _respond(send, 404)
+        return
+    if not tenant.webhook_parser.signature_validator.validate(body, signature):
+        await _respond(send, 400)
+        return
+    if _inflight is None:
+        _inflight = asyncio.Semaphore(MAX_INFLIGHT)
+        _pending = asyncio.Semaphore(MAX_PENDING)
+    keys = _sender_keys(tenant, body)
+    if keys and all(_senders.queued(key) >= MAX_PER_SENDER for key in keys):
+        # 順番待ちが溜まっている送信者だけの webhook は捨てる（流量制限で断られる分）
+        counters["dropped"] += 1
+        print(f"Dropped webhook from {keys}: {MAX_PER_SENDER} already waiting")
+        await _respond(send, 200, b"OK")
+        return
+    await _pending.acquire()
+    counters["accepted"] += 1
+    task = asyncio.create_task(_dispatch(tenant, body, signature, time.time(), _senders.reserve(keys)))
+    _tasks.add(task)
+    task.add_done_callback(_tasks.discard)
+    await _respond(send, 200, b"OK")
+
+
+class _ClientGone(Exception):
+    pass
+
+
+async def wsgi_bridge(scope, receive, send):
+    """Runs the Flask app for non-webhook paths in its own thread pool, streaming its output."""
+    body = await _read_body(receive)
+    loop = asyncio.get_running_loop()
+    # 送信が追いつかないときは Flask 側を待たせる
+    queue = asyncio.Queue(maxsize=WSGI_BUFFER_CHUNKS)
+
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", ""),
+        "PATH_INFO": scope["path"],
+        "QUERY_STRING": scope.get("query_string", b"").decode("latin-1"),
+        "SERVER_NAME": (scope.get("server") or ("localhost", 80))[0],
+        "SERVER_PORT": str((scope.get("server") or ("localhost", 80))[1]),
+        "SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False,
+        "CONTENT_LENGTH": str(len(body)),
+    }
+    for name, value in scope["headers"]:
+        key = name.decode("latin-1").upper().replace("-", "_")
+        if key == "CONTENT_TYPE":
+            environ["CONTENT_TYPE"] = value.decode("latin-1")
+        elif key != "CONTENT_LENGTH":
+            environ[f"HTTP_{key}"] = value.decode("latin-1")
+
+    closed = threading.Event()
+
+    def put(item):
+        # 接続が切れて読み手がいなくなったら諦める
+        future = asyncio.run_coroutine_threadsafe(queue.put(item), loop)
+        while True:
+            try:
+                return future.result(timeout=1)
+            except FutureTimeout:
+                if closed.is_set():
+                    future.cancel()
+                    raise _ClientGone()
+
+    def run():
+        started = []
+
+        def start_response(status, response_headers, exc_info=None):
+            code = int(status.split(" ", 1)[0])
+            headers = [(k.lower().encode("latin-1"), v.encode("latin-1")) for k, v in response_headers]
+            started.append(True)
+            put(("start", code, headers))
+
+        try:
+            result = main.app(environ, start_response)
+            try:
+                for chunk in result:
+                    if chunk:
+                        put(("body", chunk))
+            finally:
+                if hasattr(result, "close"):
+                    result.close()
+        except _ClientGone:
+            return
+        except Exception:
+            traceback.print_exc()
+            if not started:
+                put(("start", 500, []))
+        put(("end",))
+
+    future = loop.run_in_executor(_wsgi_executor, run)
+    try:
+        while True:
+            item = await queue.get()
+            if item[0] == "start":
+                await send({"type": "http.response.start", "status": item[1], "headers": item[2]})
+            elif item[0] == "body":
+                await send({"type": "http.response.body", "body": item[1], "more_body": True})
+            else:
+                await send({"type": "http.response.body", "body": b""})
+                break
+    finally:
+        closed.set()
+    await future
+
+
+async def lifespan(scope, receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            # 処理中のイベントを待ち、未書き込みのログイン状態を書き出す
+            if _tasks:
+                await asyncio.wait(list(_tasks), timeout=20)
+            await asyncio.get_running_loop().run_in_executor(_executor, main.flush_sessions)
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        await lifespan(scope, receive, send)
+    elif scope["type"] == "http" and scope["path"] == "/callback":
+        await callback(scope, receive, send)
+    elif scope["type"] == "http" and scope["path"].startswith("/callback/"):
+        await callback(scope, receive, send, scope["path"][len("/callback/"):])
+    elif scope["type"] == "http":
+        await wsgi_bridge(scope, receive, send)
@@ -0,0 +1,373 @@
+# benchmarks/bench.py
+# 潮位PDFの解析と IDT 計算のベンチマーク
+#
+#   python benchmarks/bench.py                 計測して結果を表示
+#   python benchmarks/bench.py --check         baseline.json と比べ、閾値を超えて遅く（重く）なったら終了コード1
+#   python benchmarks/bench.py --save          結果を baseline.json に保存（基準を更新するとき）
+#   python benchmarks/bench.py make-fixture    fixtures/KC_sample.pdf を作り直す
+#
+# 時間はマシンの速さや混み具合に依存するので、各計測の直前に基準ループ（calibration_loop）も測り、
+# その時間との比（relative）で baseline.json と比べる（別のマシンで保存した基準とも比べられる）。
+# 表の value は参考の絶対値。メモリ（KiB）はそのまま比べる。
+# pdfplumber が入っていなければ PyPDF2 との比較は飛ばす。
+
+import argparse
+import calendar
+import datetime
+import gc
+import json
+import math
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+from idt_parser import FIELDS_ADMIN_IDT, calc_idt, parse_idt_input, parse_records, parse_time_str, round_score  # noqa: E402
+from tide import extract_tide_from_pdf, parse_tide_page, parse_tide_table  # noqa: E402
+
+FIXTURE_PDF = os.path.join(HERE, "fixtures", "KC_sample.pdf")
+BASELINE_PATH = os.path.join(HERE, "baseline.json")
+FIXTURE_YEAR = 2024
+DEFAULT_SIZES = (1_000, 10_000, 100_000, 1_000_000)
+# 基準値の何倍を超えたら劣化とみなすか
+DEFAULT_THRESHOLD = float(os.environ.get("BENCH_THRESHOLD", "1.5"))
+# ns/call の小さなベンチマークは1回の計測がぶれやすいので多めに繰り返して最良値を取る
+MICRO_REPEAT = 15
+
+
+# ---- fixture ---------------------------------------------------------------
+
+def fixture_tide(year, month, day, hour):
+    """Deterministic tide level (cm) used for the fixture, roughly like Kochi's semidiurnal tide."""
+    t = (datetime.date(year, month, day).toordinal() * 24 + hour) / 12.42
+    return int(round(110 + 75 * math.sin(2 * math.pi * t) + 15 * math.sin(math.pi * t / 14.77)))
+
+
+def days_in_month(year, month):
+    return calendar.monthrange(year, month)[1]
+
+
+def fixture_page_lines(year, month):
+    # 気象庁の毎時潮位表と同じく「日 0時..23時 の潮位」を1行に並べる（末尾は満潮の時刻と潮位）
+    lines = [
+        f"KOCHI (KC)  {year}  HOURLY TIDE LEVEL (cm)  MONTH {month}",
+        "DAY " + " ".join(f"{h:>3}" for h in range(24)) + "  HW-TIME HW",
+    ]
+    for day in range(1, days_in_month(year, month) + 1):
+        hours = [fixture_tide(year, month, day, h) for h in range(24)]
+        high_hour = max(range(24), key=lambda h: hours[h])
+        lines.append(f"{day:>2} " + " ".join(f"{v:>3}" for v in hours) + f"  {high_hour:02d}00 {hours[high_hour]:>3}")
+    return lines
+
+
+def _pdf_escape(text):
+    return text.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+
+
+def build_fixture_pdf(year=FIXTURE_YEAR):
+    """Builds a 12-page text PDF laid out like the JMA hourly tide table (one page per month)."""
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        None,  # Pages（ページ数が決まってから埋める）
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Courier >>",
+    ]
+    page_ids = []
+    for month in range(1, 13):
+        ops = ["BT", "/F1 7 Tf", "9 TL", "20 810 Td"]
+        for line in fixture_page_lines(year, month):
+            ops.append(f"({_pdf_escape(line)}) Tj T*")
+        ops.append("ET")
+        stream = "\n".join(ops).encode("ascii")
+        objects.append(b"<< /Length %d >>\nstream\n" % len(stream) + stream + b"\nendstream")
+        content_id = len(objects)
+        objects.append(
+            b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] "
+            b"/Resources << /Font << /F1 3 0 R >> >> /Contents %d 0 R >>" % content_id
+        )
+        page_ids.append(len(objects))
+    kids = " ".join(f"{i} 0 R" for i in page_ids).encode("ascii")
+    objects[1] = b"<< /Type /Pages /Kids [" + kids + b"] /Count %d >>" % len(page_ids)
+
+    out = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for i, body in enumerate(objects, start=1):
+        offsets.append(len(out))
+        out += b"%d 0 obj\n" % i + body + b"\nendobj\n"
+    xref = len(out)
+    out += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    for offset in offsets:
+        out += b"%010d 00000 n \n" % offset
+    out += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref)
+    return bytes(out)
+
+
+def make_fixture():
+    os.makedirs(os.path.dirname(FIXTURE_PDF), exist_ok=True)
+    with open(FIXTURE_PDF, "wb") as f:
+        f.write(build_fixture_pdf())
+    print(f"wrote {FIXTURE_PDF}")
+
+
+def expected_table(year=FIXTURE_YEAR):
+    return {
+        (month, day): [fixture_tide(year, month, day, h) for h in range(24)]
+        for month in range(1, 13)
+        for day in range(1, days_in_month(year, month) + 1)
+    }
+
+
+# ---- synthetic erg data ----------------------------------------------------
+
+def synthetic_lines(count, seed=0):
+    """Admin-style record lines: name grade time gender weight."""
+    rng = random.Random(seed)
+    names = [f"選手{i:03d}" for i in range(200)]
+    lines = []
+    for _ in range(count):
+        minutes = rng.randint(6, 8)
+        lines.append(
+            f"{rng.choice(names)} {rng.randint(1, 3)} {minutes}:{rng.randint(0, 59):02d}.{rng.randint(0, 9)} "
+            f"{rng.choice('mw')} {rng.uniform(45, 95):.1f}"
+        )
+    return lines
+
+
+# ---- measurement -----------------------------------------------------------
+
+def calibration_loop():
+    # 文字列・dict・整数演算を混ぜた、このリポジトリのコードに近い重さの固定の処理
+    total = 0
+    seen = {}
+    for i in range(1000):
+        key = str(i)
+        total += len(key) * i
+        seen[key] = total
+    return total
+
+
+# 基準ループを1回の計測で何回まわすか（約 CALIBRATION_SECONDS になるよう最初に決める）
+CALIBRATION_SECONDS = 0.02
+_calibration_number = None
+
+
+def calibration_seconds():
+    """Time of one calibration_loop call in seconds, measured now."""
+    global _calibration_number
+    if _calibration_number is None:
+        _calibration_number = 1
+        while _time_calls(calibration_loop, _calibration_number) < CALIBRATION_SECONDS:
+            _calibration_number *= 2
+    return _time_calls(calibration_loop, _calibration_number) / _calibration_number
+
+
+def _time_calls(fn, number):
+    start = time.perf_counter()
+    for _ in range(number):
+        fn()
+    return time.perf_counter() - start
+
+
+def _relative(rounds):
+    # 各回の「計測時間 / 直前の基準ループの時間」の中央値。CPU の速さや混み具合のぶれが打ち消される
+    ratios = sorted(value / calibration for value, calibration in rounds)
+    return ratios[len(ratios) // 2]
+
+
+def per_call(fn, repeat=5, min_seconds=0.2):
+    """
+    (best time per call in nanoseconds, time relative to calibration_loop)
+    over `repeat` rounds; calls per round are chosen like timeit.autorange.
+    """
+    number = 1
+    while True:
+        elapsed = _time_calls(fn, number)
+        if elapsed >= min_seconds:
+            break
+        number *= 2 if elapsed > min_seconds / 10 else 10
+    rounds = []
+    for _ in range(repeat):
+        calibration = calibration_seconds()
+        rounds.append((_time_calls(fn, number) / number, calibration))
+    return min(value for value, _ in rounds) * 1e9, _relative(rounds)
+
+
+def timed(fn, repeat=3):
+    """(best wall time of one call in seconds, time relative to calibration_loop) over `repeat` calls."""
+    rounds = []
+    for _ in range(repeat):
+        gc.collect()
+        calibration = calibration_seconds()
+        start = time.perf_counter()
+        fn()
+        rounds.append((time.perf_counter() - start, calibration))
+    return min(value for value, _ in rounds), _relative(rounds)
+
+
+def peak_memory(fn):
+    """Peak traced allocation (KiB) while running fn once."""
+    gc.collect()
+    tracemalloc.start()
+    try:
+        fn()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak / 1024
+
+
+# ---- benchmarks ------------------------------------------------------------
+
+def bench_idt(results, sizes):
+    results["parse_time_str"] = (*per_call(lambda: parse_time_str("7:05.3"), MICRO_REPEAT), "ns/call")
+    results["parse_idt_input"] = (*per_call(lambda: parse_idt_input("7:05.3 62.5 m"), MICRO_REPEAT), "ns/call")
+    results["calc_idt"] = (*per_call(lambda: calc_idt(7, 5, 3, 62.5, 0.0), MICRO_REPEAT), "ns/call")
+
+    for size in sizes:
+        lines = synthetic_lines(size)
+        text = "\n".join(lines)
+
+        def run_records():
+            return [r for _, r, _ in parse_records(text, FIELDS_ADMIN_IDT)]
+
+        tuples = []
+        for _, record, _ in parse_records(text, FIELDS_ADMIN_IDT):
+            tuples.append((record.minutes, record.seconds, record.tenths, record.weight, 0.0 if record.gender == "m" else 1.0))
+
+        def run_scores():
+            return [round_score(calc_idt(*t)) for t in tuples]
+
+        repeat = 3 if size <= 100_000 else 1
+        seconds, relative = timed(run_records, repeat)
+        results[f"parse_records[{size}]"] = (seconds / size * 1e9, relative / size, "ns/record")
+        results[f"parse_records[{size}].peak"] = (peak_memory(run_records), None, "KiB")
+        seconds, relative = timed(run_scores, repeat)
+        results[f"calc_idt_bulk[{size}]"] = (seconds / size * 1e9, relative / size, "ns/record")
+        del tuples, text, lines
+
+
+def _pdfplumber_table(path):
+    import pdfplumber
+    table = {}
+    with pdfplumber.open(path) as pdf:
+        for month, page in enumerate(pdf.pages[:12], start=1):
+            for day, hours in parse_tide_page(page.extract_text() or "").items():
+                table[(month, day)] = hours
+    return table
+
+
+def bench_tide(results, failures):
+    expected = expected_table()
+
+    table = parse_tide_table(FIXTURE_PDF)
+    if table != expected:
+        failures.append("PyPDF2: parsed tide table does not match the fixture")
+    if extract_tide_from_pdf(FIXTURE_PDF, 7, 15, 6) != expected[(7, 15)][6]:
+        failures.append("PyPDF2: extract_tide_from_pdf returned a wrong value")
+
+    seconds, relative = timed(lambda: extract_tide_from_pdf(FIXTURE_PDF, 7, 15, 6), 5)
+    results["extract_tide_from_pdf"] = (seconds * 1e3, relative, "ms/call")
+    seconds, relative = timed(lambda: parse_tide_table(FIXTURE_PDF))
+    results["parse_tide_table.pypdf2"] = (seconds * 1e3, relative, "ms/year")
+    results["parse_tide_table.pypdf2.peak"] = (peak_memory(lambda: parse_tide_table(FIXTURE_PDF)), None, "KiB")
+
+    try:
+        import pdfplumber  # noqa: F401
+    except ImportError:
+        print("pdfplumber is not installed; skipping the pdfplumber comparison")
+        return
+    if _pdfplumber_table(FIXTURE_PDF) != expected:
+        failures.append("pdfplumber: parsed tide table does not match the fixture")
+    seconds, relative = timed(lambda: _pdfplumber_table(FIXTURE_PDF))
+    results["parse_tide_table.pdfplumber"] = (seconds * 1e3, relative, "ms/year")
+    results["parse_tide_table.pdfplumber.peak"] = (peak_memory(lambda: _pdfplumber_table(FIXTURE_PDF)), None, "KiB")
+
+
+# ---- baseline --------------------------------------------------------------
+
+def load_baseline():
+    try:
+        with open(BASELINE_PATH, encoding="utf-8") as f:
+            return json.load(f)["results"]
+    except (OSError, ValueError, KeyError):
+        return {}
+
+
+def save_baseline(results):
+    saved = {}
+    for name, (value, relative, unit) in sorted(results.items()):
+        saved[name] = {"value": round(value, 3), "unit": unit}
+        if relative is not None:
+            saved[name]["relative"] = float(f"{relative:.6g}")
+    data = {"python": sys.version.split()[0], "results": saved}
+    with open(BASELINE_PATH, "w", encoding="utf-8") as f:
+        json.dump(data, f, indent=2, ensure_ascii=False)
+        f.write("\n")
+    print(f"saved {BASELINE_PATH}")
+
+
+def compare(results, baseline, threshold):
+    """
+    Prints the result table and returns the names that got slower (or
+    bigger) than baseline*threshold. Timings are compared by their value
+    relative to the calibration loop, so the baseline may come from
+    another machine; memory is compared as is.
+    """
+    regressions = []
+    print(f"{'benchmark':<38} {'value':>12} {'unit':<10} {'baseline':>12} {'ratio':>7}")
+    for name, (value, relative, unit) in results.items():
+        saved = baseline.get(name, {})
+        base = saved.get("value")
+        if relative is not None and saved.get("relative"):
+            ratio = relative / saved["relative"]
+        else:
+            ratio = value / base if base else None
+        flag = ""
+        if ratio is not None and ratio > threshold:
+            regressions.append(name)
+            flag = "  REGRESSION"
+        base_str = f"{base:12.1f}" if base else f"{'-':>12}"
+        ratio_str = f"{ratio:7.2f}" if ratio is not None else f"{'-':>7}"
+        print(f"{name:<38} {value:12.1f} {unit:<10} {base_str} {ratio_str}{flag}")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmarks for the tide PDF parser and IDT scoring.")
+    parser.add_argument("command", nargs="?", choices=["run", "make-fixture"], default="run")
+    parser.add_argument("--sizes", default=",".join(str(s) for s in DEFAULT_SIZES),
+                        help="comma separated synthetic dataset sizes")
+    parser.add_argument("--check", action="store_true", help="exit 1 if a benchmark regressed past the threshold")
+    parser.add_argument("--save", action="store_true", help="write the results to baseline.json")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD)
+    parser.add_argument("--only", choices=["idt", "tide"])
+    args = parser.parse_args(argv)
+
+    if args.command == "make-fixture":
+        make_fixture()
+        return 0
+
+    results = {}
+    failures = []
+    if args.only in (None, "idt"):
+        bench_idt(results, [int(s) for s in args.sizes.split(",") if s])
+    if args.only in (None, "tide"):
+        bench_tide(results, failures)
+
+    regressions = compare(results, load_baseline(), args.threshold)
+    for failure in failures:
+        print(f"FAILED: {failure}")
+    if args.save:
+        save_baseline(results)
+    if failures or (args.check and regressions):
+        if regressions:
+            print(f"{len(regressions)} benchmark(s) regressed more than {args.threshold}x: {', '.join(regressions)}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
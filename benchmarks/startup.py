@@ -0,0 +1,129 @@
+# benchmarks/startup.py
+# 起動時間のベンチマーク: main の import 時間（-X importtime）と最初の webhook への応答時間
+#
+#   python benchmarks/startup.py                  計測して重いモジュールの一覧を表示
+#   python benchmarks/startup.py --check          予算超過、または遅延読み込みのはずのモジュールが読み込まれたら終了コード1
+#
+# 計測は新しいプロセスで SQLite バックエンド・偽の LINE API を使って行う。
+
+import argparse
+import json
+import os
+import re
+import subprocess
+import sys
+import tempfile
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+
+# 起動時に読み込まれてはいけないモジュール（使うときに読み込む）
+DEFERRED_MODULES = ("PyPDF2", "pdfplumber", "bs4", "google.oauth2", "gspread")
+# main の import + 最初の応答にかけてよい時間
+DEFAULT_BUDGET_MS = float(os.environ.get("STARTUP_BUDGET_MS", "600"))
+
+_IMPORTTIME_RE = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \| (\s*)(\S+)$")
+
+# 子プロセスで実行する計測本体
+_PROBE = r"""
+import json, sys, time
+started = time.perf_counter()
+import main
+imported = time.perf_counter()
+sys.path.insert(0, %(root)r)
+from replay import CallCounter, FakeLineApi, sign
+main.line_bot_api = FakeLineApi(CallCounter(), 0)
+body = json.dumps({"destination": "U0", "events": [{
+    "type": "message", "mode": "active", "timestamp": 0, "replyToken": "r",
+    "webhookEventId": "startup-probe", "deliveryContext": {"isRedelivery": False},
+    "source": {"type": "user", "userId": "U" + "0" * 32},
+    "message": {"type": "text", "id": "1", "text": "help"},
+}]})
+res = main.app.test_client().post("/callback", data=body, headers={
+    "X-Line-Signature": sign(body, "startup-secret"), "Content-Type": "application/json"})
+done = time.perf_counter()
+print("PROBE " + json.dumps({
+    "import_ms": (imported - started) * 1000,
+    "first_request_ms": (done - imported) * 1000,
+    "status": res.status_code,
+    "loaded": [m for m in %(deferred)r if m in sys.modules],
+}))
+"""
+
+
+def run_probe(workdir):
+    env = dict(os.environ)
+    env.update({
+        "PYTHONPATH": ROOT,
+        "STORAGE_BACKEND": "sqlite",
+        "SQLITE_PATH": os.path.join(workdir, "startup.db"),
+        "LINE_CHANNEL_ACCESS_TOKEN": "startup",
+        "LINE_CHANNEL_SECRET": "startup-secret",
+        "TIDE_PUSH_ENABLED": "0",
+        "SNAPSHOT_DIR": os.path.join(workdir, "snapshots"),
+    })
+    env.pop("WEBHOOK_CAPTURE_PATH", None)
+    code = _PROBE % {"root": ROOT, "deferred": DEFERRED_MODULES}
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        cwd=workdir, env=env, capture_output=True, text=True, timeout=120,
+    )
+    probe = None
+    for line in proc.stdout.splitlines():
+        if line.startswith("PROBE "):
+            probe = json.loads(line[len("PROBE "):])
+    if probe is None:
+        raise RuntimeError(f"startup probe failed:\n{proc.stderr[-2000:]}")
+    return probe, parse_importtime(proc.stderr)
+
+
+def parse_importtime(stderr):
+    """Returns [(module, self_us, cumulative_us, depth)] from -X importtime output."""
+    modules = []
+    for line in stderr.splitlines():
+        match = _IMPORTTIME_RE.match(line)
+        if match:
+            self_us, cumulative_us, indent, name = match.groups()
+            modules.append((name, int(self_us), int(cumulative_us), len(indent) // 2))
+    return modules
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Measure main.py import time and first-request latency.")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--top", type=int, default=15, help="number of top-level imports to list")
+    parser.add_argument("--budget-ms", type=float, default=DEFAULT_BUDGET_MS)
+    parser.add_argument("--check", action="store_true")
+    args = parser.parse_args(argv)
+
+    results = []
+    with tempfile.TemporaryDirectory() as workdir:
+        for _ in range(args.runs):
+            results.append(run_probe(workdir))
+    # 一番速かった回を代表値にする（ディスクキャッシュ等のぶれを除く）
+    probe, modules = min(results, key=lambda r: r[0]["import_ms"] + r[0]["first_request_ms"])
+
+    total_ms = probe["import_ms"] + probe["first_request_ms"]
+    print(f"import main: {probe['import_ms']:.1f}ms  first webhook: {probe['first_request_ms']:.1f}ms  "
+          f"total: {total_ms:.1f}ms (budget {args.budget_ms:.0f}ms, best of {args.runs})")
+    print("\nslowest imports under main (cumulative):")
+    # -X importtime は子を親より先に出力するので、main の行までの深さ1が main の直接の import
+    end = next((i for i, m in enumerate(modules) if m[0] == "main" and m[3] == 0), len(modules))
+    main_children = [m for m in modules[:end] if m[3] == 1]
+    for name, self_us, cumulative_us, _ in sorted(main_children, key=lambda m: -m[2])[:args.top]:
+        print(f"  {name:<32} {cumulative_us / 1000:8.1f}ms  (self {self_us / 1000:.1f}ms)")
+
+    failures = []
+    if probe["status"] != 200:
+        failures.append(f"first webhook returned {probe['status']}")
+    if probe["loaded"]:
+        failures.append(f"deferred modules loaded at start-up: {', '.join(probe['loaded'])}")
+    if total_ms > args.budget_ms:
+        failures.append(f"start-up took {total_ms:.0f}ms, over the {args.budget_ms:.0f}ms budget")
+    for failure in failures:
+        print(f"FAILED: {failure}")
+    return 1 if args.check and failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,385 @@
+# circuit_breaker.py
+# 外部サービス（Google Sheets / 気象庁）が遅い・落ちているときに、待たずに諦めるための仕組み
+#
+#   CircuitBreaker  失敗（または遅延）が続いたら一定時間呼び出しを止める
+#   LastGood        読み取りに失敗したら前回成功した値（古い値）を返す
+#   WriteQueue      追記に失敗したらメモリ上に貯め、復旧後に順番に書き込む
+#                   （終了時に残った分はファイルに保存し、次の起動で書き込む）
+#
+#   CIRCUIT_FAILURES       連続何回の失敗で止めるか (既定 5)
+#   CIRCUIT_RESET_SECONDS  止めてから再試行するまでの秒数 (既定 30)
+
+import contextvars
+import fcntl
+import json
+import os
+import threading
+import time
+import traceback
+from collections import deque
+
+import requests
+
+import event_dedup
+
+FAILURE_THRESHOLD = int(os.environ.get("CIRCUIT_FAILURES", "5"))
+RESET_SECONDS = float(os.environ.get("CIRCUIT_RESET_SECONDS", "30"))
+
+# WriteQueue.append の結果
+WRITTEN = "written"        # 書き込んだ
+QUEUED = "queued"          # 保存待ち（復旧後に書き込む）
+UNCERTAIN = "uncertain"    # 書き込まれたか分からない（再送せず dead letter に残す）
+
+# 書き込めなかった行として覚えておく件数（ファイルには全件残す）
+DEAD_LETTER_KEEP = 100
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling a dependency whose breaker is open."""
+
+
+def is_transient(error):
+    """True for errors worth retrying later (outage, timeout, 429/5xx)."""
+    if isinstance(error, (CircuitOpenError, requests.exceptions.RequestException)):
+        return True
+    status = getattr(getattr(error, "response", None), "status_code", None)
+    return status is not None and (status == 429 or status >= 500)
+
+
+def is_ambiguous(error):
+    """
+    True for transient errors after which a write may still have been
+    applied (read timeouts, dropped connections, 5xx other than 503).
+    Retrying such an append could write the row twice.
+    """
+    if isinstance(error, (CircuitOpenError, requests.exceptions.ConnectTimeout)):
+        return False
+    status = getattr(getattr(error, "response", None), "status_code", None)
+    if status is not None:
+        return status >= 500 and status != 503
+    return isinstance(error, requests.exceptions.RequestException)
+
+
+class CircuitBreaker:
+    """
+    Opens after `failure_threshold` consecutive failures and rejects calls
+    for `reset_seconds`. Then one probe call is let through: success closes
+    the breaker, failure opens it again. Calls slower than `slow_seconds`
+    count as failures. Exceptions in `ignore` (e.g. quota waits) and
+    non-transient errors (bad requests) do not count.
+    """
+
+    def __init__(self, name, failure_threshold=FAILURE_THRESHOLD, reset_seconds=RESET_SECONDS,
+                 slow_seconds=None, ignore=()):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.slow_seconds = slow_seconds
+        self.ignore = tuple(ignore)
+        self.state = CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+        self.counters = {"calls": 0, "failures": 0, "rejected": 0, "opened": 0}
+
+    def allow(self):
+        with self._lock:
+            if self.state == CLOSED:
+                return True
+            if self.state == OPEN and time.monotonic() - self._opened_at >= self.reset_seconds:
+                self.state = HALF_OPEN
+            if self.state == HALF_OPEN and not self._probing:
+                self._probing = True
+                return True
+            self.counters["rejected"] += 1
+            return False
+
+    @property
+    def is_open(self):
+        with self._lock:
+            return self.state != CLOSED
+
+    def _done(self, failed):
+        with self._lock:
+            self._probing = False
+            self.counters["calls"] += 1
+            if not failed:
+                self.state = CLOSED
+                self._failures = 0
+                return
+            self.counters["failures"] += 1
+            self._failures += 1
+            if self.state == HALF_OPEN or self._failures >= self.failure_threshold:
+                if self.state != OPEN:
+                    self.counters["opened"] += 1
+                    print(f"Circuit '{self.name}' opened after {self._failures} failure(s)")
+                self.state = OPEN
+                self._opened_at = time.monotonic()
+
+    def _release(self):
+        with self._lock:
+            self._probing = False
+
+    def call(self, fn, *args, **kwargs):
+        if not self.allow():
+            raise CircuitOpenError(f"{self.name} is unavailable")
+        started = time.monotonic()
+        try:
+            result = fn(*args, **kwargs)
+        except self.ignore:
+            self._release()
+            raise
+        except Exception as e:
+            if is_transient(e):
+                self._done(failed=True)
+            else:
+                self._done(failed=False)
+            raise
+        slow = self.slow_seconds is not None and time.monotonic() - started > self.slow_seconds
+        self._done(failed=slow)
+        return result
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def breaker(name, **kwargs):
+    """Process-wide breaker for a dependency name ("sheets", "jma", ...)."""
+    with _breakers_lock:
+        if name not in _breakers:
+            _breakers[name] = CircuitBreaker(name, **kwargs)
+        return _breakers[name]
+
+
+def breaker_stats():
+    """State and counters of every breaker, by dependency name."""
+    with _breakers_lock:
+        breakers = dict(_breakers)
+    return {name: {"state": b.state, **b.counters} for name, b in breakers.items()}
+
+
+class LastGood:
+    """Remembers the last successful result per key and serves it when a reload fails."""
+
+    def __init__(self):
+        self._values = {}
+        self._stale = set()
+        self._lock = threading.Lock()
+
+    def load(self, key, fn, *args, **kwargs):
+        try:
+            value = fn(*args, **kwargs)
+        except Exception as e:
+            with self._lock:
+                if key not in self._values:
+                    raise
+                if key not in self._stale:
+                    print(f"Serving stale '{key}' snapshot: {e}")
+                self._stale.add(key)
+                return self._values[key]
+        with self._lock:
+            self._values[key] = value
+            self._stale.discard(key)
+        return value
+
+    def is_stale(self, key):
+        with self._lock:
+            return key in self._stale
+
+    def get(self, key):
+        """The last successful value for `key`, or None."""
+        with self._lock:
+            return self._values.get(key)
+
+
+class WriteQueue:
+    """
+    Appends rows through `breaker`'s dependency. When the append fails
+    transiently before reaching it (or earlier rows are still waiting), the
+    row is queued in memory and written in order once the dependency is back.
+    Appends that may have been applied (see is_ambiguous) and rows that
+    cannot be written are not retried but moved to the dead letters.
+    Only appends are queued: updates and deletes address rows by number
+    and cannot safely be replayed later.
+
+    With `directory`, save() keeps rows still waiting at exit in
+    write_queue.jsonl and load() takes them over at the next start;
+    `tables` maps the table names of those rows to the tables to write to.
+    Dead letters are also appended to write_queue_dead.jsonl there.
+    """
+
+    QUEUE_FILE = "write_queue.jsonl"
+    DEAD_LETTER_FILE = "write_queue_dead.jsonl"
+
+    def __init__(self, breaker, retry_seconds=15, directory=None, tables=None):
+        self.breaker = breaker
+        self.retry_seconds = retry_seconds
+        self.directory = directory
+        self.tables = tables or {}
+        self._items = deque()       # (table name, table, args, kwargs)
+        self.dead_letters = deque(maxlen=DEAD_LETTER_KEEP)
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        self.counters = {"queued": 0, "written": 0, "uncertain": 0, "dead": 0}
+
+    def _ensure_worker(self):
+        # fork 後のワーカーではスレッドを作り直す
+        if self._thread is None or self._pid != os.getpid() or not self._thread.is_alive():
+            self._pid = os.getpid()
+            # 貯めた行は追記したテナント（tenants.py）のシートに書く
+            self._thread = threading.Thread(target=contextvars.copy_context().run, args=(self._loop,),
+                                            name=f"{self.breaker.name}-write-queue", daemon=True)
+            self._thread.start()
+
+    def append(self, name, table, args, kwargs):
+        """Appends now if possible. Returns WRITTEN, QUEUED or UNCERTAIN."""
+        # 保存待ちにした行も後で書かれるので、書き込みを出したものとして扱う
+        event_dedup.note_write()
+        with self._lock:
+            waiting = bool(self._items)
+            if waiting:
+                self._items.append((name, table, args, kwargs))
+                self.counters["queued"] += 1
+        if waiting:
+            self._ensure_worker()
+            return QUEUED
+        try:
+            table.append_row(*args, **kwargs)
+            return WRITTEN
+        except Exception as e:
+            if not is_transient(e):
+                raise
+            if is_ambiguous(e):
+                self.counters["uncertain"] += 1
+                self._dead_letter(name, args, kwargs, f"uncertain: {e}")
+                return UNCERTAIN
+            print(f"Queued append to '{name}' for later ({e})")
+            with self._lock:
+                self._items.append((name, table, args, kwargs))
+                self.counters["queued"] += 1
+            self._ensure_worker()
+            return QUEUED
+
+    def pending_count(self):
+        with self._lock:
+            return len(self._items)
+
+    def drain(self):
+        written = 0
+        while True:
+            with self._lock:
+                if not self._items:
+                    return written
+                name, table, args, kwargs = self._items[0]
+            if table is None:
+                table = self.tables.get(name)
+            try:
+                if table is None:
+                    raise LookupError(f"no table registered for '{name}'")
+                table.append_row(*args, **kwargs)
+                written += 1
+                self.counters["written"] += 1
+            except Exception as e:
+                if is_transient(e) and not is_ambiguous(e):
+                    return written
+                # 書けたか分からない行・書けない行（不正な値など）は捨てずに dead letter に移して先に進む
+                self._dead_letter(name, args, kwargs, f"{'uncertain' if is_transient(e) else 'rejected'}: {e}")
+            with self._lock:
+                self._items.popleft()
+
+    def _dead_letter(self, name, args, kwargs, reason):
+        item = {"table": name, "args": list(args), "kwargs": kwargs, "reason": reason, "at": time.time()}
+        self.dead_letters.append(item)
+        self.counters["dead"] += 1
+        print(f"Append to '{name}' moved to dead letters ({reason}): {list(args)}")
+        if self.directory:
+            try:
+                self._append_lines(self.DEAD_LETTER_FILE, [item])
+            except OSError:
+                traceback.print_exc()
+
+    def _locked(self, filename):
+        os.makedirs(self.directory, exist_ok=True)
+        lock_file = open(os.path.join(self.directory, filename + ".lock"), "a")
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        return lock_file
+
+    def _append_lines(self, filename, items):
+        # 複数のワーカーが同じファイルに書くのでロックして追記する
+        with self._locked(filename):
+            with open(os.path.join(self.directory, filename), "a", encoding="utf-8") as f:
+                for item in items:
+                    f.write(json.dumps(item, ensure_ascii=False) + "\n")
+
+    def save(self):
+        """Moves the rows still waiting to the queue file for the next start. Returns their number."""
+        if not self.directory:
+            return 0
+        with self._lock:
+            items, self._items = list(self._items), deque()
+        if items:
+            self._append_lines(self.QUEUE_FILE, [
+                {"table": name, "args": list(args), "kwargs": kwargs} for name, _, args, kwargs in items
+            ])
+        return len(items)
+
+    def load(self):
+        """Queues the rows saved by save() in any process (each row is taken by one process). Returns their number."""
+        if not self.directory:
+            return 0
+        path = os.path.join(self.directory, self.QUEUE_FILE)
+        with self._locked(self.QUEUE_FILE):
+            try:
+                with open(path, encoding="utf-8") as f:
+                    lines = f.read().splitlines()
+            except FileNotFoundError:
+                return 0
+            os.remove(path)
+        items = []
+        for line in lines:
+            try:
+                item = json.loads(line)
+                items.append((item["table"], None, tuple(item["args"]), item["kwargs"]))
+            except (ValueError, KeyError):
+                print(f"Ignoring broken line in {path}: {line!r}")
+        with self._lock:
+            # 保存されていた行は、この起動で新しく来た行より先に書く
+            self._items.extendleft(reversed(items))
+        if items:
+            print(f"Restored {len(items)} queued append(s) from {path}")
+            self._ensure_worker()
+        return len(items)
+
+    def _loop(self):
+        while True:
+            time.sleep(self.retry_seconds)
+            try:
+                if self.pending_count():
+                    self.drain()
+            except Exception:
+                traceback.print_exc()
+
+
+class QueuedAppends:
+    """
+    A table view whose append_row goes through a WriteQueue under `name`
+    (the key in the queue's `tables`) and returns WRITTEN, QUEUED or UNCERTAIN.
+    """
+
+    def __init__(self, table, queue, name):
+        self._table = table
+        self._queue = queue
+        self._name = name
+
+    def __getattr__(self, name):
+        return getattr(self._table, name)
+
+    def append_row(self, *args, **kwargs):
+        return self._queue.append(self._name, self._table, args, kwargs)
@@ -0,0 +1,151 @@
+# event_dedup.py
+# LINEの再送（redelivery）によるイベントの二重処理を防ぐ
+# webhookEventId を TTL 付き・上限付きの集合で管理する
+# 処理を始めるときに記録し、処理に失敗したら release() で消す（再送されたときに処理し直す）
+# ただし書き込みを出した後の失敗では消さない（再送で同じ行を二重に書かないように）
+
+import contextvars
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+TTL_SECONDS = int(os.environ.get("EVENT_DEDUP_TTL", "600"))
+MAX_ENTRIES = int(os.environ.get("EVENT_DEDUP_MAX", "10000"))
+# 複数ワーカーで共有する場合は SQLite ファイルのパスを指定する
+SHARED_DB_PATH = os.environ.get("EVENT_DEDUP_DB")
+
+
+class MemoryDedup:
+    def __init__(self, ttl=TTL_SECONDS, max_entries=MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._seen = OrderedDict()  # event_id -> expires
+        self._lock = threading.Lock()
+
+    def mark(self, event_id):
+        """Records event_id. Returns False if it was already seen and not expired."""
+        now = time.monotonic()
+        with self._lock:
+            # 古いものから期限切れを捨てる
+            while self._seen:
+                expires = next(iter(self._seen.values()))
+                if expires > now and len(self._seen) < self.max_entries:
+                    break
+                self._seen.popitem(last=False)
+            if event_id in self._seen:
+                return False
+            self._seen[event_id] = now + self.ttl
+            return True
+
+    def unmark(self, event_id):
+        with self._lock:
+            self._seen.pop(event_id, None)
+
+
+class SqliteDedup:
+    def __init__(self, path, ttl=TTL_SECONDS):
+        self.path = path
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._conn = None
+        self._pid = None
+
+    def _connection(self):
+        # fork 後のワーカーでは接続を開き直す
+        if self._conn is None or self._pid != os.getpid():
+            self._conn = sqlite3.connect(self.path, timeout=5, check_same_thread=False, isolation_level=None)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS seen_events (event_id TEXT PRIMARY KEY, expires REAL NOT NULL)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS seen_events_expires ON seen_events (expires)")
+            self._pid = os.getpid()
+        return self._conn
+
+    def mark(self, event_id):
+        now = time.time()
+        with self._lock:
+            conn = self._connection()
+            conn.execute("DELETE FROM seen_events WHERE expires < ?", (now,))
+            cur = conn.execute(
+                "INSERT OR IGNORE INTO seen_events (event_id, expires) VALUES (?, ?)",
+                (event_id, now + self.ttl),
+            )
+            return cur.rowcount == 1
+
+    def unmark(self, event_id):
+        with self._lock:
+            self._connection().execute("DELETE FROM seen_events WHERE event_id = ?", (event_id,))
+
+
+_backend = SqliteDedup(SHARED_DB_PATH) if SHARED_DB_PATH else MemoryDedup()
+counters = {"processed": 0, "duplicates": 0, "no_id": 0, "released": 0, "kept": 0}
+# 処理中のイベントについて、書き込みを出したかどうか（handling() の中だけ dict が入る）
+_handling = contextvars.ContextVar("event_handling", default=None)
+
+
+def first_delivery(event):
+    """
+    Returns True if the event should be processed.
+    Events without a webhookEventId are always processed.
+    """
+    event_id = getattr(event, "webhook_event_id", None)
+    if not event_id:
+        counters["no_id"] += 1
+        return True
+    try:
+        fresh = _backend.mark(event_id)
+    except sqlite3.Error as e:
+        # 共有ストアが使えない場合は処理を止めない
+        print(f"event dedup backend error: {e}")
+        return True
+    if fresh:
+        counters["processed"] += 1
+    else:
+        counters["duplicates"] += 1
+    return fresh
+
+
+def release(event):
+    """Forgets an event whose processing failed, so that its redelivery is processed."""
+    event_id = getattr(event, "webhook_event_id", None)
+    if not event_id:
+        return
+    try:
+        _backend.unmark(event_id)
+    except sqlite3.Error as e:
+        print(f"event dedup backend error: {e}")
+        return
+    counters["released"] += 1
+
+
+def note_write():
+    """Records that the event being handled has issued a write (called by the storage layer)."""
+    state = _handling.get()
+    if state is not None:
+        state["wrote"] = True
+
+
+@contextmanager
+def handling(event):
+    """
+    Handles `event` in the block. If the block fails before any write was
+    issued, the event is released so that its redelivery is processed.
+    After a write the mark is kept: processing the redelivery again could
+    write the same row twice.
+    """
+    state = {"wrote": False}
+    token = _handling.set(state)
+    try:
+        yield
+    except Exception:
+        if state["wrote"]:
+            counters["kept"] += 1
+        else:
+            release(event)
+        raise
+    finally:
+        _handling.reset(token)
@@ -0,0 +1,175 @@
+# export.py
+# IDT 記録・管理者記録を CSV / NDJSON で書き出す（/export エンドポイント用）
+#
+# 記録は生成器で1件ずつ流し、データ全体をメモリに載せない。
+# IDT 記録は索引（idt_index.py）から、管理者記録はシートを EXPORT_CHUNK_ROWS 行ずつ読みながら出力する。
+#
+#   EXPORT_CHUNK_ROWS   管理者記録シートを1回に読む行数 (既定 500)
+
+import csv
+import io
+import json
+import os
+import re
+
+CHUNK_ROWS = int(os.environ.get("EXPORT_CHUNK_ROWS", "500"))
+# この大きさまで貯めてから送る（1行ずつ送ると遅い）
+FLUSH_BYTES = 64 * 1024
+
+IDT_FIELDS = ["name", "grade", "gender", "date", "time", "weight", "score"]
+# 管理者記録シートの列: date, name, gender, time, weight, score
+ADMIN_FIELDS = ["date", "name", "gender", "time", "weight", "score"]
+
+FORMATS = {
+    "csv": ("text/csv; charset=utf-8", "csv"),
+    "ndjson": ("application/x-ndjson", "ndjson"),
+}
+
+_DATE_RE = re.compile(r"^\s*(\d{4})[/-](\d{1,2})[/-](\d{1,2})")
+
+
+def parse_date(value):
+    """(year, month, day) from "2024/5/1" or "2024-05-01", or None."""
+    match = _DATE_RE.match(str(value or ""))
+    return tuple(int(n) for n in match.groups()) if match else None
+
+
+class Filters:
+    def __init__(self, date_from=None, date_to=None, grade=None, gender=None):
+        self.date_from = date_from
+        self.date_to = date_to
+        self.grade = grade
+        self.gender = gender
+
+    @classmethod
+    def from_args(cls, args):
+        """Builds filters from query parameters (from, to, grade, gender); ValueError if invalid."""
+        bounds = []
+        for name in ("from", "to"):
+            value = args.get(name)
+            date = parse_date(value) if value else None
+            if value and date is None:
+                raise ValueError(f"invalid date for '{name}': {value}")
+            bounds.append(date)
+        gender = (args.get("gender") or "").lower() or None
+        if gender not in (None, "m", "w"):
+            raise ValueError(f"invalid gender: {gender}")
+        return cls(bounds[0], bounds[1], args.get("grade") or None, gender)
+
+    def matches(self, date, gender, grade=None):
+        if self.grade is not None and str(grade) != self.grade:
+            return False
+        if self.gender is not None and str(gender).lower() != self.gender:
+            return False
+        if self.date_from or self.date_to:
+            day = parse_date(date)
+            if day is None:
+                return False
+            if self.date_from and day < self.date_from:
+                return False
+            if self.date_to and day > self.date_to:
+                return False
+        return True
+
+
+def idt_records(index, filters):
+    """Yields IDT records (IDT_FIELDS order) from the index, including rows not yet synced."""
+    # 読み直しで entries が差し替えられても、走査中のリストはそのまま使える
+    entries = index.entries
+    for i in range(len(entries)):
+        e = entries[i]
+        if filters.matches(e.date, e.gender, e.grade):
+            yield [e.name, e.grade, e.gender, e.date, e.time_str, e.weight, e.score]
+    for e in index.unsynced_entries():
+        if filters.matches(e.date, e.gender, e.grade):
+            yield [e.name, e.grade, e.gender, e.date, e.time_str, e.weight, e.score]
+
+
+def sheet_rows(table, first_row=2, last_col="F", chunk=CHUNK_ROWS):
+    """Yields the rows of `table` from `first_row`, reading `chunk` rows per request."""
+    start = first_row
+    while True:
+        try:
+            rows = table.get(f"A{start}:{last_col}{start + chunk - 1}")
+        except Exception as e:
+            # シートの行数を超えた範囲は 400 になる（＝最後まで読んだ）
+            if getattr(getattr(e, "response", None), "status_code", None) == 400:
+                return
+            raise
+        if not rows:
+            return
+        yield from rows
+        start += chunk
+
+
+def admin_records(table, filters):
+    """Yields admin records (ADMIN_FIELDS order), reading the sheet chunk by chunk."""
+    width = len(ADMIN_FIELDS)
+    for row in sheet_rows(table, last_col=chr(ord("A") + width - 1)):
+        row = list(row[:width]) + [""] * (width - len(row))
+        if not any(row):
+            continue
+        if filters.matches(row[0], row[2]):
+            yield row
+
+
+def _number(value):
+    if isinstance(value, str):
+        try:
+            return float(value) if value.strip() else None
+        except ValueError:
+            return value
+    return value
+
+
+# CSV インジェクション対策で ' を前に付ける先頭文字
+_FORMULA_PREFIXES = ("=", "+", "-", "@", "\t", "\r")
+
+
+def _csv_value(value):
+    if value is None:
+        return ""
+    if isinstance(value, float):
+        # 60.0 は "60" と書く（シートでの表示と同じ）
+        return str(int(value)) if value.is_integer() else repr(value)
+    # 表計算ソフトで開いたときに数式として実行されないよう、先頭に ' を付けて文字列にする
+    if isinstance(value, str) and value.startswith(_FORMULA_PREFIXES):
+        return "'" + value
+    return value
+
+
+def csv_chunks(fields, records):
+    buffer = io.StringIO()
+    # 行末は RFC 4180 の CRLF にする（"\n" だと値の中の "\r" が引用符で囲まれず、行が割れる）
+    writer = csv.writer(buffer, lineterminator="\r\n")
+    writer.writerow(fields)
+    for record in records:
+        writer.writerow([_csv_value(v) for v in record])
+        if buffer.tell() >= FLUSH_BYTES:
+            yield buffer.getvalue().encode("utf-8")
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue().encode("utf-8")
+
+
+def ndjson_chunks(fields, records):
+    numeric = {"weight", "score"}
+    parts = []
+    size = 0
+    for record in records:
+        item = {f: (_number(v) if f in numeric else v) for f, v in zip(fields, record)}
+        line = json.dumps(item, ensure_ascii=False) + "\n"
+        parts.append(line)
+        size += len(line)
+        if size >= FLUSH_BYTES:
+            yield "".join(parts).encode("utf-8")
+            parts, size = [], 0
+    if parts:
+        yield "".join(parts).encode("utf-8")
+
+
+def serialize(fmt, fields, records):
+    """Encoded chunks of `records` in `fmt` ("csv" or "ndjson")."""
+    if fmt == "ndjson":
+        return ndjson_chunks(fields, records)
+    return csv_chunks(fields, records)
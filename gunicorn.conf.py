@@ -0,0 +1,30 @@
+# gunicorn.conf.py
+# gunicorn は起動ディレクトリのこのファイルを自動で読み込む（Procfile: gunicorn main:app）
+#
+# preload_app でマスターが main を一度だけ読み込み、ワーカーは fork でそれを引き継ぐ。
+# 再起動・スケールアウト時にワーカーごとの import やシート接続の準備を待たずに済む。
+# スレッドと HTTP 接続は fork で引き継げないので、post_fork で main.init_worker() を呼んで作り直す。
+# ワーカーの終了時には main.shutdown_worker() で次回起動用のキャッシュを保存する（warm_start.py）。
+#
+#   GUNICORN_PRELOAD=0  preload を使わない（各ワーカーが main を読み込む従来の動作）
+
+import os
+
+preload_app = os.environ.get("GUNICORN_PRELOAD", "1") == "1"
+
+if preload_app:
+    # マスターでの import 時にはスレッドを起動しない
+    os.environ["DEFER_WORKER_INIT"] = "1"
+
+
+def post_fork(server, worker):
+    if preload_app:
+        import main
+        main.init_worker()
+
+
+def worker_exit(server, worker):
+    import sys
+    main = sys.modules.get("main")
+    if main is not None:
+        main.shutdown_worker()
@@ -0,0 +1,276 @@
+# idt_index.py
+# database シートの IDT 記録を選手（名前+学年）ごとに索引化する
+# シートの列: name, grade, gender, date, time, weight, score, admin
+
+import bisect
+import os
+import random
+import threading
+import time
+import zlib
+from array import array
+from collections import namedtuple
+
+from singleflight import SingleFlight
+
+COL_NAME, COL_GRADE, COL_GENDER, COL_DATE, COL_TIME, COL_WEIGHT, COL_SCORE, COL_ADMIN = range(8)
+
+IdtEntry = namedtuple("IdtEntry", ["row_number", "name", "grade", "gender", "date", "time_str", "weight", "score"])
+
+# 他ワーカーが追記した分を取り込むため、この秒数を過ぎたら追記分を読む
+SYNC_SECONDS = float(os.environ.get("IDT_SYNC_SECONDS", "60"))
+# 見落とした手作業の編集を拾うため、この秒数を過ぎたら全体を読み直す
+FULL_REFRESH_SECONDS = float(os.environ.get("IDT_FULL_REFRESH_SECONDS", "21600"))
+# 追記分を読むときに、既に取り込んだ行が変わっていないかを確かめる範囲（数と行数）
+SAMPLE_BLOCKS = 2
+SAMPLE_ROWS = 5
+LAST_COL = "H"
+# このプロセスが追記した記録は、シートから読めるまで（保存待ちの間も）索引に含める。
+# 書き込みを諦めた行が残り続けないよう、この秒数を過ぎたものは捨てる
+LOCAL_MAX_SECONDS = 86400
+# シートから読んだ行と追記した記録を同じものとみなす IDT の差（シートの表示桁数で丸められるため）
+SCORE_TOLERANCE = 0.05
+
+
+def _to_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def entry_from_row(row_number, row):
+    """Converts a sheet row into an IdtEntry, or None for header/broken rows."""
+    if len(row) <= COL_SCORE:
+        return None
+    score = _to_float(row[COL_SCORE])
+    if score is None:
+        return None
+    return IdtEntry(
+        row_number, row[COL_NAME], str(row[COL_GRADE]), row[COL_GENDER],
+        row[COL_DATE], row[COL_TIME], _to_float(row[COL_WEIGHT]), score,
+    )
+
+
+def row_hash(row):
+    """Checksum of a row's A:H cells, ignoring trailing empty cells (as gspread's get() drops them)."""
+    cells = [str(v) for v in row[:COL_ADMIN + 1]]
+    while cells and cells[-1] == "":
+        cells.pop()
+    return zlib.crc32("\x1f".join(cells).encode("utf-8"))
+
+
+class IdtIndex:
+    """
+    Index of the IDT records sheet. The sheet only grows by append_row, so
+    after the first full read sync() fetches just the rows below the last
+    one seen (A{n}:H, starting at the last known row so it is re-checked).
+    A few sampled blocks of earlier rows are compared with stored row
+    checksums in the same request; any difference (a manual edit, insert
+    or delete) falls back to a full reload.
+    """
+
+    def __init__(self, sheet):
+        self.sheet = sheet
+        self.entries = []        # 読み込んだ順（＝行順）の IdtEntry
+        self.by_athlete = {}     # (name, grade) -> [(date, offset), ...] 日付順
+        self.row_count = 0       # 取り込み済みのシート行数（ヘッダー含む）
+        self.generation = 0      # 全体を読み直すたびに増える
+        self.loaded_at = None
+        self.full_loaded_at = None
+        self._hashes = array("L")   # シートの行ごとの row_hash（行番号 - 1 が添字）
+        self._local = []            # (追加時刻, IdtEntry) このプロセスが追記し、まだシートから読めていない記録
+        self._lock = threading.Lock()
+        self._flight = SingleFlight()
+        self.counters = {"full": 0, "tail": 0, "tail_rows": 0, "mismatch": 0}
+
+    def _reset(self):
+        self.entries = []
+        self.by_athlete = {}
+        self.row_count = 0
+        self._hashes = array("L")
+
+    def _add_entry(self, entry):
+        offset = len(self.entries)
+        self.entries.append(entry)
+        offsets = self.by_athlete.setdefault((entry.name, entry.grade), [])
+        bisect.insort(offsets, (entry.date, offset))
+
+    def _load_rows(self, rows, start_row):
+        loaded = []
+        for row_number, row in enumerate(rows, start=start_row):
+            self._hashes.append(row_hash(row))
+            entry = entry_from_row(row_number, row)
+            if entry:
+                self._add_entry(entry)
+                loaded.append(entry)
+        self.row_count = start_row - 1 + len(rows)
+        return loaded
+
+    def _observe(self, loaded):
+        """Drops the local entries whose rows appear in `loaded` (newest rows first, one row per entry)."""
+        now = time.monotonic()
+        local = [(t, e) for t, e in self._local if now - t <= LOCAL_MAX_SECONDS]
+        for row in reversed(loaded):
+            if not local:
+                break
+            for i, (_, e) in enumerate(local):
+                if (e.name, e.grade) == (row.name, row.grade) and abs(e.score - row.score) <= SCORE_TOLERANCE:
+                    del local[i]
+                    break
+        self._local = local
+
+    def refresh(self):
+        """Reads the whole sheet again."""
+        started = time.monotonic()
+        rows = self.sheet.get_all_values()
+        with self._lock:
+            self._reset()
+            self._observe(self._load_rows(rows, 1))
+            self.generation += 1
+            self.loaded_at = self.full_loaded_at = started
+        self.counters["full"] += 1
+
+    def _sample_blocks(self, n):
+        # 末尾の行は追記分と一緒に読むので、それより上からランダムに選ぶ
+        if n < 3:
+            return []
+        blocks = set()
+        for _ in range(SAMPLE_BLOCKS):
+            first = random.randint(2, n - 1)
+            blocks.add((first, min(first + SAMPLE_ROWS - 1, n - 1)))
+        return sorted(blocks)
+
+    def _matches(self, first_row, rows, count):
+        rows = list(rows) + [[]] * (count - len(rows))
+        return all(
+            row_hash(row) == self._hashes[row_number - 1]
+            for row_number, row in enumerate(rows[:count], start=first_row)
+        )
+
+    def sync(self):
+        """Brings the index up to date, reading only new rows when nothing above them changed."""
+        if not self.row_count or self.full_loaded_at is None or time.monotonic() - self.full_loaded_at > FULL_REFRESH_SECONDS:
+            return self.refresh()
+        started = time.monotonic()
+        with self._lock:
+            n = self.row_count
+        blocks = self._sample_blocks(n)
+        ranges = [f"A{n}:{LAST_COL}"] + [f"A{first}:{LAST_COL}{last}" for first, last in blocks]
+        try:
+            tail, *samples = self.sheet.batch_get(ranges)
+        except Exception as e:
+            # 行が消されてシートが短くなると範囲外の指定として 400 になる
+            if getattr(getattr(e, "response", None), "status_code", None) != 400:
+                raise
+            tail, samples = [], []
+        with self._lock:
+            unchanged = (
+                self.row_count == n and tail and row_hash(tail[0]) == self._hashes[n - 1]
+                and all(self._matches(first, rows, last - first + 1) for (first, last), rows in zip(blocks, samples))
+            )
+            if unchanged:
+                self._observe(self._load_rows(tail[1:], n + 1))
+                self.loaded_at = started
+        if not unchanged:
+            print(f"IDT sheet changed at or above row {n}; reloading it")
+            self.counters["mismatch"] += 1
+            return self.refresh()
+        self.counters["tail"] += 1
+        self.counters["tail_rows"] += len(tail) - 1
+
+    def dump(self):
+        """The loaded rows as JSON-able data for the warm-start file; None before the first load."""
+        with self._lock:
+            if self.loaded_at is None:
+                return None
+            return {
+                "row_count": self.row_count,
+                "entries": [list(e) for e in self.entries],
+                "hashes": self._hashes.tolist(),
+            }
+
+    def restore(self, data):
+        """Loads rows saved by dump(). The next sync() reads only rows added since."""
+        entries = [IdtEntry(*e) for e in data["entries"]]
+        with self._lock:
+            self._reset()
+            for entry in entries:
+                self._add_entry(entry)
+            self._hashes = array("L", data["hashes"])
+            self.row_count = data["row_count"]
+            self.generation += 1
+            self.loaded_at = self.full_loaded_at = time.monotonic()
+
+    def ensure_fresh(self):
+        if self.loaded_at is None or time.monotonic() - self.loaded_at > SYNC_SECONDS:
+            # 同時に期限切れを検知しても読み込みは1回だけ
+            self._flight.do("sync", self.sync)
+
+    def add(self, row):
+        """Registers a row this process has just appended (or queued); it is shown until a sync() reads it from the sheet."""
+        with self._lock:
+            if self.loaded_at is None:
+                return
+            entry = entry_from_row(None, row)
+            if entry:
+                self._local.append((time.monotonic(), entry))
+
+    @property
+    def version(self):
+        """Changes whenever the indexed records change."""
+        with self._lock:
+            return (self.generation, self.row_count, len(self._local))
+
+    def all_entries(self):
+        with self._lock:
+            return self.entries + [e for _, e in self._local]
+
+    def unsynced_entries(self):
+        """Rows this process appended that sync() has not read back yet."""
+        with self._lock:
+            return [e for _, e in self._local]
+
+    def records_for(self, name, grade):
+        key = (name, str(grade))
+        with self._lock:
+            offsets = self.by_athlete.get(key, [])
+            synced = [self.entries[offset] for _, offset in offsets]
+            local = [e for _, e in self._local if (e.name, e.grade) == key]
+        if not local:
+            return synced
+        return sorted(synced + local, key=lambda e: e.date)
+
+
+def summarize_history(entries, limit=5, window=3):
+    """
+    Builds the history summary for one athlete's entries (date order).
+    Returns a dict with the last `limit` records (each with a rolling
+    average over `window` records), the personal best and overall average.
+    """
+    if not entries:
+        return None
+    scores = [e.score for e in entries]
+    recent = []
+    start = max(0, len(entries) - limit)
+    for i in range(start, len(entries)):
+        lo = max(0, i - window + 1)
+        rolling = sum(scores[lo:i + 1]) / (i + 1 - lo)
+        recent.append((entries[i], rolling))
+    best = max(entries, key=lambda e: e.score)
+    return {
+        "count": len(entries),
+        "recent": recent,
+        "best": best,
+        "average": sum(scores) / len(scores),
+    }
+
+
+def format_history(summary, window=3):
+    lines = [f"IDT記録（全{summary['count']}件）"]
+    for entry, rolling in summary["recent"]:
+        lines.append(f"{entry.date} {entry.time_str} {entry.score:.2f}%（直近{window}回平均 {rolling:.2f}%）")
+    best = summary["best"]
+    lines.append(f"自己ベスト: {best.score:.2f}%（{best.date} {best.time_str}）")
+    lines.append(f"全体平均: {summary['average']:.2f}%")
+    return "\n".join(lines)
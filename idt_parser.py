@@ -0,0 +1,113 @@
+# idt_parser.py
+# IDT記録入力のパース・検証・スコア計算をまとめたモジュール
+
+import re
+from collections import namedtuple
+
+# 正規表現は import 時に一度だけコンパイルする
+_TIME_RE = re.compile(r"^(\d{1,2}):([0-5]?\d)(?:\.(\d))?$")
+_IDT_INPUT_RE = re.compile(r"^(\d{1,2}:[0-5]?\d(?:\.\d)?)\s+(\d{1,3}\.\d)\s+([mwMW])$")
+_LINE_SPLIT_RE = re.compile(r"\r?\n")
+
+# エラーコード
+ERR_FORMAT = "format"        # 項目数が合わない
+ERR_TIME = "time"            # タイム形式が不正
+ERR_WEIGHT = "weight"        # 体重が数値でない
+ERR_GENDER = "gender"        # 性別が m/w 以外
+ERR_GRADE = "grade"          # 学年が数字でない
+
+# 入力モードごとの項目並び
+FIELDS_TIME_WEIGHT = ("time", "weight")
+FIELDS_TIME_WEIGHT_GENDER = ("time", "weight", "gender")
+FIELDS_ADMIN_IDT = ("name", "grade", "time", "gender", "weight")
+FIELDS_ADMIN_ADD = ("name", "gender", "time", "weight")
+
+# 検証順（モードに関係なくこの順でエラーを返す）
+_CHECK_ORDER = ("grade", "gender", "time", "weight")
+
+IdtRecord = namedtuple(
+    "IdtRecord",
+    ["name", "grade", "gender", "time_str", "minutes", "seconds", "tenths", "weight", "score"],
+)
+
+
+def parse_time_str(time_str):
+    match = _TIME_RE.match(time_str)
+    if not match:
+        return None
+    min_str, sec_str, secd_str = match.groups()
+    return int(min_str), int(sec_str), int(secd_str) if secd_str else 0
+
+
+def parse_idt_input(text):
+    match = _IDT_INPUT_RE.match(text.strip())
+    if not match:
+        return None
+    time_str, weight_str, gender_str = match.groups()
+    return time_str, float(weight_str), gender_str.lower()
+
+
+def calc_idt(mi, se, sed, wei, gend):
+    ergo = mi * 60.0 + se + sed * 0.1
+    idtm = ((101.0 - wei) * (20.9 / 23.0) + 333.07) / ergo * 100.0
+    idtw = ((100.0 - wei) * (1.40) + 357.80) / ergo * 100.0
+    score = idtm * (1.0 - gend) + idtw * gend
+    return score
+
+
+def round_score(score):
+    # 表示・記録用に小数第2位で丸める（浮動小数誤差対策で微小値を足す）
+    return round(score + 1e-8, 2)
+
+
+def parse_record(text, fields, name=None, grade=None, gender=None):
+    """
+    Parses one line of record input into an IdtRecord.
+    `fields` is one of the FIELDS_* tuples; values missing from the line
+    (e.g. the logged-in user's name/gender) are taken from the keyword args.
+    Returns (record, None) on success or (None, error_code) on failure.
+    """
+    parts = text.split()
+    if len(parts) != len(fields):
+        return None, ERR_FORMAT
+    values = {"name": name, "grade": grade, "gender": gender}
+    values.update(zip(fields, parts))
+
+    for field in _CHECK_ORDER:
+        value = values.get(field)
+        if field == "grade":
+            if "grade" in fields and not value.isdigit():
+                return None, ERR_GRADE
+        elif field == "gender":
+            if value is None or value.lower() not in ("m", "w"):
+                return None, ERR_GENDER
+        elif field == "time":
+            t = parse_time_str(value)
+            if not t:
+                return None, ERR_TIME
+        elif field == "weight":
+            try:
+                weight = float(value)
+            except (TypeError, ValueError):
+                return None, ERR_WEIGHT
+
+    gender_value = values["gender"]
+    mi, se, sed = t
+    gend = 0.0 if gender_value.lower() == "m" else 1.0
+    score = round_score(calc_idt(mi, se, sed, weight, gend))
+    return IdtRecord(
+        values["name"], values["grade"], gender_value, values["time"],
+        mi, se, sed, weight, score,
+    ), None
+
+
+def parse_records(text, fields, **defaults):
+    """
+    Parses multi-line input in a single pass.
+    Yields (line_number, record, error_code) for each non-empty line.
+    """
+    for i, line in enumerate(_LINE_SPLIT_RE.split(text), start=1):
+        if not line.strip():
+            continue
+        record, error = parse_record(line, fields, **defaults)
+        yield i, record, error
@@ -1,200 +1,330 @@
 import os
+import sys
 import json
 import datetime
 import pytz
 import random
 import re
-from flask import Flask, request, abort
-from linebot import LineBotApi, WebhookHandler
+import hmac
+import atexit
+from flask import Flask, request, abort, Response, stream_with_context
+from linebot import LineBotApi
 from linebot.exceptions import InvalidSignatureError
 from linebot.models import MessageEvent, TextMessage, TextSendMessage
-import gspread
-from google.oauth2.service_account import Credentials
-import requests
-from bs4 import BeautifulSoup
-import datetime
 import traceback
-import io
-from PyPDF2 import PdfReader
-import tempfile
-from linebot.models import FlexSendMessage
+import event_dedup
+import export
+import webhook_capture
+import profiler
+import rate_limit
+from idt_index import IdtIndex, summarize_history, format_history
+from team_report import ReportService
+from session_store import SessionStore
+from circuit_breaker import LastGood, WriteQueue, QueuedAppends, QUEUED, UNCERTAIN, breaker_stats
+from shared_snapshot import SharedSnapshots, SNAPSHOT_DIR
+from tenants import TenantWebhookHandler, init_registry, tenant_local, current as current_tenant
+from warm_start import WarmStart, WARM_START_PATH
+from sheets_quota import with_priority, get_scheduler, PRIORITY_BACKGROUND, PRIORITY_REFRESH
+from storage import (
+    open_storage, sheets_breaker, rowcol_to_a1, apply_mutation, find_rows, RowMutation, ConflictError,
+    USERS, IDT_RECORDS, ADMIN_RECORDS,
+)
+from table import table_for, UsersTable, SuspendTable, BanTable
+from singleflight import SingleFlight
+from tide import load_tide_table, TideScheduler, dump_tide_tables, restore_tide_tables
+from render_cache import get_role, help_message, readme_message
+from idt_parser import (
+    parse_record,
+    ERR_FORMAT, ERR_TIME, ERR_WEIGHT, ERR_GENDER, ERR_GRADE,
+    FIELDS_TIME_WEIGHT, FIELDS_TIME_WEIGHT_GENDER, FIELDS_ADMIN_IDT, FIELDS_ADMIN_ADD,
+)
 
 app = Flask(__name__)
 
-LINE_CHANNEL_ACCESS_TOKEN = os.environ["LINE_CHANNEL_ACCESS_TOKEN"]
-LINE_CHANNEL_SECRET = os.environ["LINE_CHANNEL_SECRET"]
-
-line_bot_api = LineBotApi(LINE_CHANNEL_ACCESS_TOKEN)
-handler = WebhookHandler(LINE_CHANNEL_SECRET)
+# 受け持つクラブ（LINE チャネルとスプレッドシートの組）。TENANTS_JSON が無ければ環境変数の1つだけ
+registry = init_registry()
+# 以下の tenant_local はテナントごとに別々の値を持つ（処理中のテナントのものが使われる）
+handler = TenantWebhookHandler()
 
-credentials_json_str = os.environ.get("GOOGLE_CREDENTIALS_JSON")
-if credentials_json_str is None:
-    raise ValueError("GOOGLE_CREDENTIALS_JSON が設定されていません。")
+@tenant_local
+def line_bot_api():
+    return LineBotApi(current_tenant().channel_access_token)
 
-credentials_info = json.loads(credentials_json_str)
 SCOPES = [
     "https://www.googleapis.com/auth/spreadsheets",
     "https://www.googleapis.com/auth/drive"
 ]
-creds = Credentials.from_service_account_info(credentials_info, scopes=SCOPES)
-
-# ユーザデータ用スプレッドシートURLで明示的に指定
-USER_DATABASE_URL = "https://docs.google.com/spreadsheets/d/1wZR1Tdupldp0RVOm00QAbE9-muz47unt_WhxagdirFA/"
-user_db_spreadsheet = gspread.authorize(creds).open_by_url(USER_DATABASE_URL)
-worksheet = user_db_spreadsheet.worksheet("users")
-
-
-IDT_RECORD_URL = os.environ.get("IDT_RECORD_URL", "https://docs.google.com/spreadsheets/d/11ZlpV2yl9aA3gxpS-JhBxgNniaxlDP1NO_4XmpGvg54/edit")
-idt_record_sheet = gspread.authorize(creds).open_by_url(IDT_RECORD_URL).worksheet("database")
+creds = None
+if os.environ.get("STORAGE_BACKEND", "sheets") == "sheets":
+    # google-auth は Sheets を使うときだけ読み込む
+    from google.oauth2.service_account import Credentials
+    credentials_json_str = os.environ.get("GOOGLE_CREDENTIALS_JSON")
+    if credentials_json_str is None:
+        raise ValueError("GOOGLE_CREDENTIALS_JSON が設定されていません。")
+    credentials_info = json.loads(credentials_json_str)
+    creds = Credentials.from_service_account_info(credentials_info, scopes=SCOPES)
+
+# 保存先（Google スプレッドシート or SQLite）。各シートは同じ操作を持つ表として扱う
+@tenant_local
+def storage():
+    tenant = current_tenant()
+    return open_storage(
+        tenant.user_database_url, tenant.idt_record_url, tenant.admin_record_url, credentials=creds,
+        sqlite_path=tenant.sqlite_path, partition=tenant.partition,
+    )
+
+# 書き込んだら全ワーカーの共有スナップショットを捨てる
+@tenant_local
+def snapshots():
+    return SharedSnapshots(current_tenant().state_dir or SNAPSHOT_DIR)
+
+@tenant_local
+def worksheet():
+    return snapshots.invalidating(
+        storage.table(USERS, header=["name", "grade", "key", "user_id", "last_auth", "admin", "gender"]), "users")
+
+# シートに書けない間、記録・停止の追記はメモリに貯めて復旧後に書き込む
+# （終了時に残った分は保存し、次の起動で書き込む。保存先は表の名前で選ぶ）
+@tenant_local
+def append_queue():
+    tenant = current_tenant()
+    return WriteQueue(
+        sheets_breaker(tenant.partition), directory=tenant.state_dir or SNAPSHOT_DIR,
+        tables={IDT_RECORDS: idt_record_table, ADMIN_RECORDS: admin_record_table, SUSPEND_SHEET_NAME: suspend_table},
+    )
+
+@tenant_local
+def idt_record_table():
+    return storage.table(IDT_RECORDS)
+
+@tenant_local
+def idt_record_sheet():
+    return QueuedAppends(idt_record_table, append_queue, IDT_RECORDS)
+
+# 索引の読み直しはキャッシュ更新なので、クォータが足りないときは後回しにする
+@tenant_local
+def idt_index():
+    return IdtIndex(with_priority(storage.table(IDT_RECORDS), PRIORITY_REFRESH))
+
+@tenant_local
+def admin_record_table():
+    return storage.table(ADMIN_RECORDS) if storage.has_admin_records else None
+
+@tenant_local
+def admin_record_sheet():
+    if not storage.has_admin_records:
+        return None
+    return QueuedAppends(admin_record_table, append_queue, ADMIN_RECORDS)
 
-ADMIN_RECORD_URL = os.environ.get("ADMIN_RECORD_URL")
-if ADMIN_RECORD_URL:
-    admin_record_sheet = gspread.authorize(creds).open_by_url(ADMIN_RECORD_URL).worksheet("database")
-else:
-    admin_record_sheet = None
+@tenant_local
+def report_service():
+    admin_sheet = storage.table(ADMIN_RECORDS) if storage.has_admin_records else None
+    return ReportService(
+        idt_index, with_priority(admin_sheet, PRIORITY_BACKGROUND),
+        push=lambda to, text: line_bot_api.push_message(to, TextSendMessage(text=text))
+    )
 
 SUSPEND_SHEET_NAME = os.environ.get("SUSPEND_SHEET_NAME", "suspend_list")
-try:
-    suspend_sheet = user_db_spreadsheet.worksheet(SUSPEND_SHEET_NAME)
-except gspread.exceptions.WorksheetNotFound:
-    suspend_sheet = user_db_spreadsheet.add_worksheet(title=SUSPEND_SHEET_NAME, rows=100, cols=4)
-    suspend_sheet.append_row(["user_id", "until", "reason"])
 
-ADMIN_REQUEST_BAN_SHEET = "admin_request_ban"
-try:
-    admin_request_ban_sheet = user_db_spreadsheet.worksheet(ADMIN_REQUEST_BAN_SHEET)
-except gspread.exceptions.WorksheetNotFound:
-    admin_request_ban_sheet = user_db_spreadsheet.add_worksheet(title=ADMIN_REQUEST_BAN_SHEET, rows=100, cols=3)
-    admin_request_ban_sheet.append_row(["user_id", "until", "last_request_date"])
+@tenant_local
+def suspend_table():
+    return snapshots.invalidating(storage.table(SUSPEND_SHEET_NAME, header=["user_id", "until", "reason"]), "suspend")
 
-def download_tide_pdf(year: int) -> str | None:
-    """
-    Downloads the hourly tide data PDF for Kochi for a given year.
-    Returns the filepath to the temporary PDF file, or None on failure.
-    KC.pdf is the code for Kochi.
-    """
-    url = f"https://www.data.jma.go.jp/kaiyou/data/db/tide/suisan/pdf_hourly/{year}/KC.pdf"
-    headers = {
-        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36"
-    }
-    temp_pdf_file = None
-    try:
-        res = requests.get(url, headers=headers, stream=True)
-        if res.status_code == 200:
-            temp_pdf_file = tempfile.NamedTemporaryFile(delete=False, suffix='.pdf')
-            for chunk in res.iter_content(chunk_size=8192):
-                temp_pdf_file.write(chunk)
-            temp_pdf_file.close()
-            return temp_pdf_file.name
-        else:
-            print(f"Error downloading PDF: Status {res.status_code} for URL {url}")
-            return None
-    except requests.exceptions.RequestException as e:
-        print(f"RequestException while downloading PDF from {url}: {e}")
-        if temp_pdf_file: 
-            temp_pdf_file.close()
-            os.remove(temp_pdf_file.name)
-        return None
-    except Exception as e:
-        print(f"An unexpected error occurred while downloading or writing PDF from {url}: {e}")
-        if temp_pdf_file: 
-            temp_pdf_file.close()
-            try:
-                os.remove(temp_pdf_file.name)
-            except OSError:
-                pass
-        return None
-
-### 変更点 ###
-# 潮位PDFから指定日時の潮位を抽出するロジックを実装
-def extract_tide_from_pdf(pdf_filepath: str, target_month: int, target_day: int, target_hour: int) -> int | None:
-    """
-    Extracts the tide level for a specific date and hour from a JMA PDF file.
-    """
-    try:
-        reader = PdfReader(pdf_filepath)
-        
-        # 月はPDFのページ番号に対応 (1月 -> 0ページ目)
-        if not (0 <= target_month - 1 < len(reader.pages)):
-            print(f"Error: Invalid month {target_month} for PDF with {len(reader.pages)} pages.")
-            return None
-            
-        page = reader.pages[target_month - 1]
-        text = page.extract_text()
-        
-        lines = text.split('\n')
-        
-        # データ行を走査して目的の日の潮位を探す
-        for line in lines:
-            # 行頭がスペースと数字で始まっている行を対象とする (例: " 1 ", "10 ")
-            line_strip = line.strip()
-            if not line_strip or not line_strip[0].isdigit():
-                continue
-
-            # 行をスペースで分割
-            parts = re.split(r'\s+', line_strip)
-            
-            # 最初の部分が日付のはず
-            try:
-                day = int(parts[0])
-            except (ValueError, IndexError):
-                continue
-
-            if day == target_day:
-                # 該当日の行を見つけた
-                # parts[0]は日付なので、潮位データはparts[1:]にある
-                # 0時のデータは parts[1] に対応
-                tide_values = parts[1:]
-                
-                if 0 <= target_hour < len(tide_values):
-                    tide_value_str = tide_values[target_hour]
-                    if tide_value_str.isdigit():
-                        return int(tide_value_str)
-                
-                # もし見つかればその時点で終了
-                return None
-                
-        return None # 最後まで見つからなかった場合
+@tenant_local
+def suspend_sheet():
+    return QueuedAppends(suspend_table, append_queue, SUSPEND_SHEET_NAME)
 
-    except Exception as e:
-        error_details = traceback.format_exc()
-        print(f"Error during PDF processing with PyPDF2 for {pdf_filepath}: {e}\n{error_details}")
-        return None
+ADMIN_REQUEST_BAN_SHEET = "admin_request_ban"
 
+@tenant_local
+def admin_request_ban_sheet():
+    return snapshots.invalidating(
+        storage.table(ADMIN_REQUEST_BAN_SHEET, header=["user_id", "until", "last_request_date"]), "admin_request_ban")
 
 def get_admin_request_ban(user_id):
-    rows = admin_request_ban_sheet.get_all_values()
-    if len(rows) < 2:
+    bans = table_for(load_admin_request_ban_snapshot(), BanTable)
+    if not bans or not bans.has("user_id"):
         return None
-    header = rows[0]
-    user_id_col = header.index("user_id")
-    until_col = header.index("until")
-    for row in rows[1:]:
-        if row[user_id_col] == user_id:
-            try:
-                until_date = datetime.datetime.strptime(row[until_col], "%Y/%m/%d").replace(tzinfo=pytz.timezone('Asia/Tokyo'))
-                return until_date
-            except Exception:
-                return None
-    return None
+    pos = bans.find("user_id", user_id)
+    if pos is None:
+        return None
+    return bans.until[pos]
 
 def set_admin_request_ban(user_id, days=14):
     until = (jst_now() + datetime.timedelta(days=days)).strftime("%Y/%m/%d")
     now_ymd = today_jst_ymd()
-    rows = admin_request_ban_sheet.get_all_values()
-    header = rows[0]
-    user_id_col = header.index("user_id")
-    for i, row in enumerate(rows[1:], start=2):
-        if row[user_id_col] == user_id:
-            admin_request_ban_sheet.update_cell(i, header.index("until")+1, until)
-            admin_request_ban_sheet.update_cell(i, header.index("last_request_date")+1, now_ymd)
-            return
+    # 行番号を指定して書くので、スナップショット（保存ファイルや前回値の場合もある）ではなくシートを直接読む
+    # 列は user_id, until, last_request_date の順
+    found = find_rows(admin_request_ban_sheet, user_id)
+    if found:
+        i = found[0][0]
+        admin_request_ban_sheet.update_cell(i, 2, until)
+        admin_request_ban_sheet.update_cell(i, 3, now_ymd)
+        return
     admin_request_ban_sheet.append_row([user_id, until, now_ymd])
 
-user_states = {}
-otp_store = {}
-idt_memory = {}
-admin_request_store = {}
+TIDE_SUBSCRIBERS_SHEET = "tide_subscribers"
+
+@tenant_local
+def tide_subscribers_sheet():
+    return storage.table(TIDE_SUBSCRIBERS_SHEET, header=["user_id", "since"])
+
+def get_tide_subscribers():
+    rows = with_priority(tide_subscribers_sheet, PRIORITY_BACKGROUND).get_all_values()
+    if len(rows) < 2:
+        return []
+    user_id_col = rows[0].index("user_id")
+    return [row[user_id_col] for row in rows[1:] if len(row) > user_id_col and row[user_id_col]]
+
+def set_tide_subscription(user_id, subscribe):
+    found = find_rows(tide_subscribers_sheet, user_id)
+    if found:
+        if subscribe:
+            return False
+        tide_subscribers_sheet.delete_rows(found[0][0])
+        return True
+    if not subscribe:
+        return False
+    tide_subscribers_sheet.append_row([user_id, today_jst_ymd()])
+    return True
+
+# 毎朝この時刻（JST）に潮位を配信する
+TIDE_PUSH_HOUR = int(os.environ.get("TIDE_PUSH_HOUR", "5"))
+
+@tenant_local
+def tide_scheduler():
+    return TideScheduler(
+        get_tide_subscribers,
+        multicast=lambda to, text: line_bot_api.multicast(to, TextSendMessage(text=text)),
+        hour=TIDE_PUSH_HOUR,
+        marker_dir=current_tenant().state_dir,
+    )
+
+# init_worker を実行したプロセス（ワーカー）の pid。preload 時のマスターでは None のまま
+_worker_pid = None
+
+def init_worker():
+    """
+    Per-process start-up: background threads and fresh HTTP connections.
+    Runs at import time, or from gunicorn's post_fork hook when the app is
+    preloaded in the master (see gunicorn.conf.py), since threads and
+    sockets must not be shared across fork.
+    """
+    global _worker_pid
+    _worker_pid = os.getpid()
+    for tenant in registry:
+        with tenant.activate():
+            storage.reset_connections()
+            if os.environ.get("TIDE_PUSH_ENABLED", "1") == "1":
+                tide_scheduler.start()
+            warm_start.start()
+            # 前回の終了時に書けずに残った追記を引き継ぐ
+            append_queue.load()
+
+def flush_sessions():
+    """Writes pending logins of every tenant to the sheet."""
+    for tenant in registry:
+        with tenant.activate():
+            session_store.flush()
+
+def shutdown_worker():
+    """
+    Writes pending logins and queued appends (saving the appends it cannot
+    write for the next start) and the warm-start files; called at exit and
+    from gunicorn's worker_exit hook.
+    Does nothing outside workers: under preload the master exits last, and
+    its preload-time caches would overwrite the workers' fresher files.
+    """
+    if _worker_pid != os.getpid():
+        return
+    for tenant in registry:
+        with tenant.activate():
+            try:
+                session_store.flush()
+                if append_queue.pending_count():
+                    append_queue.drain()
+                    append_queue.save()
+                warm_start.save()
+            except Exception:
+                traceback.print_exc()
+
+# 同時に来たメッセージのシート読み込みは1回にまとめる
+snapshot_flight = tenant_local(SingleFlight)
+# シートが読めないときは前回読めた内容（古い値）で応答を続ける
+last_good = tenant_local(LastGood)
+# 共有スナップショットをシートから読み直す間隔（書き込み時はその場で捨てる）
+SNAPSHOT_MAX_AGE = float(os.environ.get("SHARED_SNAPSHOT_MAX_AGE", "60"))
+
+def _load_snapshot(name, table):
+    return snapshot_flight.do(name, last_good.load, name, snapshots.get, name, table.get_all_values, SNAPSHOT_MAX_AGE)
+
+def _revalidate_snapshot(name, table):
+    # 応答側の読み込み（_load_snapshot）を待たせないよう別のキーで読み直す
+    return snapshot_flight.do(("revalidate", name), last_good.load, name, snapshots.revalidate, name, table.get_all_values, SNAPSHOT_MAX_AGE)
+
+def snapshot_is_stale(name):
+    """True while `name` may be older than the sheet (read failures, or restored at start-up)."""
+    return last_good.is_stale(name) or snapshots.is_seeded(name)
+
+def load_users_snapshot():
+    return _load_snapshot("users", worksheet)
+
+def load_suspend_snapshot():
+    return _load_snapshot("suspend", suspend_sheet)
+
+def load_admin_request_ban_snapshot():
+    return _load_snapshot("admin_request_ban", admin_request_ban_sheet)
+
+# 前回の終了時に保存したキャッシュから始め、シートはバックグラウンドで読み直す
+@tenant_local
+def warm_start():
+    tenant = current_tenant()
+    path = WARM_START_PATH
+    if path and tenant.state_dir:
+        path = os.path.join(tenant.state_dir, os.path.basename(path))
+    warm = WarmStart(path)
+    for name, table in (("users", worksheet), ("suspend", suspend_sheet), ("admin_request_ban", admin_request_ban_sheet)):
+        warm.register(
+            name,
+            dump=lambda name=name: snapshots.peek(name) or last_good.get(name),
+            restore=lambda data, name=name: snapshots.seed(name, data),
+            revalidate=lambda name=name, table=table: _revalidate_snapshot(name, table),
+        )
+    # IDT 索引は保存時点より後の追記分だけを読む
+    warm.register("idt_index", dump=idt_index.dump, restore=idt_index.restore, revalidate=idt_index.sync)
+    # 潮位表は年ごとに確定しているので読み直さない
+    warm.register("tide", dump=dump_tide_tables, restore=restore_tide_tables)
+    return warm
+
+for _tenant in registry:
+    with _tenant.activate():
+        warm_start.load()
+        if os.environ.get("DEFER_WORKER_INIT") == "1":
+            # preload 時はマスターで一度読んでおき、fork したワーカーは読み込み済みの内容から始める
+            # （保存ファイルから読み込めたものはシートを読まない）
+            for _load in (load_users_snapshot, load_suspend_snapshot, load_admin_request_ban_snapshot):
+                try:
+                    _load()
+                except Exception as e:
+                    print(f"Snapshot warm-up failed ({_tenant.id}): {e}")
+atexit.register(shutdown_worker)
+
+if os.environ.get("DEFER_WORKER_INIT") != "1":
+    init_worker()
+
+# 会話の途中状態（テナントごと）
+user_states = tenant_local(dict)
+otp_store = tenant_local(dict)
+idt_memory = tenant_local(dict)
+admin_request_store = tenant_local(dict)
+
+def append_reply(status, written, what):
+    """Reply for an append through append_queue: `written` once saved, otherwise a notice about `what`."""
+    if status == QUEUED:
+        return f"{what}は保存待ちです。シートに接続できないため、復旧したら自動で追加します。"
+    if status == UNCERTAIN:
+        return f"{what}を保存できたか確認できませんでした。しばらくしてから記録を確認し、無い場合はもう一度入力してください。"
+    return written
 
 def today_jst_ymd():
     jst = pytz.timezone('Asia/Tokyo')
@@ -210,68 +340,85 @@ def generate_otp():
 def now_str():
     return datetime.datetime.now(pytz.timezone('Asia/Tokyo')).strftime("%Y/%m/%d %H:%M:%S")
 
-def parse_idt_input(text):
-    match = re.match(
-        r"^(\d{1,2}:[0-5]?\d(?:\.\d)?)\s+(\d{1,3}\.\d)\s+([mwMW])$",
-        text.strip(), re.I)
-    if not match:
-        return None
-    time_str, weight_str, gender_str = match.groups()
-    return time_str, float(weight_str), gender_str.lower()
-
-def parse_time_str(time_str):
-    match = re.match(r"^(\d{1,2}):([0-5]?\d)(?:\.(\d))?$", time_str)
-    if not match:
-        return None
-    min_str, sec_str, secd_str = match.groups()
-    mi = int(min_str)
-    se = int(sec_str)
-    sed = int(secd_str) if secd_str else 0
-    return mi, se, sed
-
-def calc_idt(mi, se, sed, wei, gend):
-    ergo = mi * 60.0 + se + sed * 0.1
-    idtm = ((101.0 - wei) * (20.9 / 23.0) + 333.07) / ergo * 100.0
-    idtw = ((100.0 - wei) * (1.40) + 357.80) / ergo * 100.0
-    score = idtm * (1.0 - gend) + idtw * gend
-    return score
-
 ### 変更点 ###
 # ヘルパー関数がシートデータ(all_users_data)を引数で受け取るように修正
+# 列指向の UsersTable への変換はスナップショットごとに一度だけ行われる
+def users_table(all_users_data):
+    return table_for(all_users_data, UsersTable)
+
 def get_user_row(user_id, all_users_data):
     if not all_users_data or len(all_users_data) < 2:
         return None, None, None
-    header = [h.strip() for h in all_users_data[0]]
-    user_id_col = header.index("user_id")
-    for row in all_users_data[1:]:
-        if len(row) > user_id_col and row[user_id_col] == user_id:
-            return header, row, all_users_data.index(row)
-    return header, None, -1
+    users = users_table(all_users_data)
+    pos = users.find_user(user_id)
+    if pos is None:
+        return users.header, None, -1
+    # 戻り値の index はヘッダー行を0とした位置（gspreadの行番号 - 1）
+    return users.header, users.row(pos), pos + 1
 
 def get_user_name_grade(user_id, all_users_data):
-    header, user_row, _ = get_user_row(user_id, all_users_data)
-    if user_row:
-        name_col = header.index("name")
-        grade_col = header.index("grade")
-        return user_row[name_col], user_row[grade_col]
+    users = users_table(all_users_data)
+    pos = users.find_user(user_id) if users else None
+    if pos is not None:
+        return users.get(pos, "name"), users.get(pos, "grade")
     return None, None
 
 def get_last_auth(user_id, all_users_data):
-    header, user_row, _ = get_user_row(user_id, all_users_data)
-    if user_row:
-        last_auth_col = header.index("last_auth")
-        if len(user_row) > last_auth_col:
-            value = user_row[last_auth_col]
-            return value if value != "" else None
+    value = session_store.get(user_id)
+    if value is not None:
+        return value
+    users = users_table(all_users_data)
+    pos = users.find_user(user_id) if users else None
+    if pos is not None:
+        value = users.get(pos, "last_auth")
+        return value if value != "" else None
     return None
 
 def set_last_auth(user_id, dt=None):
-    users = worksheet.get_all_values()
-    header, user_row, row_index = get_user_row(user_id, users)
-    if user_row:
-        last_auth_col = header.index("last_auth")
-        # gspreadの行インデックスは1から始まるので+1する
-        worksheet.update_cell(row_index + 1, last_auth_col + 1, dt if dt else now_str())
+    # 返信を待たせないよう、シートへの書き込みは session_store がまとめて行う
+    session_store.set(user_id, dt if dt else now_str())
+
+def persist_last_auth(updates):
+    # 行番号を指定して書くので、スナップショットではなくシートを直接読む（他のワーカーが行を消していることがある）
+    users = users_table(with_priority(worksheet, PRIORITY_BACKGROUND).get_all_values())
+    if not users:
+        return
+    last_auth_col = users.col["last_auth"]
+    data = []
+    for pos, uid in enumerate(users.column("user_id")):
+        if uid in updates:
+            data.append({
+                "range": rowcol_to_a1(users.sheet_row(pos), last_auth_col + 1),
+                "values": [[updates[uid]]],
+            })
+    if data:
+        with_priority(worksheet, PRIORITY_BACKGROUND).batch_update(data, value_input_option="USER_ENTERED")
+
+@tenant_local
+def session_store():
+    return SessionStore(persist_last_auth)
+
+MUTATION_RETRIES = 3
+
+def mutate_users(build):
+    """
+    Runs build(users_table, mutation) against a fresh users snapshot and
+    applies the resulting row changes as one write. If the sheet changed in
+    the meantime the snapshot is re-read and build is run again.
+    Returns build's return value.
+    """
+    for attempt in range(MUTATION_RETRIES):
+        snapshot = worksheet.get_all_values()
+        mutation = RowMutation(snapshot, "user_id")
+        result = build(users_table(snapshot), mutation)
+        if mutation.empty:
+            return result
+        try:
+            apply_mutation(worksheet, mutation)
+            return result
+        except ConflictError:
+            print(f"users sheet changed during mutation (attempt {attempt + 1})")
+    raise ConflictError("users sheet kept changing; giving up")
 
 def ensure_header():
     header = worksheet.row_values(1)
@@ -285,111 +432,225 @@ def ensure_header():
 def get_admin_number_to_userid(all_users_data):
     if not all_users_data or len(all_users_data) < 2:
         return {}
-    header = all_users_data[0]
-    user_id_col = header.index("user_id")
-    admin_col = header.index("admin")
-    number_to_userid = {}
-    for row in all_users_data[1:]:
-        if len(row) > admin_col and row[admin_col].isdigit():
-            number_to_userid[int(row[admin_col])] = row[user_id_col]
-    return number_to_userid
-
-def get_next_admin_number(all_users_data):
-    if not all_users_data or len(all_users_data) < 2:
+    users = users_table(all_users_data)
+    user_ids = users.column("user_id")
+    return {num: user_ids[pos] for pos, num in enumerate(users.admin_numbers) if num is not None}
+
+def get_next_admin_number(users):
+    if not users:
         return 1
-    header = all_users_data[0]
-    admin_col = header.index("admin")
-    nums = {int(row[admin_col]) for row in all_users_data[1:] if len(row) > admin_col and row[admin_col].isdigit()}
+    nums = {num for num in users.admin_numbers if num is not None}
     n = 1
     while n in nums:
         n += 1
     return n
 
 def is_admin(user_id, all_users_data):
-    header, user_row, _ = get_user_row(user_id, all_users_data)
-    if user_row:
-        admin_col = header.index("admin")
-        if len(user_row) > admin_col and user_row[admin_col].isdigit():
-            return True
-    return False
+    users = users_table(all_users_data)
+    return bool(users) and users.admin_number(users.find_user(user_id)) is not None
 
 def is_head_admin(user_id, all_users_data):
-    header, user_row, _ = get_user_row(user_id, all_users_data)
-    if user_row:
-        admin_col = header.index("admin")
-        if len(user_row) > admin_col and user_row[admin_col] == "1":
-            return True
-    return False
-
-def get_help_message(user_id, all_users_data):
-    if is_head_admin(user_id, all_users_data):
-        return (
-            "あなたは1番管理者です。\n"
-            "“add idt”で任意の選手のIDT記録を管理者として追加できます。\n"
-            "入力形式: 名前 学年 タイム 性別(m/w) 体重\n"
-            "例: 太郎 2 7:32.8 m 58.6\n"
-            "“admin approve <名前>”で管理者昇格承認（1番管理者のみ）\n"
-            "“stop responding to <ユーザ名> for <時間> time because you did <理由>”で一時停止（1番管理者のみ）"
-        )
-    elif is_admin(user_id, all_users_data):
-        return (
-            "あなたは管理者（マネージャー）アカウントです。\n"
-            "“cal idt”でIDTの計算ができます\n"
-            "“add idt”で任意の選手のIDT記録を管理者として追加できます。\n"
-            "入力形式: 名前 学年 タイム 性別(m/w) 体重\n"
-            "例: 太郎 2 7:32.8 m 56.4\n"
-        )
-    else:
-        return (
-            "“login”でログインができます(記録の記入時に必須)\n"
-            "“logout”でログアウトができます\n"
-            "“cal idt”でIDTの計算ができます(ログイン不要)\n"
-            "“add idt”で自分のIDT記録を入力できます(ログイン必須)。例: 7:32.8 53.6\n"
-            "“admin request”で管理者申請\n"
-        )
+    users = users_table(all_users_data)
+    return bool(users) and users.admin_number(users.find_user(user_id)) == 1
+
+RECORD_ERROR_MESSAGES = {
+    ERR_TIME: "タイム形式が正しくありません。例: 7:32.8",
+    ERR_WEIGHT: "体重は数値で入力してください。",
+    ERR_GENDER: "性別は m か w で入力してください。",
+    ERR_GRADE: "学年は半角数字で入力してください。",
+}
+PROFILE_GENDER_ERROR_MESSAGE = "ユーザー情報の性別が正しく登録されていません。管理者に連絡してください。"
+
+def record_error_message(error, format_message):
+    if error == ERR_FORMAT:
+        return format_message
+    return RECORD_ERROR_MESSAGES[error]
 
 def check_suspend(user_id):
-    rows = suspend_sheet.get_all_values()
-    if not rows or len(rows) < 2:
+    try:
+        suspends = table_for(load_suspend_snapshot(), SuspendTable)
+    except Exception:
+        # 停止リストが読めないときは停止なしとして応答を続ける
+        traceback.print_exc()
+        return False, None, None, None
+    if not suspends:
         return False, None, None, None
-    header = rows[0]
-    if "user_id" not in header or "until" not in header or "reason" not in header:
+    if not (suspends.has("user_id") and suspends.has("until") and suspends.has("reason")):
         return False, None, None, None
-    user_id_col = header.index("user_id")
-    until_col = header.index("until")
-    reason_col = header.index("reason")
     now = jst_now()
-    for i, row in enumerate(rows[1:], start=2):
-        if row[user_id_col] == user_id:
-            try:
-                until_time = datetime.datetime.strptime(row[until_col], "%Y/%m/%d %H:%M").replace(tzinfo=pytz.timezone('Asia/Tokyo'))
-            except Exception:
-                continue
-            if now < until_time:
-                return (True, (until_time - now), row[reason_col], i)
-            else:
+    for pos in suspends.find_all(user_id=user_id):
+        until_time = suspends.until[pos]
+        if until_time is None:
+            continue
+        i = suspends.sheet_row(pos)
+        if now < until_time:
+            return (True, (until_time - now), suspends.get(pos, "reason"), i)
+        else:
+            # 古いスナップショットの行番号では消さない（別の行を消してしまう）
+            if not snapshot_is_stale("suspend"):
                 suspend_sheet.delete_rows(i)
-                return (False, None, None, None)
+            return (False, None, None, None)
     return (False, None, None, None)
 
 @app.route("/callback", methods=["POST"])
-def callback():
+@app.route("/callback/<tenant_id>", methods=["POST"])
+def callback(tenant_id=None):
     signature = request.headers["X-Line-Signature"]
     body = request.get_data(as_text=True)
+    tenant = registry.for_webhook(body, signature, tenant_id)
+    if tenant is None:
+        abort(404)
+    with tenant.activate():
+        if webhook_capture.enabled() and handler.parser.signature_validator.validate(body, signature):
+            webhook_capture.capture(body)
+        try:
+            handler.handle(body, signature)
+        except InvalidSignatureError:
+            abort(400)
+    return "OK"
+
+def tenant_from_args():
+    """The tenant named by the `tenant` query parameter (optional with a single tenant); aborts with 404 otherwise."""
+    tenant_id = request.args.get("tenant")
+    if tenant_id is None and len(registry) == 1:
+        return registry.tenants[0]
+    tenant = registry.get(tenant_id)
+    if tenant is None:
+        abort(404)
+    return tenant
+
+# プロファイル取得用エンドポイント（PROFILE_TOKEN を設定したときだけ有効、運用者用）
+# 複数のクラブを受け持つときは ?tenant=<id> でクラブを選ぶ
+PROFILE_TOKEN = os.environ.get("PROFILE_TOKEN")
+
+def profile_dir():
+    """Where the current tenant's profiling settings and results live (one club cannot toggle another's)."""
+    partition = current_tenant().partition
+    return os.path.join(profiler.PROFILE_DIR, partition) if partition else profiler.PROFILE_DIR
+
+def require_bearer(expected):
+    """Aborts unless the endpoint is enabled (`expected` set) and the request carries it as a bearer token."""
+    if not expected:
+        abort(404)
+    auth = request.headers.get("Authorization", "")
+    token = auth[len("Bearer "):] if auth.startswith("Bearer ") else ""
+    if not hmac.compare_digest(token.encode(), expected.encode()):
+        abort(403)
+
+@app.route("/debug/profile", methods=["GET"])
+def debug_profile():
+    require_bearer(PROFILE_TOKEN)
+    with tenant_from_args().activate():
+        profiles = profiler.load_all(profile_dir())
+    if request.args.get("format") == "json":
+        return Response(json.dumps(profiler.summary(profiles), ensure_ascii=False), mimetype="application/json")
+    # flamegraph.pl / speedscope にそのまま渡せる collapsed 形式
+    return Response(profiler.collapsed(profiles, request.args.get("flow")), mimetype="text/plain")
+
+# 流量制限・重複排除・クォータなどの counters（PROFILE_TOKEN で保護。クラブごとの値は &tenant=<id> のクラブ）
+@app.route("/debug/stats", methods=["GET"])
+def debug_stats():
+    require_bearer(PROFILE_TOKEN)
+    with tenant_from_args().activate():
+        stats = {
+            "rate_limit": rate_limit.stats(),
+            "event_dedup": dict(event_dedup.counters),
+            "sheets_quota": get_scheduler().stats(),
+            "circuit_breakers": breaker_stats(),
+            "write_queue": dict(append_queue.counters, pending=append_queue.pending_count()),
+            "snapshots": dict(snapshots.counters),
+            "idt_index": dict(idt_index.counters),
+            "warm_start": dict(warm_start.counters),
+        }
+    # ASGI で動かしているときは webhook の受け付け状況も出す
+    asgi = sys.modules.get("asgi")
+    if asgi is not None:
+        stats["asgi"] = dict(asgi.counters)
+    return Response(json.dumps(stats, ensure_ascii=False), mimetype="application/json")
+
+# 記録の書き出し用エンドポイント（クラブの export_token、1クラブのときは EXPORT_TOKEN を設定したときだけ有効）
+#   GET /export?dataset=idt|admin&format=csv|ndjson&from=2024-04-01&to=2025-03-31&grade=2&gender=m
+#   複数のクラブを受け持つときは &tenant=<id> でクラブを選ぶ（トークンはそのクラブのもの）
+@app.route("/export", methods=["GET"])
+def export_records():
+    tenant = tenant_from_args()
+    require_bearer(tenant.export_token)
+    dataset = request.args.get("dataset", "idt")
+    fmt = request.args.get("format", "csv")
+    if dataset not in ("idt", "admin") or fmt not in export.FORMATS:
+        abort(400)
     try:
-        handler.handle(body, signature)
-    except InvalidSignatureError:
+        filters = export.Filters.from_args(request.args)
+    except ValueError:
         abort(400)
-    return "OK"
+    with tenant.activate():
+        if dataset == "admin":
+            # 管理者記録には学年の列がない
+            if not storage.has_admin_records:
+                abort(404)
+            if filters.grade is not None:
+                abort(400)
+            fields = export.ADMIN_FIELDS
+            records = export.admin_records(with_priority(admin_record_sheet, PRIORITY_BACKGROUND), filters)
+        else:
+            # 書き出しを始める前に索引を最新にする（失敗したらエラーで返す）
+            idt_index.ensure_fresh()
+            fields = export.IDT_FIELDS
+            records = export.idt_records(idt_index, filters)
+    content_type, extension = export.FORMATS[fmt]
+    # 本文はこの関数を抜けてから生成されるので、生成中もテナントを切り替えておく
+    return Response(
+        stream_with_context(tenant.iterate(export.serialize(fmt, fields, records))),
+        content_type=content_type,
+        headers={"Content-Disposition": f'attachment; filename="{dataset}_records.{extension}"'},
+    )
+
+def profile_flow(event):
+    return profiler.flow_for(event.message.text, user_states.get(event.source.user_id, {}).get("mode"))
 
 @handler.add(MessageEvent, message=TextMessage)
 def handle_message(event):
+    # 再送イベントは処理済み（または処理中）なら何もしない
+    if not event_dedup.first_delivery(event):
+        return
+    # 書き込みの前に失敗したイベントは、再送されたときにもう一度処理する
+    with event_dedup.handling(event):
+        # 1番管理者が有効にしたときだけ、一部のイベントの処理をサンプリングする
+        with profiler.sample(lambda: profile_flow(event), profile_dir()):
+            _handle_message(event)
+
+def _handle_message(event):
     user_id = event.source.user_id
     text = event.message.text.strip()
 
+    # 0. 流量制限（シートへのアクセス前にメモリ上で判定）
+    command_class = rate_limit.classify(text, user_states.get(user_id, {}).get("mode"))
+    allowed, strikes = rate_limit.check(user_id, command_class)
+    if not allowed:
+        if rate_limit.should_escalate(strikes):
+            until = (jst_now() + datetime.timedelta(minutes=rate_limit.SUSPEND_MINUTES)).strftime("%Y/%m/%d %H:%M")
+            try:
+                suspend_sheet.append_row([user_id, until, "短時間での大量送信"])
+                rate_limit.record_escalation(user_id)
+            except Exception:
+                traceback.print_exc()
+        if strikes == 1:
+            line_bot_api.reply_message(
+                event.reply_token,
+                TextSendMessage(text="送信間隔が短すぎます。しばらく待ってから再度送信してください。")
+            )
+        return
+
     ### 変更点 ###
     # handle_messageの冒頭で一度だけシートから全データを取得
-    all_users_data = worksheet.get_all_values()
+    try:
+        all_users_data = load_users_snapshot()
+    except Exception:
+        # 起動直後で前回の値もない場合
+        traceback.print_exc()
+        line_bot_api.reply_message(event.reply_token, TextSendMessage(text="現在データベースに接続できません。しばらくしてから再度お試しください。"))
+        return
+    users = users_table(all_users_data)
     header, user_row, user_row_index = get_user_row(user_id, all_users_data)
 
 
@@ -438,49 +699,25 @@ def handle_message(event):
                 TextSendMessage(text="IDT計算モードを終了しました。")
             )
             return
-        parts = text.strip().split()
-        if len(parts) != 2:
-            line_bot_api.reply_message(
-                event.reply_token,
-                TextSendMessage(text="形式が正しくありません。\nタイム 体重 の順でスペース区切りで入力してください。\n例: 7:32.8 56.3\n終了する場合は end と入力してください。")
-            )
-            return
-        time_str, weight = parts
-        t = parse_time_str(time_str)
-        if not t:
-            line_bot_api.reply_message(
-                event.reply_token,
-                TextSendMessage(text="タイム形式が正しくありません。例: 7:32.8")
-            )
-            return
-        try:
-            weight = float(weight)
-        except Exception:
-            line_bot_api.reply_message(
-                event.reply_token,
-                TextSendMessage(text="体重は数値で入力してください。")
-            )
-            return
-        
         gender = None
         if user_row and "gender" in header:
-            gender_col = header.index("gender")
-            gender = user_row[gender_col]
+            gender = user_row[header.index("gender")]
 
-        if gender is None or gender.lower() not in ("m", "w"):
+        record, error = parse_record(text, FIELDS_TIME_WEIGHT, gender=gender)
+        if error:
+            if error == ERR_GENDER:
+                msg = PROFILE_GENDER_ERROR_MESSAGE
+            else:
+                msg = record_error_message(error, "形式が正しくありません。\nタイム 体重 の順でスペース区切りで入力してください。\n例: 7:32.8 56.3\n終了する場合は end と入力してください。")
             line_bot_api.reply_message(
                 event.reply_token,
-                TextSendMessage(text="ユーザー情報の性別が正しく登録されていません。管理者に連絡してください。")
+                TextSendMessage(text=msg)
             )
             return
-        gend = 0.0 if gender.lower() == "m" else 1.0
-        mi, se, sed = t
-        score = calc_idt(mi, se, sed, weight, gend)
-        score_disp = round(score + 1e-8, 2)
         line_bot_api.reply_message(
             event.reply_token,
             TextSendMessage(
-                text=f"IDT計算結果: {score_disp:.2f}%"
+                text=f"IDT計算結果: {record.score:.2f}%"
             )
         )
         return
@@ -494,104 +731,53 @@ def handle_message(event):
                 TextSendMessage(text="IDT計算モードを終了しました。")
             )
             return
-        parts = text.strip().split()
-        if len(parts) != 3:
+        record, error = parse_record(text, FIELDS_TIME_WEIGHT_GENDER)
+        if error:
             line_bot_api.reply_message(
                 event.reply_token,
-                TextSendMessage(text="形式が正しくありません。\nタイム 体重 性別(m/w) の順でスペース区切りで入力してください。\n例: 7:32.8 56.3 m\n終了する場合は end と入力してください。")
+                TextSendMessage(text=record_error_message(error, "形式が正しくありません。\nタイム 体重 性別(m/w) の順でスペース区切りで入力してください。\n例: 7:32.8 56.3 m\n終了する場合は end と入力してください。"))
             )
             return
-        time_str, weight, gender = parts
-        t = parse_time_str(time_str)
-        if not t:
-            line_bot_api.reply_message(
-                event.reply_token,
-                TextSendMessage(text="タイム形式が正しくありません。例: 7:32.8")
-            )
-            return
-        try:
-            weight = float(weight)
-        except Exception:
-            line_bot_api.reply_message(
-                event.reply_token,
-                TextSendMessage(text="体重は数値で入力してください。")
-            )
-            return
-        if gender.lower() not in ("m", "w"):
-            line_bot_api.reply_message(
-                event.reply_token,
-                TextSendMessage(text="性別は m か w で入力してください。")
-            )
-            return
-        gend = 0.0 if gender.lower() == "m" else 1.0
-        mi, se, sed = t
-        score = calc_idt(mi, se, sed, weight, gend)
-        score_disp = round(score + 1e-8, 2)
         line_bot_api.reply_message(
             event.reply_token,
             TextSendMessage(
-                text=f"IDT計算結果: {score_disp:.2f}%"
+                text=f"IDT計算結果: {record.score:.2f}%"
             )
         )
         return
 
 # helpコマンド
     if text.lower() == "help":
-        msg = get_help_message(user_id, all_users_data)
         line_bot_api.reply_message(
             event.reply_token,
-            TextSendMessage(text=msg)
+            help_message(get_role(header, user_row))
         )
         return         
 
 # readme / r コマンド
     if text.lower() in ["readme", "r"]:
-        flex_msg = FlexSendMessage(
-            alt_text="Botの使い方はこちら",
-            contents={
-                "type": "bubble",
-                "body": {
-                    "type": "box",
-                    "layout": "vertical",
-                    "contents": [
-                        {
-                            "type": "text",
-                            "text": "📘 Botの使い方",
-                            "weight": "bold",
-                            "size": "lg"
-                        },
-                        {
-                            "type": "text",
-                            "text": "以下のリンクから詳細なREADMEが見られます。(外部サイトに遷移します。)",
-                            "size": "sm",
-                            "wrap": True
-                        }
-                    ]
-                },
-                "footer": {
-                    "type": "box",
-                    "layout": "vertical",
-                    "spacing": "sm",
-                    "contents": [
-                        {
-                            "type": "button",
-                            "style": "primary",
-                            "action": {
-                                "type": "uri",
-                                "label": "READMEを見る",
-                                "uri": "https://direct-preview-68679e75e78885be252c2c24.monaca.education"
-                            }
-                        }
-                    ]
-                }
-            }
-        )
         line_bot_api.reply_message(
             event.reply_token,
-            messages=[flex_msg]
+            messages=[readme_message()]
         )
         return
 
+    # 毎朝の潮位配信の登録・解除
+    if text.lower() in ("tide subscribe", "tide unsubscribe"):
+        subscribe = text.lower() == "tide subscribe"
+        try:
+            changed = set_tide_subscription(user_id, subscribe)
+        except Exception:
+            traceback.print_exc()
+            line_bot_api.reply_message(event.reply_token, TextSendMessage(text="登録処理中にエラーが発生しました。時間をおいて再試行してください。"))
+            return
+        if subscribe:
+            reply_text = f"毎朝{TIDE_PUSH_HOUR}時に高知港の潮位をお送りします。" if changed else "既に潮位配信に登録されています。"
+        else:
+            reply_text = "潮位配信を解除しました。" if changed else "潮位配信には登録されていません。"
+        line_bot_api.reply_message(event.reply_token, TextSendMessage(text=reply_text))
+        return
+
     # tideコマンド
     if text.lower() == "tide":
         user_states[user_id] = {"mode": "awaiting_tide_datetime"}
@@ -626,11 +812,12 @@ def handle_message(event):
 
         current_year = datetime.datetime.now().year
         
-        pdf_filepath = None
         try:
-            pdf_filepath = download_tide_pdf(current_year)
-            if pdf_filepath:
-                tide_value = extract_tide_from_pdf(pdf_filepath, month, day, hour)
+            # 潮位表は年ごとに一度だけ取得・解析してキャッシュされる
+            table = load_tide_table(current_year)
+            if table is not None:
+                hours = table.get((month, day))
+                tide_value = hours[hour] if hours and hour < len(hours) else None
                 if tide_value is not None:
                     reply_text = f"高知港の{current_year}年{month}月{day}日 {hour}時の潮位は、約 {tide_value} cmです。"
                 else:
@@ -641,10 +828,6 @@ def handle_message(event):
         except Exception as e:
             print(f"ERROR: Unhandled error in tide processing: {e}\n{traceback.format_exc()}")
             reply_text = "潮位の取得中に予期せぬエラーが発生しました。管理者に連絡してください。"
-        
-        finally:
-            if pdf_filepath and os.path.exists(pdf_filepath):
-                os.remove(pdf_filepath)
 
         line_bot_api.reply_message(event.reply_token, TextSendMessage(text=reply_text))
         user_states.pop(user_id, None) # Clear state after attempt
@@ -728,17 +911,13 @@ def handle_message(event):
             )
             return
         
-        name_col = header.index("name")
-        grade_col = header.index("grade")
-
         # 重複チェック (キャッシュされたデータを使用)
-        for row in all_users_data[1:]:
-            if row[name_col] == name and row[grade_col] == grade:
-                line_bot_api.reply_message(
-                    event.reply_token,
-                    TextSendMessage(text="既に同じ名前と学年のユーザーが登録されています。管理者に相談してください。")
-                )
-                return
+        if users and any(users.find_all(name=name, grade=grade)):
+            line_bot_api.reply_message(
+                event.reply_token,
+                TextSendMessage(text="既に同じ名前と学年のユーザーが登録されています。管理者に相談してください。")
+            )
+            return
 
         # カラム順に合わせて辞書からリストを生成
         row_dict = {
@@ -811,21 +990,10 @@ def handle_message(event):
             return
         grade, name, key = parts
         
-        name_col = header.index("name")
-        grade_col = header.index("grade")
-        key_col = header.index("key")
-        user_id_col = header.index("user_id")
-        found_target_row = None
-        target_row_gspread_index = -1
-        
-        for i, row in enumerate(all_users_data[1:], start=2):
-            if row[name_col] == name and row[grade_col] == grade and row[key_col] == key:
-                found_target_row = row
-                target_row_gspread_index = i
-                break
-
-        if found_target_row:
-            target_user_id = found_target_row[user_id_col]
+        target_pos = next(users.find_all(name=name, grade=grade, key=key), None)
+
+        if target_pos is not None:
+            target_user_id = users.get(target_pos, "user_id")
             if target_user_id == user_id:
                 set_last_auth(user_id, now_str())
                 user_states.pop(user_id)
@@ -837,7 +1005,6 @@ def handle_message(event):
               
             user_states[user_id] = {
                 'mode': 'login_switch_confirm',
-                'target_row': target_row_gspread_index,
                 'target_user_id': target_user_id,
                 'name': name,
                 'grade': grade,
@@ -976,21 +1143,35 @@ def handle_message(event):
                 line_bot_api.reply_message(event.reply_token, TextSendMessage(text="操作開始から30分経過したため、やり直してください。"))
                 return
 
-            # Note: worksheet.delete_rows() can be slow and might fail.
-            # A safer approach is to clear the row and mark as deleted. For now, we stick to the original logic.
-            # 元のuser_idを持つ行を見つけて削除
-            users_data_for_delete = worksheet.get_all_values() # 最新のデータを取得
-            user_id_col = users_data_for_delete[0].index("user_id")
-            for i, row in enumerate(users_data_for_delete[1:], start=2):
-                if row[user_id_col] == state['target_user_id']:
-                    worksheet.delete_rows(i)
-                    break
-            
-            worksheet.update_cell(state['target_row'], user_id_col + 1, user_id)
-            set_last_auth(user_id, now_str())
+            # 対象アカウントをこの端末に付け替え、この端末の古い行は削除する
+            # 行番号は同じスナップショットから計算し、1回の書き込みでまとめて反映する
+            def build_switch(users, mutation):
+                target_pos = next(users.find_all(user_id=state['target_user_id'], name=state['name'], grade=state['grade']), None)
+                if target_pos is None:
+                    return False
+                target_row = users.sheet_row(target_pos)
+                mutation.set_cell(target_row, users.col["user_id"] + 1, user_id)
+                mutation.set_cell(target_row, users.col["last_auth"] + 1, now_str())
+                for pos in users.find_all(user_id=user_id):
+                    if pos != target_pos:
+                        mutation.delete_row(users.sheet_row(pos))
+                return True
+
+            try:
+                switched = mutate_users(build_switch)
+            except Exception:
+                traceback.print_exc()
+                user_states.pop(user_id)
+                line_bot_api.reply_message(event.reply_token, TextSendMessage(text="アカウントの切り替えに失敗しました。最初からやり直してください。"))
+                return
+            session_store.forget(state['target_user_id'])
+            session_store.forget(user_id)
             otp_store.pop(state['target_user_id'], None)
             user_states.pop(user_id)
-            line_bot_api.reply_message(event.reply_token, TextSendMessage(text="アカウントの切り替えが完了しました。"))
+            if switched:
+                line_bot_api.reply_message(event.reply_token, TextSendMessage(text="アカウントの切り替えが完了しました。"))
+            else:
+                line_bot_api.reply_message(event.reply_token, TextSendMessage(text="切り替え先のアカウントが見つかりませんでした。最初からやり直してください。"))
             return
         else:
             user_states.pop(user_id)
@@ -1005,10 +1186,20 @@ def handle_message(event):
 
     if user_id in user_states and user_states[user_id].get("mode") == "delete_account_confirm":
         if text.strip().lower() in ["はい", "yes", "はい。", "yes."]:
-            deleted = False
-            if user_row_index != -1: # user_row_index is from get_user_row, 1-based index
-                worksheet.delete_rows(user_row_index + 1)
-                deleted = True
+            def build_delete(users, mutation):
+                rows = [users.sheet_row(pos) for pos in users.find_all(user_id=user_id)]
+                for row in rows:
+                    mutation.delete_row(row)
+                return bool(rows)
+
+            try:
+                deleted = mutate_users(build_delete)
+            except Exception:
+                traceback.print_exc()
+                user_states.pop(user_id)
+                line_bot_api.reply_message(event.reply_token, TextSendMessage(text="アカウントの削除に失敗しました。時間をおいて再試行してください。"))
+                return
+            session_store.forget(user_id)
             
             user_states.pop(user_id)
             if deleted:
@@ -1047,35 +1238,27 @@ def handle_message(event):
             user_states.pop(user_id)
             line_bot_api.reply_message(event.reply_token, TextSendMessage(text="IDT記録追加モードを終了しました。"))
             return
-        parts = text.split(" ")
-        if len(parts) != 5:
-            line_bot_api.reply_message(event.reply_token, TextSendMessage(text="形式が正しくありません。\n名前 学年 タイム 性別 体重 の順でスペース区切りで入力してください。\n例: 太郎 2 7:32.8 m 56.3\n終了する場合は end と入力してください。"))
-            return
-        name, grade, time_str, gender, weight = parts
-        if gender.lower() not in ("m", "w"):
-            line_bot_api.reply_message(event.reply_token, TextSendMessage(text="性別は m か w で入力してください。"))
-            return
-        t = parse_time_str(time_str)
-        if not t:
-            line_bot_api.reply_message(event.reply_token, TextSendMessage(text="タイム形式が正しくありません。例: 7:32.8"))
+        record, error = parse_record(text, FIELDS_ADMIN_IDT)
+        if error:
+            line_bot_api.reply_message(event.reply_token, TextSendMessage(text=record_error_message(error, "形式が正しくありません。\n名前 学年 タイム 性別 体重 の順でスペース区切りで入力してください。\n例: 太郎 2 7:32.8 m 56.3\n終了する場合は end と入力してください。")))
             return
-        try:
-            weight = float(weight)
-        except Exception:
-            line_bot_api.reply_message(event.reply_token, TextSendMessage(text="体重は数値で入力してください。"))
-            return
-        mi, se, sed = t
-        gend = 0.0 if gender.lower() == "m" else 1.0
-        score = calc_idt(mi, se, sed, weight, gend)
-        score_disp = round(score + 1e-8, 2)
+        name, grade, gender, time_str, weight, score_disp = record.name, record.grade, record.gender, record.time_str, record.weight, record.score
         record_date = today_jst_ymd()
         row = [name, grade, gender, record_date, time_str, weight, score_disp, "1"]
         try:
-            idt_record_sheet.append_row(row, value_input_option="USER_ENTERED")
-            line_bot_api.reply_message(event.reply_token, TextSendMessage(text=f"{name}（学年:{grade}）のIDT記録を追加しました。IDT: {score_disp:.2f}%"))
+            status = idt_record_sheet.append_row(row, value_input_option="USER_ENTERED")
         except Exception as e:
+            user_states.pop(user_id)
             line_bot_api.reply_message(event.reply_token, TextSendMessage(text=f"記録に失敗しました: {e}"))
+            return
+        # 返信に失敗しても同じ記録をもう一度書かないよう、状態は先に戻しておく
         user_states.pop(user_id)
+        if status != UNCERTAIN:
+            idt_index.add(row)
+        report_service.invalidate()
+        line_bot_api.reply_message(event.reply_token, TextSendMessage(text=append_reply(
+            status, f"{name}（学年:{grade}）のIDT記録を追加しました。IDT: {score_disp:.2f}%",
+            f"{name}（学年:{grade}）のIDT記録（IDT: {score_disp:.2f}%）")))
         return
 
     # 一般ユーザによる記録追加
@@ -1084,33 +1267,88 @@ def handle_message(event):
             user_states.pop(user_id)
             line_bot_api.reply_message(event.reply_token, TextSendMessage(text="IDT記録追加モードを終了しました。"))
             return
-        parts = text.split(" ")
-        if len(parts) != 2:
-            line_bot_api.reply_message(event.reply_token, TextSendMessage(text="形式が正しくありません。\nタイム 体重 の順でスペース区切りで入力してください。\n例: 7:32.8 56.3\n終了する場合は end と入力してください。"))
-            return
-        time_str, weight = parts
-        t = parse_time_str(time_str)
-        if not t:
-            line_bot_api.reply_message(event.reply_token, TextSendMessage(text="タイム形式が正しくありません。例: 7:32.8"))
-            return
-        try:
-            weight = float(weight)
-        except Exception:
-            line_bot_api.reply_message(event.reply_token, TextSendMessage(text="体重は数値で入力してください。"))
-            return
-        mi, se, sed = t
         name = user_row[header.index("name")]
         grade = user_row[header.index("grade")]
         gender = user_row[header.index("gender")]
-        
-        gend = 0.0 if gender.lower() == "m" else 1.0
-        score = calc_idt(mi, se, sed, weight, gend)
-        score_disp = round(score + 1e-8, 2)
+        record, error = parse_record(text, FIELDS_TIME_WEIGHT, name=name, grade=grade, gender=gender)
+        if error:
+            if error == ERR_GENDER:
+                msg = PROFILE_GENDER_ERROR_MESSAGE
+            else:
+                msg = record_error_message(error, "形式が正しくありません。\nタイム 体重 の順でスペース区切りで入力してください。\n例: 7:32.8 56.3\n終了する場合は end と入力してください。")
+            line_bot_api.reply_message(event.reply_token, TextSendMessage(text=msg))
+            return
+        time_str, weight, score_disp = record.time_str, record.weight, record.score
         record_date = today_jst_ymd()
         row = [name, grade, gender, record_date, time_str, weight, score_disp, ""]
-        idt_record_sheet.append_row(row, value_input_option="USER_ENTERED")
-        line_bot_api.reply_message(event.reply_token, TextSendMessage(text=f"あなたのIDT記録を{record_date}に追加しました。IDT: {score_disp:.2f}%"))
+        status = idt_record_sheet.append_row(row, value_input_option="USER_ENTERED")
+        # 返信に失敗しても同じ記録をもう一度書かないよう、状態は先に戻しておく
         user_states.pop(user_id)
+        if status != UNCERTAIN:
+            idt_index.add(row)
+        report_service.invalidate()
+        line_bot_api.reply_message(event.reply_token, TextSendMessage(text=append_reply(
+            status, f"あなたのIDT記録を{record_date}に追加しました。IDT: {score_disp:.2f}%",
+            f"あなたの{record_date}のIDT記録（IDT: {score_disp:.2f}%）")))
+        return
+
+    # historyコマンド（自分のIDT記録の推移）
+    if re.match(r"^history(\s+\d+)?$", text, re.I):
+        if not user_row or get_last_auth(user_id, all_users_data) == "LOGGED_OUT":
+            line_bot_api.reply_message(event.reply_token, TextSendMessage(text="記録の閲覧にはログインが必要です。“login”でログインしてください。"))
+            return
+        parts = text.split()
+        limit = min(int(parts[1]), 20) if len(parts) == 2 else 5
+        name = user_row[header.index("name")]
+        grade = user_row[header.index("grade")]
+        try:
+            idt_index.ensure_fresh()
+            summary = summarize_history(idt_index.records_for(name, grade), limit=max(limit, 1))
+        except Exception:
+            traceback.print_exc()
+            line_bot_api.reply_message(event.reply_token, TextSendMessage(text="記録の取得に失敗しました。時間をおいて再試行してください。"))
+            return
+        if summary is None:
+            line_bot_api.reply_message(event.reply_token, TextSendMessage(text="まだIDT記録がありません。“add idt”で記録を追加できます。"))
+        else:
+            line_bot_api.reply_message(event.reply_token, TextSendMessage(text=format_history(summary)))
+        return
+
+    # reportコマンド（チームのIDT集計、管理者のみ）
+    if text.lower() == "report":
+        if not is_admin(user_id, all_users_data):
+            line_bot_api.reply_message(event.reply_token, TextSendMessage(text="管理者権限がありません。"))
+            return
+        cached = report_service.cached_report()
+        if cached:
+            line_bot_api.reply_message(event.reply_token, TextSendMessage(text=cached))
+            return
+        report_service.request(user_id)
+        line_bot_api.reply_message(event.reply_token, TextSendMessage(text="チームIDTレポートを作成しています。完成したらお送りします。"))
+        return
+
+    # profileコマンド（処理時間のサンプリング、1番管理者のみ）
+    if re.match(r"^profile(\s|$)", text, re.I):
+        if not is_head_admin(user_id, all_users_data):
+            line_bot_api.reply_message(event.reply_token, TextSendMessage(text="この操作は1番管理者のみ可能です。"))
+            return
+        parts = text.lower().split()
+        action = parts[1] if len(parts) > 1 else "status"
+        if action == "on":
+            try:
+                rate = float(parts[2]) if len(parts) > 2 else profiler.DEFAULT_RATE
+            except ValueError:
+                line_bot_api.reply_message(event.reply_token, TextSendMessage(text="割合は 0〜1 の数値で指定してください。\n例: profile on 0.2"))
+                return
+            profiler.enable(rate, directory=profile_dir())
+        elif action == "off":
+            profiler.disable(profile_dir())
+        elif action == "reset":
+            profiler.reset(profile_dir())
+        elif action != "status":
+            line_bot_api.reply_message(event.reply_token, TextSendMessage(text="profile on [割合] / profile off / profile status / profile reset"))
+            return
+        line_bot_api.reply_message(event.reply_token, TextSendMessage(text=profiler.format_status(profile_dir())))
         return
 
     # ---------- 管理者申請・承認制度 ----------
@@ -1147,15 +1385,7 @@ def handle_message(event):
             key = user_states[user_id].get("key")
             
             # Use cached data for check
-            name_col = header.index("name")
-            grade_col = header.index("grade")
-            key_col = header.index("key")
-            
-            found = False
-            for row in all_users_data[1:]:
-                if row[name_col] == name and row[grade_col] == grade and row[key_col] == key:
-                    found = True
-                    break
+            found = any(users.find_all(name=name, grade=grade, key=key))
             
             if not found:
                 user_states.pop(user_id)
@@ -1180,23 +1410,24 @@ def handle_message(event):
         target_name = text[len("admin approve "):].strip()
         for request_user_id, req in list(admin_request_store.items()):
             if req["name"] == target_name:
-                # To apply changes, we need to fetch fresh data for this specific operation
-                current_users_data = worksheet.get_all_values()
-                current_header = current_users_data[0]
-                name_col = current_header.index("name")
-                admin_col = current_header.index("admin")
-                
-                for i, row in enumerate(current_users_data[1:], start=2):
-                    if row[name_col] == target_name:
-                        next_num = get_next_admin_number(current_users_data)
-                        worksheet.update_cell(i, admin_col + 1, str(next_num))
-                        line_bot_api.reply_message(event.reply_token, TextSendMessage(text=f"{target_name}を管理者({next_num})に承認しました。"))
-                        line_bot_api.push_message(request_user_id, TextSendMessage(text=("あなたの管理者申請が承認されました。以降、個人のIDT記録など選手向け機能はご利用いただけません。\n")))
-                        admin_request_store.pop(request_user_id)
-                        
-                        # Set ban for other requests from the same user if needed
-                        set_admin_request_ban(request_user_id, days=14)
-                        return # Exit after successful approval
+                # 番号の採番と行番号での書き込みは、スナップショットではなくシートを直接読んで行う（mutate_users）
+                def build_approve(users, mutation):
+                    target_pos = users.find("name", target_name)
+                    if target_pos is None:
+                        return None
+                    next_num = get_next_admin_number(users)
+                    mutation.set_cell(users.sheet_row(target_pos), users.col["admin"] + 1, str(next_num))
+                    return next_num
+
+                next_num = mutate_users(build_approve)
+                if next_num is not None:
+                    line_bot_api.reply_message(event.reply_token, TextSendMessage(text=f"{target_name}を管理者({next_num})に承認しました。"))
+                    line_bot_api.push_message(request_user_id, TextSendMessage(text=("あなたの管理者申請が承認されました。以降、個人のIDT記録など選手向け機能はご利用いただけません。\n")))
+                    admin_request_store.pop(request_user_id)
+                    
+                    # Set ban for other requests from the same user if needed
+                    set_admin_request_ban(request_user_id, days=14)
+                    return # Exit after successful approval
         
         line_bot_api.reply_message(event.reply_token, TextSendMessage(text="該当する申請が見つかりません。"))
         return
@@ -1211,51 +1442,35 @@ def handle_message(event):
         return
 
     if user_id in user_states and user_states[user_id].get('mode') == 'admin_add':
-        if admin_record_sheet is None:
+        if not storage.has_admin_records:
             line_bot_api.reply_message(event.reply_token, TextSendMessage(text="管理者記録用スプレッドシートが設定されていません。"))
             user_states.pop(user_id)
             return
         
-        parts = text.split(" ")
-        if len(parts) != 4:
-            line_bot_api.reply_message(event.reply_token, TextSendMessage(text="形式が正しくありません。\n名前 性別(m/w) タイム 体重 の順でスペース区切りで入力してください。"))
-            return
-        
-        name, gender, time_str, weight = parts
-        if gender.lower() not in ("m", "w"):
-            line_bot_api.reply_message(event.reply_token, TextSendMessage(text="性別は m か w で入力してください。"))
+        record, error = parse_record(text, FIELDS_ADMIN_ADD)
+        if error:
+            line_bot_api.reply_message(event.reply_token, TextSendMessage(text=record_error_message(error, "形式が正しくありません。\n名前 性別(m/w) タイム 体重 の順でスペース区切りで入力してください。")))
             return
-        
-        t = parse_time_str(time_str)
-        if not t:
-            line_bot_api.reply_message(event.reply_token, TextSendMessage(text="タイム形式が正しくありません。例: 7:32.8"))
-            return
-        
-        try:
-            weight = float(weight)
-        except Exception:
-            line_bot_api.reply_message(event.reply_token, TextSendMessage(text="体重は数値で入力してください。"))
-            return
-        
-        gend = 0.0 if gender.lower() == "m" else 1.0
-        mi, se, sed = t
-        score = calc_idt(mi, se, sed, weight, gend)
-        score_disp = round(score + 1e-8, 2)
+        name, gender, time_str, weight, score_disp = record.name, record.gender, record.time_str, record.weight, record.score
         record_date = today_jst_ymd()
         
-        name_col = header.index("name")
-        if any(row[name_col] == name for row in all_users_data[1:]):
+        if users.find("name", name) is not None:
             line_bot_api.reply_message(event.reply_token, TextSendMessage(text="既に選手として追加済みのユーザー名です。管理者からの記録追加はできません。"))
             user_states.pop(user_id)
             return
         
         row = [record_date, name, gender, time_str, weight, score_disp]
         try:
-            admin_record_sheet.append_row(row, value_input_option="USER_ENTERED")
-            line_bot_api.reply_message(event.reply_token, TextSendMessage(text=f"管理者として{record_date}に記録を登録しました。\nIDT: {score_disp:.2f}%"))
-            user_states.pop(user_id)
+            status = admin_record_sheet.append_row(row, value_input_option="USER_ENTERED")
         except Exception as e:
             line_bot_api.reply_message(event.reply_token, TextSendMessage(text=f"記録に失敗しました。{e}"))
+            return
+        # 返信に失敗しても同じ記録をもう一度書かないよう、状態は先に戻しておく
+        user_states.pop(user_id)
+        report_service.invalidate()
+        line_bot_api.reply_message(event.reply_token, TextSendMessage(text=append_reply(
+            status, f"管理者として{record_date}に記録を登録しました。\nIDT: {score_disp:.2f}%",
+            f"{name}の{record_date}の管理者記録（IDT: {score_disp:.2f}%）")))
         return
 
     return
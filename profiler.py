@@ -0,0 +1,340 @@
+# profiler.py
+# 本番で handle_message のどこに時間が掛かっているかを調べるためのサンプリングプロファイラ
+#
+# 1番管理者の「profile on [割合]」で有効になり、その割合のイベントだけを計測する。
+# 計測中のイベントを処理しているスレッドのスタックを一定間隔で覗き、
+# 処理の流れ（モード名やコマンド名）ごとに collapsed 形式（flamegraph.pl / speedscope 用）で集計する。
+# 無効なときの負荷は設定ファイルの確認（1秒に1回）だけ。
+#
+# 設定と集計結果は PROFILE_DIR に置き、gunicorn の全ワーカーで共有する。
+# 各関数の directory を変えると、設定・集計をその置き場所ごとに分けられる（複数クラブを受け持つときのクラブごとの計測）。
+#
+#   PROFILE_DIR               設定・集計の置き場所
+#   PROFILE_INTERVAL_MS       サンプリング間隔 (既定 5)
+#   PROFILE_MAX_MINUTES       有効にしてから自動で無効に戻すまでの分数 (既定 60)
+
+import datetime
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import traceback
+from collections import Counter
+
+import pytz
+
+PROFILE_DIR = os.environ.get("PROFILE_DIR", os.path.join(tempfile.gettempdir(), "line_bot_profiles"))
+INTERVAL_SECONDS = float(os.environ.get("PROFILE_INTERVAL_MS", "5")) / 1000
+MAX_MINUTES = float(os.environ.get("PROFILE_MAX_MINUTES", "60"))
+SETTINGS_CHECK_SECONDS = 1.0
+JST = pytz.timezone('Asia/Tokyo')
+DEFAULT_RATE = 0.1
+
+# 流れの名前に使うコマンド（ユーザーの自由入力は名前に含めない）
+COMMANDS = (
+    "help", "readme", "login", "logout", "cal idt", "tide subscribe", "tide unsubscribe", "tide",
+    "delete account", "add idt", "history", "report", "admin request", "admin approve", "admin add", "profile",
+)
+
+
+def flow_for(text, mode=None):
+    """Flow name for a message: the conversation mode if any, otherwise the command."""
+    if mode:
+        return f"mode:{mode}"
+    lowered = text.strip().lower()
+    for command in COMMANDS:
+        if lowered == command or lowered.startswith(command + " "):
+            return command.replace(" ", "_")
+    return "other"
+
+
+def _settings_path(directory):
+    return os.path.join(directory, "settings.json")
+
+
+def _write_json(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.replace(tmp, path)
+
+
+def enable(rate=DEFAULT_RATE, minutes=MAX_MINUTES, directory=PROFILE_DIR):
+    rate = min(max(rate, 0.0), 1.0)
+    _write_json(_settings_path(directory), {"rate": rate, "until": time.time() + minutes * 60})
+    _settings_for(directory).checked_at = 0.0
+    return rate
+
+
+def disable(directory=PROFILE_DIR):
+    _write_json(_settings_path(directory), {"rate": 0.0, "until": 0})
+    _settings_for(directory).checked_at = 0.0
+
+
+def reset(directory=PROFILE_DIR):
+    """Deletes every worker's collected profiles."""
+    _profiles_for(directory).clear()
+    try:
+        names = os.listdir(directory)
+    except OSError:
+        return
+    for name in names:
+        if name.startswith("profile_") and name.endswith(".json"):
+            try:
+                os.remove(os.path.join(directory, name))
+            except OSError:
+                pass
+
+
+class _Settings:
+    def __init__(self, directory):
+        self.directory = directory
+        self.rate = 0.0
+        self.until = 0.0
+        self.checked_at = 0.0
+        self.mtime = None
+
+    def current_rate(self):
+        now = time.monotonic()
+        if now - self.checked_at >= SETTINGS_CHECK_SECONDS:
+            self.checked_at = now
+            try:
+                mtime = os.stat(_settings_path(self.directory)).st_mtime
+                if mtime != self.mtime:
+                    with open(_settings_path(self.directory), encoding="utf-8") as f:
+                        data = json.load(f)
+                    self.rate, self.until, self.mtime = float(data["rate"]), float(data["until"]), mtime
+            except (OSError, ValueError, KeyError):
+                self.rate = 0.0
+        if self.rate and time.time() > self.until:
+            return 0.0
+        return self.rate
+
+
+_settings = {}           # directory -> _Settings
+_settings_lock = threading.Lock()
+
+
+def _settings_for(directory):
+    with _settings_lock:
+        if directory not in _settings:
+            _settings[directory] = _Settings(directory)
+        return _settings[directory]
+
+
+def status(directory=PROFILE_DIR):
+    settings = _settings_for(directory)
+    rate = settings.current_rate()
+    return {"rate": rate, "until": settings.until if rate else None}
+
+
+class _FlowProfile:
+    __slots__ = ("count", "total_ms", "max_ms", "samples")
+
+    def __init__(self):
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.samples = Counter()   # "a;b;c" -> サンプル数
+
+
+class _Profiles:
+    """Per-process aggregate, saved to <directory>/profile_<pid>.json after each profiled event."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._flows = {}
+        self._lock = threading.Lock()
+
+    def clear(self):
+        with self._lock:
+            self._flows = {}
+
+    def add_samples(self, flow, stacks):
+        with self._lock:
+            profile = self._flows.setdefault(flow, _FlowProfile())
+            profile.samples.update(stacks)
+
+    def finish(self, flow, elapsed_ms):
+        with self._lock:
+            profile = self._flows.setdefault(flow, _FlowProfile())
+            profile.count += 1
+            profile.total_ms += elapsed_ms
+            profile.max_ms = max(profile.max_ms, elapsed_ms)
+            data = {
+                name: {"count": p.count, "total_ms": p.total_ms, "max_ms": p.max_ms, "samples": dict(p.samples)}
+                for name, p in self._flows.items()
+            }
+        _write_json(os.path.join(self.directory, f"profile_{os.getpid()}.json"), data)
+
+
+_profiles = {}           # directory -> _Profiles
+
+
+def _profiles_for(directory):
+    with _settings_lock:
+        if directory not in _profiles:
+            _profiles[directory] = _Profiles(directory)
+        return _profiles[directory]
+
+
+def _collapse(frame, root):
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+        if frame is root:
+            break
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+class _Sampler:
+    """One background thread that samples the stacks of threads being profiled."""
+
+    def __init__(self):
+        self._active = {}          # thread id -> (flow, root frame, Counter)
+        self._cond = threading.Condition()
+        self._thread = None
+        self._pid = None
+
+    def _ensure_thread(self):
+        # fork 後のワーカーではスレッドを作り直す
+        if self._thread is None or self._pid != os.getpid() or not self._thread.is_alive():
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._loop, name="profile-sampler", daemon=True)
+            self._thread.start()
+
+    def start(self, flow, root):
+        stacks = Counter()
+        with self._cond:
+            self._active[threading.get_ident()] = (flow, root, stacks)
+            self._ensure_thread()
+            self._cond.notify()
+        return stacks
+
+    def stop(self):
+        with self._cond:
+            return self._active.pop(threading.get_ident(), None)
+
+    def _loop(self):
+        while True:
+            with self._cond:
+                while not self._active:
+                    self._cond.wait()
+                active = list(self._active.items())
+            frames = sys._current_frames()
+            for ident, (flow, root, stacks) in active:
+                frame = frames.get(ident)
+                if frame is not None:
+                    stacks[_collapse(frame, root)] += 1
+            del frames
+            time.sleep(INTERVAL_SECONDS)
+
+
+_sampler = _Sampler()
+
+
+class sample:
+    """
+    Context manager around one event. With probability equal to the
+    configured rate it samples the calling function's stack until exit
+    and records the result under flow_fn()'s name.
+    """
+
+    __slots__ = ("flow_fn", "directory", "flow", "started")
+
+    def __init__(self, flow_fn, directory=PROFILE_DIR):
+        self.flow_fn = flow_fn
+        self.directory = directory
+        self.flow = None
+
+    def __enter__(self):
+        rate = _settings_for(self.directory).current_rate()
+        if not rate or random.random() >= rate:
+            return self
+        try:
+            self.flow = self.flow_fn()
+            _sampler.start(self.flow, sys._getframe(1))
+            self.started = time.perf_counter()
+        except Exception:
+            traceback.print_exc()
+            self.flow = None
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if self.flow is None:
+            return False
+        try:
+            elapsed_ms = (time.perf_counter() - self.started) * 1000
+            item = _sampler.stop()
+            profiles = _profiles_for(self.directory)
+            if item:
+                profiles.add_samples(self.flow, item[2])
+            profiles.finish(self.flow, elapsed_ms)
+        except Exception:
+            traceback.print_exc()
+        return False
+
+
+def load_all(directory=PROFILE_DIR):
+    """Merges the saved profiles of every worker: {flow: {"count", "total_ms", "max_ms", "samples"}}."""
+    merged = {}
+    try:
+        names = os.listdir(directory)
+    except OSError:
+        return merged
+    for name in names:
+        if not (name.startswith("profile_") and name.endswith(".json")):
+            continue
+        try:
+            with open(os.path.join(directory, name), encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            continue
+        for flow, p in data.items():
+            m = merged.setdefault(flow, {"count": 0, "total_ms": 0.0, "max_ms": 0.0, "samples": Counter()})
+            m["count"] += p["count"]
+            m["total_ms"] += p["total_ms"]
+            m["max_ms"] = max(m["max_ms"], p["max_ms"])
+            m["samples"].update(p["samples"])
+    return merged
+
+
+def collapsed(profiles, flow=None):
+    """Flame-graph input: one "flow;frame;...;frame count" line per distinct stack."""
+    lines = []
+    for name in sorted(profiles):
+        if flow and name != flow:
+            continue
+        for stack, count in profiles[name]["samples"].most_common():
+            lines.append(f"{name};{stack} {count}")
+    return "\n".join(lines) + ("\n" if lines else "")
+
+
+def summary(profiles):
+    return {
+        name: {
+            "events": p["count"],
+            "avg_ms": round(p["total_ms"] / p["count"], 1) if p["count"] else 0.0,
+            "max_ms": round(p["max_ms"], 1),
+            "samples": sum(p["samples"].values()),
+        }
+        for name, p in sorted(profiles.items())
+    }
+
+
+def format_status(directory=PROFILE_DIR):
+    s = status(directory)
+    if not s["rate"]:
+        lines = ["プロファイリング: 無効"]
+    else:
+        until = datetime.datetime.fromtimestamp(s["until"], JST).strftime("%H:%M")
+        lines = [f"プロファイリング: 有効（{s['rate'] * 100:g}% のイベント、{until} まで）"]
+    for name, p in summary(load_all(directory)).items():
+        lines.append(f"{name}: {p['events']}件 平均{p['avg_ms']}ms 最大{p['max_ms']}ms")
+    return "\n".join(lines)
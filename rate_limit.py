@@ -0,0 +1,133 @@
+# rate_limit.py
+# user_id × コマンド種別ごとのトークンバケットによる流量制限
+# シートへのアクセスより前にメモリ上だけで判定する
+# LINE の user_id はプロバイダー単位なので、複数のクラブ（tenants.py）を使う人は
+# クラブごとに別のバケット・回数を持つ（あるクラブでの連投で別のクラブの一時停止にならないように）
+
+import os
+import threading
+import time
+
+import tenants
+
+CLASS_CHEAP = "cheap"          # help / cal idt など
+CLASS_EXPENSIVE = "expensive"  # tide / login / add idt など
+
+EXPENSIVE_COMMANDS = ("tide", "login", "logout", "delete account", "admin request", "admin add", "report")
+EXPENSIVE_PREFIXES = ("add idt", "admin approve ", "history", "tide ")
+EXPENSIVE_MODES = (
+    "awaiting_tide_datetime", "signup", "login_confirm", "login_switch",
+    "login_switch_confirm", "login_switch_otp", "login_switch_final_confirm",
+    "delete_account_confirm", "add_idt_admin", "add_idt_user",
+    "admin_request", "admin_add",
+)
+
+
+def _parse_rate(value, default):
+    # "容量/秒数" 形式 (例: "10/60" → 60秒で10回まで)
+    try:
+        capacity, period = value.split("/")
+        capacity, period = float(capacity), float(period)
+        if capacity > 0 and period > 0:
+            return capacity, capacity / period
+    except (AttributeError, ValueError):
+        pass
+    return default
+
+
+LIMITS = {
+    CLASS_CHEAP: _parse_rate(os.environ.get("RATE_LIMIT_CHEAP"), (10.0, 10.0 / 60)),
+    CLASS_EXPENSIVE: _parse_rate(os.environ.get("RATE_LIMIT_EXPENSIVE"), (4.0, 4.0 / 60)),
+}
+# 連続で制限に掛かった回数がこの値に達したら一時停止へ昇格（0で無効）
+SUSPEND_AFTER = int(os.environ.get("RATE_LIMIT_SUSPEND_AFTER", "0"))
+SUSPEND_MINUTES = int(os.environ.get("RATE_LIMIT_SUSPEND_MINUTES", "30"))
+MAX_BUCKETS = 10000
+
+_lock = threading.Lock()
+_buckets = {}   # ((tenant id, user_id), class) -> [tokens, last_refill]
+_strikes = {}   # (tenant id, user_id) -> 連続で制限に掛かった回数
+counters = {
+    CLASS_CHEAP: {"allowed": 0, "limited": 0},
+    CLASS_EXPENSIVE: {"allowed": 0, "limited": 0},
+    "escalated": 0,
+}
+
+
+def classify(text, mode=None):
+    lowered = text.strip().lower()
+    if mode in EXPENSIVE_MODES:
+        return CLASS_EXPENSIVE
+    if lowered in EXPENSIVE_COMMANDS or lowered.startswith(EXPENSIVE_PREFIXES):
+        return CLASS_EXPENSIVE
+    return CLASS_CHEAP
+
+
+def _prune(now):
+    # 満タンに戻ったバケットは保持する必要がない
+    for key, (tokens, last) in list(_buckets.items()):
+        capacity, rate = LIMITS[key[1]]
+        if tokens + (now - last) * rate >= capacity:
+            del _buckets[key]
+    # バケットが全部満タンに戻ったユーザーは、もう連続して制限に掛かってはいない
+    active = {user for user, _ in _buckets}
+    for user in list(_strikes):
+        if user not in active:
+            del _strikes[user]
+
+
+def _user(user_id):
+    return tenants.current().id, user_id
+
+
+def check(user_id, command_class):
+    """
+    Takes one token from the user's bucket for `command_class` in the current tenant.
+    Returns (allowed, strikes): strikes counts consecutive rejections so
+    the caller can notify once and escalate to a suspension.
+    """
+    capacity, rate = LIMITS[command_class]
+    now = time.monotonic()
+    user = _user(user_id)
+    with _lock:
+        key = (user, command_class)
+        bucket = _buckets.get(key)
+        if bucket is None:
+            if len(_buckets) >= MAX_BUCKETS:
+                _prune(now)
+            bucket = _buckets[key] = [capacity, now]
+        tokens = min(capacity, bucket[0] + (now - bucket[1]) * rate)
+        bucket[1] = now
+        if tokens >= 1.0:
+            bucket[0] = tokens - 1.0
+            _strikes.pop(user, None)
+            counters[command_class]["allowed"] += 1
+            return True, 0
+        bucket[0] = tokens
+        strikes = _strikes.get(user, 0) + 1
+        _strikes[user] = strikes
+        counters[command_class]["limited"] += 1
+        return False, strikes
+
+
+def should_escalate(strikes):
+    # 一時停止の書き込みに失敗したときも、次に制限に掛かったらもう一度試す
+    return SUSPEND_AFTER > 0 and strikes >= SUSPEND_AFTER
+
+
+def record_escalation(user_id):
+    user = _user(user_id)
+    with _lock:
+        counters["escalated"] += 1
+        _strikes.pop(user, None)
+
+
+def stats():
+    with _lock:
+        return {
+            CLASS_CHEAP: dict(counters[CLASS_CHEAP]),
+            CLASS_EXPENSIVE: dict(counters[CLASS_EXPENSIVE]),
+            "escalated": counters["escalated"],
+            "buckets": len(_buckets),
+            "strikes": len(_strikes),
+        }
@@ -0,0 +1,128 @@
+# render_cache.py
+# 固定応答（help / readme）のメッセージを事前に組み立ててキャッシュする
+
+from functools import lru_cache
+
+from linebot.models import FlexSendMessage, TextSendMessage
+
+ROLE_HEAD_ADMIN = "head_admin"
+ROLE_ADMIN = "admin"
+ROLE_USER = "user"
+
+README_URL = "https://direct-preview-68679e75e78885be252c2c24.monaca.education"
+
+HELP_TEMPLATES = {
+    ROLE_HEAD_ADMIN: (
+        "あなたは1番管理者です。\n"
+        "“add idt”で任意の選手のIDT記録を管理者として追加できます。\n"
+        "入力形式: 名前 学年 タイム 性別(m/w) 体重\n"
+        "例: 太郎 2 7:32.8 m 58.6\n"
+        "“report”でチームのIDT集計レポートを受け取れます\n"
+        "“admin approve <名前>”で管理者昇格承認（1番管理者のみ）\n"
+        "“profile on [割合]”で処理時間の計測を開始（“profile off”で停止、“profile status”で集計を表示）\n"
+        "“stop responding to <ユーザ名> for <時間> time because you did <理由>”で一時停止（1番管理者のみ）"
+    ),
+    ROLE_ADMIN: (
+        "あなたは管理者（マネージャー）アカウントです。\n"
+        "“cal idt”でIDTの計算ができます\n"
+        "“add idt”で任意の選手のIDT記録を管理者として追加できます。\n"
+        "入力形式: 名前 学年 タイム 性別(m/w) 体重\n"
+        "例: 太郎 2 7:32.8 m 56.4\n"
+        "“report”でチームのIDT集計レポートを受け取れます\n"
+    ),
+    ROLE_USER: (
+        "“login”でログインができます(記録の記入時に必須)\n"
+        "“logout”でログアウトができます\n"
+        "“cal idt”でIDTの計算ができます(ログイン不要)\n"
+        "“add idt”で自分のIDT記録を入力できます(ログイン必須)。例: 7:32.8 53.6\n"
+        "“history”で自分のIDT記録の推移を確認できます(ログイン必須)\n"
+        "“tide”で潮位を調べられます。“tide subscribe”で毎朝の潮位配信を登録（“tide unsubscribe”で解除）\n"
+        "“admin request”で管理者申請\n"
+    ),
+}
+
+README_TEMPLATE = {
+    "alt_text": "Botの使い方はこちら",
+    "contents": {
+        "type": "bubble",
+        "body": {
+            "type": "box",
+            "layout": "vertical",
+            "contents": [
+                {
+                    "type": "text",
+                    "text": "📘 Botの使い方",
+                    "weight": "bold",
+                    "size": "lg"
+                },
+                {
+                    "type": "text",
+                    "text": "以下のリンクから詳細なREADMEが見られます。(外部サイトに遷移します。)",
+                    "size": "sm",
+                    "wrap": True
+                }
+            ]
+        },
+        "footer": {
+            "type": "box",
+            "layout": "vertical",
+            "spacing": "sm",
+            "contents": [
+                {
+                    "type": "button",
+                    "style": "primary",
+                    "action": {
+                        "type": "uri",
+                        "label": "READMEを見る",
+                        "uri": README_URL
+                    }
+                }
+            ]
+        }
+    }
+}
+
+
+class PrerenderedMessage:
+    """
+    Wraps a send-message object whose JSON form is computed once.
+    LineBotApi only calls as_json_dict() on outgoing messages, so the
+    cached dict is reused as-is for every reply.
+    """
+
+    def __init__(self, message):
+        self.message = message
+        self._json = message.as_json_dict()
+
+    def as_json_dict(self):
+        return self._json
+
+
+def get_role(header, user_row):
+    # handle_message で取得済みの行から役割を一度だけ判定する
+    if not user_row or "admin" not in header:
+        return ROLE_USER
+    admin_col = header.index("admin")
+    if len(user_row) > admin_col:
+        value = user_row[admin_col]
+        if value == "1":
+            return ROLE_HEAD_ADMIN
+        if value.isdigit():
+            return ROLE_ADMIN
+    return ROLE_USER
+
+
+@lru_cache(maxsize=None)
+def help_message(role):
+    return PrerenderedMessage(TextSendMessage(text=HELP_TEMPLATES[role]))
+
+
+@lru_cache(maxsize=None)
+def readme_message():
+    return PrerenderedMessage(FlexSendMessage(**README_TEMPLATE))
+
+
+def clear_render_cache():
+    # テンプレートを書き換えた場合のみ呼ぶ
+    help_message.cache_clear()
+    readme_message.cache_clear()
@@ -0,0 +1,242 @@
+# replay.py
+# webhook_capture.py で記録した webhook をローカルの main.app に再送する負荷試験ツール
+#
+#   python replay.py webhooks.jsonl.gz --speed 10
+#
+# シートの代わりに一時的な SQLite、LINE API の代わりに呼び出しを数えるだけの偽物を使う。
+# 記録にあるユーザーはログイン済みの選手として登録しておく（--db で既存の SQLite から始めることもできる）。
+# 本文は再送時に署名し直す。流量制限は再生速度に合わせて窓を縮める。
+
+import argparse
+import base64
+import hashlib
+import hmac
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from webhook_capture import read_capture
+
+REPLAY_SECRET = "replay-channel-secret"
+FIXTURE_PDF = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmarks", "fixtures", "KC_sample.pdf")
+
+
+class CallCounter:
+    def __init__(self):
+        self.counts = Counter()
+        self._lock = threading.Lock()
+
+    def add(self, name):
+        with self._lock:
+            self.counts[name] += 1
+
+
+class CountingTable:
+    """Wraps a storage table, counting (and optionally delaying) every method call."""
+
+    def __init__(self, table, counter, latency):
+        self._table = table
+        self._counter = counter
+        self._latency = latency
+
+    def __getattr__(self, name):
+        attr = getattr(self._table, name)
+        if name.startswith("_") or not callable(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            self._counter.add(f"sheets.{name}")
+            if self._latency:
+                time.sleep(self._latency)
+            return attr(*args, **kwargs)
+        return call
+
+
+class CountingBackend:
+    def __init__(self, backend, counter, latency):
+        self._backend = backend
+        self._counter = counter
+        self._latency = latency
+
+    def __getattr__(self, name):
+        return getattr(self._backend, name)
+
+    def table(self, name, header=None, rows=100):
+        return CountingTable(self._backend.table(name, header=header, rows=rows), self._counter, self._latency)
+
+
+class FakeLineApi:
+    """Stands in for LineBotApi: counts calls and sleeps `latency` seconds per call."""
+
+    def __init__(self, counter, latency):
+        self._counter = counter
+        self._latency = latency
+
+    def __getattr__(self, name):
+        def call(*args, **kwargs):
+            self._counter.add(f"line.{name}")
+            if self._latency:
+                time.sleep(self._latency)
+        return call
+
+
+def sign(body, secret=REPLAY_SECRET):
+    return base64.b64encode(hmac.new(secret.encode(), body.encode("utf-8"), hashlib.sha256).digest()).decode()
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, int(round(pct / 100 * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+
+def prepare_environment(args, workdir):
+    db_path = os.path.join(workdir, "replay.db")
+    if args.db:
+        shutil.copyfile(args.db, db_path)
+    os.environ.update({
+        "STORAGE_BACKEND": "sqlite",
+        "SQLITE_PATH": db_path,
+        "LINE_CHANNEL_ACCESS_TOKEN": "replay",
+        "LINE_CHANNEL_SECRET": REPLAY_SECRET,
+        "TIDE_PUSH_ENABLED": "0",
+        "JMA_CACHE_DIR": os.path.join(workdir, "jma_cache"),
+        "SNAPSHOT_DIR": os.path.join(workdir, "snapshots"),
+    })
+    for name in ("EVENT_DEDUP_DB", "WEBHOOK_CAPTURE_PATH"):
+        os.environ.pop(name, None)
+    # 速く再生した分だけ流量制限の窓を縮め、本番と同じ割合で制限が掛かるようにする
+    for name, default in (("RATE_LIMIT_CHEAP", "10/60"), ("RATE_LIMIT_EXPENSIVE", "4/60")):
+        capacity, period = os.environ.get(name, default).split("/")
+        os.environ[name] = f"{capacity}/{float(period) / args.speed}"
+
+
+def load_main(counter, args):
+    import storage
+    open_storage = storage.open_storage
+    sheets_latency = args.sheets_latency_ms / 1000
+
+    def counting_open_storage(*a, **kw):
+        return CountingBackend(open_storage(*a, **kw), counter, sheets_latency)
+    storage.open_storage = counting_open_storage
+
+    import tide
+    def fake_fetch(url, timeout=None):
+        counter.add("jma.fetch")
+        return FIXTURE_PDF
+    tide.fetch_cached = fake_fetch
+
+    import main
+    main.line_bot_api = FakeLineApi(counter, args.line_latency_ms / 1000)
+    return main
+
+
+def register_users(main, user_ids):
+    """Registers every captured user as a logged-in athlete so their messages take the real flows."""
+    users = main.users_table(main.worksheet.get_all_values())
+    known = set(users.column("user_id")) if users and users.has("user_id") else set()
+    for i, user_id in enumerate(sorted(user_ids - known)):
+        main.worksheet.append_row([f"replay{i:04d}", "1", "key", user_id, main.now_str(), "", "m"])
+
+
+def user_ids_in(records):
+    ids = set()
+    for record in records:
+        for event in record["body"].get("events", []):
+            user_id = event.get("source", {}).get("userId")
+            if user_id:
+                ids.add(user_id)
+    return ids
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Replay captured LINE webhooks against a local main.app.")
+    parser.add_argument("capture", help="file written by WEBHOOK_CAPTURE_PATH")
+    parser.add_argument("--speed", type=float, default=1.0, help="replay speed multiplier (1-100)")
+    parser.add_argument("--threads", type=int, default=32, help="concurrent requests in flight")
+    parser.add_argument("--limit", type=int, help="replay only the first N webhooks")
+    parser.add_argument("--db", help="SQLite file to start from (copied, never modified)")
+    parser.add_argument("--no-register", action="store_true", help="do not register captured users")
+    parser.add_argument("--sheets-latency-ms", type=float, default=0, help="simulated latency per Sheets call")
+    parser.add_argument("--line-latency-ms", type=float, default=0, help="simulated latency per LINE API call")
+    args = parser.parse_args(argv)
+    if not 1 <= args.speed <= 100:
+        parser.error("--speed must be between 1 and 100")
+
+    records = list(read_capture(args.capture))
+    if args.limit:
+        records = records[:args.limit]
+    if not records:
+        print("no webhooks in capture")
+        return 1
+
+    workdir = tempfile.mkdtemp(prefix="replay_")
+    try:
+        prepare_environment(args, workdir)
+        counter = CallCounter()
+        app_module = load_main(counter, args)
+        if not args.no_register:
+            register_users(app_module, user_ids_in(records))
+        counter.counts.clear()
+        return run(app_module, records, counter, args)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def run(app_module, records, counter, args):
+    latencies = []
+    lags = []
+    statuses = Counter()
+    lock = threading.Lock()
+    local = threading.local()
+
+    def send(body):
+        client = getattr(local, "client", None)
+        if client is None:
+            client = local.client = app_module.app.test_client()
+        started = time.perf_counter()
+        res = client.post("/callback", data=body.encode("utf-8"), headers={
+            "X-Line-Signature": sign(body), "Content-Type": "application/json",
+        })
+        elapsed = time.perf_counter() - started
+        with lock:
+            latencies.append(elapsed)
+            statuses[res.status_code] += 1
+
+    first = records[0]["t"]
+    events = sum(len(r["body"].get("events", [])) for r in records)
+    print(f"replaying {len(records)} webhooks ({events} events) at {args.speed:g}x")
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.threads) as pool:
+        for record in records:
+            due = started + (record["t"] - first) / args.speed
+            delay = due - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                lags.append(-delay)
+            pool.submit(send, json.dumps(record["body"], ensure_ascii=False))
+    wall = time.perf_counter() - started
+
+    latencies.sort()
+    print(f"wall time {wall:.2f}s, {len(records) / wall:.1f} webhooks/s, statuses {dict(statuses)}")
+    print("latency ms: " + "  ".join(
+        f"p{p}={percentile(latencies, p) * 1000:.1f}" for p in (50, 90, 95, 99)
+    ) + f"  max={latencies[-1] * 1000:.1f}")
+    if lags:
+        print(f"behind schedule: {len(lags)} webhooks, max {max(lags) * 1000:.0f}ms")
+    print("dependency calls:")
+    for name, count in sorted(counter.counts.items()):
+        print(f"  {name:<28} {count:>8}  ({count / len(records):.2f}/webhook)")
+    return 0 if set(statuses) == {200} else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
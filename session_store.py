@@ -0,0 +1,78 @@
+# session_store.py
+# ログイン状態（last_auth）の更新をメモリ上に貯め、シートへはまとめて非同期に書き込む
+#
+# メモリに持つのはシートにまだ書いていない値だけ。それ以外は常にシート（共有スナップショット）を見るので、
+# 別のワーカーでのログアウトや切り替えもそのスナップショットの更新と同時に反映される。
+
+import atexit
+import contextvars
+import os
+import threading
+import time
+import traceback
+
+# シートへの書き込み間隔
+FLUSH_SECONDS = float(os.environ.get("SESSION_FLUSH_SECONDS", "5"))
+
+
+class SessionStore:
+    def __init__(self, persist_batch, flush_seconds=FLUSH_SECONDS):
+        self.persist_batch = persist_batch   # persist_batch({user_id: last_auth})
+        self.flush_seconds = flush_seconds
+        self._pending = {}                   # user_id -> last_auth（未書き込み、または書き込み中）
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        self._context = contextvars.copy_context()
+        # 同じ Context は同時に2か所で run できないので、スレッドと終了処理ではそれぞれ複製を使う
+        atexit.register(lambda: self._context.copy().run(self.flush))
+
+    def _ensure_flusher(self):
+        # fork 後のワーカーではスレッドを作り直す
+        if self._thread is None or self._pid != os.getpid() or not self._thread.is_alive():
+            self._pid = os.getpid()
+            # 書き込みは作成したテナント（tenants.py）のシートに行う
+            self._thread = threading.Thread(target=self._context.copy().run, args=(self._loop,), name="session-flush", daemon=True)
+            self._thread.start()
+
+    def get(self, user_id):
+        """Returns the last_auth value not yet written to the sheet, or None (then the sheet is current)."""
+        with self._lock:
+            return self._pending.get(user_id)
+
+    def set(self, user_id, value):
+        with self._lock:
+            self._pending[user_id] = value
+        self._ensure_flusher()
+
+    def forget(self, user_id):
+        # アカウント削除・切り替え時に、書き込み前の古い状態を残さない
+        with self._lock:
+            self._pending.pop(user_id, None)
+
+    def pending_count(self):
+        with self._lock:
+            return len(self._pending)
+
+    def flush(self):
+        with self._lock:
+            batch = dict(self._pending)
+        if not batch:
+            return 0
+        try:
+            self.persist_batch(batch)
+        except Exception:
+            traceback.print_exc()
+            # 失敗した分は残しておき、次回に回す
+            return 0
+        # 書き込みが済むまではメモリの値を使う（その間のシートは古い）。書いている間に更新された値は残す
+        with self._lock:
+            for user_id, value in batch.items():
+                if self._pending.get(user_id) == value:
+                    del self._pending[user_id]
+        return len(batch)
+
+    def _loop(self):
+        while True:
+            time.sleep(self.flush_seconds)
+            self.flush()
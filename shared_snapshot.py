@@ -0,0 +1,212 @@
+# shared_snapshot.py
+# gunicorn の全ワーカーで共有するスナップショット（users / 停止リスト / 潮位表など）
+#
+# スナップショットは SNAPSHOT_DIR/<name>.json に置く。古くなったら、ロックを取った1プロセスだけが
+# シートから読み直して一時ファイルに書き、os.replace で差し替える。他のワーカーはロックが空くのを待ち、
+# 新しいファイルを読むだけなので、シートへの読み込みはワーカー数によらず1回で済む。
+# 各プロセスはファイルの版（inode と更新時刻）が変わったときだけ読み直す。
+#
+#   SNAPSHOT_DIR              置き場所（同じホストのワーカーで共有される）
+#   SHARED_SNAPSHOT_MAX_AGE   シートのスナップショットを読み直すまでの秒数 (既定 60, main.py)
+
+import fcntl
+import json
+import os
+import tempfile
+import threading
+import time
+
+from sheets_quota import with_priority
+from singleflight import SingleFlight
+
+SNAPSHOT_DIR = os.environ.get("SNAPSHOT_DIR", os.path.join(tempfile.gettempdir(), "line_bot_snapshots"))
+
+
+class SharedSnapshots:
+    def __init__(self, directory=SNAPSHOT_DIR):
+        self.directory = directory
+        self._local = {}           # name -> (version, value)
+        self._seeds = {}           # name -> (generation, value)  warm_start で読み込んだ内容
+        self._lock = threading.Lock()
+        self._flight = SingleFlight()
+        self.counters = {"loaded": 0, "refreshed": 0, "hits": 0, "seeded": 0}
+
+    def _path(self, name):
+        return os.path.join(self.directory, f"{name}.json")
+
+    def _stat(self, name):
+        try:
+            return os.stat(self._path(name))
+        except OSError:
+            return None
+
+    def _generation(self, name):
+        # invalidate() のたびに更新される印。読み直し中に書き込みがあったかの判定に使う
+        try:
+            return os.stat(self._path(name) + ".gen").st_mtime_ns
+        except OSError:
+            return None
+
+    def _read(self, name, st, decode):
+        version = (st.st_ino, st.st_mtime_ns)
+        with self._lock:
+            cached = self._local.get(name)
+        if cached and cached[0] == version:
+            self.counters["hits"] += 1
+            return cached[1]
+        try:
+            with open(self._path(name), "rb") as f:
+                data = json.loads(f.read())
+        except (OSError, ValueError):
+            return None
+        value = decode(data) if decode else data
+        with self._lock:
+            self._local[name] = (version, value)
+        self.counters["loaded"] += 1
+        return value
+
+    def _fresh(self, st, max_age):
+        return st is not None and (max_age is None or time.time() - st.st_mtime <= max_age)
+
+    def get(self, name, loader, max_age=None, encode=None, decode=None):
+        """
+        Returns the shared snapshot `name`, calling loader() to rebuild it
+        when the file is missing or older than `max_age` seconds. Only one
+        process rebuilds at a time; the others wait and read its result.
+        A loader returning None is not saved.
+        """
+        with self._lock:
+            seed = self._seeds.get(name)
+        if seed is not None:
+            # どこかのワーカーが書き込んでいたら、読み込んだ内容はもう使わない
+            if self._generation(name) == seed[0]:
+                self.counters["seeded"] += 1
+                return seed[1]
+            with self._lock:
+                self._seeds.pop(name, None)
+        st = self._stat(name)
+        if self._fresh(st, max_age):
+            value = self._read(name, st, decode)
+            if value is not None:
+                return value
+        return self._flight.do(name, self._refresh, name, loader, max_age, encode, decode)
+
+    def seed(self, name, value):
+        """
+        Serves `value` for `name` (e.g. restored from the warm-start file)
+        until revalidate() succeeds or any worker writes to the table.
+        """
+        with self._lock:
+            self._seeds[name] = (self._generation(name), value)
+
+    def is_seeded(self, name):
+        with self._lock:
+            return name in self._seeds
+
+    def revalidate(self, name, loader, max_age=None, encode=None, decode=None):
+        """Like get(), but ignores a seeded value; the result replaces the seed."""
+        value = self._flight.do(name, self._refresh, name, loader, max_age, encode, decode)
+        if value is not None:
+            with self._lock:
+                self._seeds.pop(name, None)
+        return value
+
+    def peek(self, name):
+        """The value this process last served for `name`, without any I/O. None if there is none."""
+        with self._lock:
+            seed = self._seeds.get(name)
+            if seed is not None:
+                return seed[1]
+            cached = self._local.get(name)
+        return cached[1] if cached else None
+
+    def _refresh(self, name, loader, max_age, encode, decode):
+        os.makedirs(self.directory, exist_ok=True)
+        with open(self._path(name) + ".lock", "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                # 待っている間に他のワーカーが更新していればそれを使う
+                st = self._stat(name)
+                if self._fresh(st, max_age):
+                    value = self._read(name, st, decode)
+                    if value is not None:
+                        return value
+                generation = self._generation(name)
+                value = loader()
+                if value is None:
+                    return None
+                if self._generation(name) != generation:
+                    # 読み直している間に書き込みがあった。書き込み前の内容かもしれないので共有しない
+                    return value
+                self._write(name, encode(value) if encode else value)
+                self.counters["refreshed"] += 1
+                st = self._stat(name)
+                if st is not None:
+                    with self._lock:
+                        self._local[name] = ((st.st_ino, st.st_mtime_ns), value)
+                return value
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _write(self, name, data):
+        fd, tmp = tempfile.mkstemp(dir=self.directory, prefix=f".{name}.", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(data, f, ensure_ascii=False, separators=(",", ":"))
+            os.replace(tmp, self._path(name))
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+
+    def invalidate(self, name):
+        """Drops `name` for every worker; the next get() rebuilds it."""
+        try:
+            os.remove(self._path(name))
+        except FileNotFoundError:
+            pass
+        os.makedirs(self.directory, exist_ok=True)
+        with open(self._path(name) + ".gen", "w") as f:
+            f.write(str(time.time_ns()))
+        with self._lock:
+            self._local.pop(name, None)
+            self._seeds.pop(name, None)
+
+    def invalidating(self, table, *names):
+        """A view of `table` whose writes invalidate the given snapshots."""
+        return InvalidatingTable(table, self, names)
+
+
+# 書き込みとして扱う表のメソッド（gspread / SqliteTable / QuotaTable 共通）
+WRITE_METHODS = frozenset({
+    "append_row", "append_rows", "update", "update_cell", "update_acell", "batch_update",
+    "delete_rows", "insert_row", "insert_rows", "clear", "batch_clear",
+    "apply_mutation", "spreadsheet_batch_update", "replace_all",
+})
+
+
+class InvalidatingTable:
+    def __init__(self, table, snapshots, names):
+        self._table = table
+        self._snapshots = snapshots
+        self._names = names
+
+    def __getattr__(self, name):
+        attr = getattr(self._table, name)
+        if name not in WRITE_METHODS:
+            return attr
+
+        def call(*args, **kwargs):
+            try:
+                return attr(*args, **kwargs)
+            finally:
+                # 失敗しても途中まで書かれている可能性があるので必ず捨てる
+                for snapshot in self._names:
+                    self._snapshots.invalidate(snapshot)
+        return call
+
+    def with_priority(self, priority):
+        return InvalidatingTable(with_priority(self._table, priority), self._snapshots, self._names)
+
+
+snapshots = SharedSnapshots()
@@ -1,29 +1,46 @@
 import os
 import json
-import gspread
-from google.oauth2.service_account import Credentials
-from datetime import datetime
 from datetime import datetime
 
-# 環境変数から認証情報を読み込み
-credentials_info = json.loads(os.environ["GOOGLE_CREDENTIALS_JSON"])
-scopes = ["https://www.googleapis.com/auth/spreadsheets"]
-credentials = Credentials.from_service_account_info(credentials_info, scopes=scopes)
-gc = gspread.authorize(credentials)
+from storage import open_storage, find_rows, USERS, IDT_RECORDS
 
-# users用スプレッドシートに接続
+# users用スプレッドシート・database用スプレッドシート（STORAGE_BACKEND=sqlite なら SQLITE_PATH を使う）
 USERS_SPREADSHEET_URL = "https://docs.google.com/spreadsheets/d/1wZR1Tdupldp0RVOm00QAbE9-muz47unt_WhxagdirFA/edit"
-users_spreadsheet = gc.open_by_url(USERS_SPREADSHEET_URL)
-users_ws = users_spreadsheet.worksheet("users")  # 認証情報シート
-
-# database用スプレッドシートに接続
 DATABASE_SPREADSHEET_URL = "https://docs.google.com/spreadsheets/d/11ZlpV2yl9aA3gxpS-JhBxgNniaxlDP1NO_4XmpGvg54/edit"
-database_spreadsheet = gc.open_by_url(DATABASE_SPREADSHEET_URL)
-data_ws = database_spreadsheet.worksheet("database")  # 記録データシート
+
+
+def _credentials():
+    # 認証情報は Google Sheets を使うときだけ読み込む
+    if os.environ.get("STORAGE_BACKEND", "sheets") == "sqlite":
+        return None
+    from google.oauth2.service_account import Credentials
+    credentials_info = json.loads(os.environ["GOOGLE_CREDENTIALS_JSON"])
+    scopes = ["https://www.googleapis.com/auth/spreadsheets"]
+    return Credentials.from_service_account_info(credentials_info, scopes=scopes)
+
+
+storage = open_storage(USERS_SPREADSHEET_URL, DATABASE_SPREADSHEET_URL, credentials=_credentials())
+users_ws = storage.table(USERS)  # 認証情報シート
+data_ws = storage.table(IDT_RECORDS)  # 記録データシート
+
+
+def _records(table):
+    # gspread の get_all_records と同じく、ヘッダーをキーにした dict のリスト
+    rows = table.get_all_values()
+    if not rows:
+        return []
+    header = rows[0]
+    return [dict(zip(header, row)) for row in rows[1:]]
+
+
+def _find_user_row(name):
+    # users の1列目は name（SQLite では索引で引く）
+    found = find_rows(users_ws, name)
+    return found[0][0] if found else None
 
 # 指定ユーザーの認証チェック
 def check_credentials(name, key):
-    records = users_ws.get_all_records()
+    records = _records(users_ws)
     for row in records:
         if row['name'] == name and row['key'] == key:
             return True
@@ -31,28 +48,29 @@ def check_credentials(name, key):
 
 # 最終ログイン時間を更新
 def update_login_time(name):
-    cell = users_ws.find(name)
-    if cell:
-        users_ws.update_cell(cell.row, 3, datetime.now().isoformat())
+    row = _find_user_row(name)
+    if row:
+        users_ws.update_cell(row, 3, datetime.now().isoformat())
 
 # 最終ログイン時間を取得
 def get_last_login_time(name):
-    cell = users_ws.find(name)
-    if cell:
-        return users_ws.cell(cell.row, 3).value
+    row = _find_user_row(name)
+    if row:
+        values = users_ws.row_values(row)
+        return values[2] if len(values) >= 3 else None
     return None
 
 def get_user_key_map():
-    records = users_ws.get_all_records()
+    records = _records(users_ws)
     return {row['name']: row['key'] for row in records}
 
 
 def update_last_auth(name):
     try:
-        cell = users_ws.find(name)
-        if cell:
+        row = _find_user_row(name)
+        if row:
             # 例: 3列目に最終認証日時をISOフォーマットで記録
-            users_ws.update_cell(cell.row, 3, datetime.now().isoformat())
+            users_ws.update_cell(row, 3, datetime.now().isoformat())
     except Exception as e:
         print(f"Failed to update last auth for {name}: {e}")
 
@@ -0,0 +1,280 @@
+# sheets_quota.py
+# Google Sheets API の呼び出しを読み取り・書き込みのクォータ内に収めるスケジューラ
+#
+# Sheets API の上限は「1ユーザー（サービスアカウント）あたり毎分 読み取り60回・書き込み60回」。
+# 各呼び出しはトークンバケットからトークンを取ってから実行し、足りなければ優先度順に待つ。
+# 429 が返ったら Retry-After（なければ指数バックオフ）の間そのバケット全体を止めて再試行する。
+#
+#   SHEETS_READ_QUOTA / SHEETS_WRITE_QUOTA   "回数/秒" (既定 "60/60")
+#   WEB_CONCURRENCY                          gunicorn のワーカー数。クォータをワーカー数で割る
+
+import heapq
+import itertools
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+import event_dedup
+
+READ = "read"
+WRITE = "write"
+
+# 優先度（小さいほど先）
+PRIORITY_USER = 0          # ユーザーへの返信に必要な読み書き
+PRIORITY_BACKGROUND = 1    # last_auth の書き戻し・同期など
+PRIORITY_REFRESH = 2       # キャッシュの読み直し
+
+# ユーザー向けの呼び出しはこれ以上待たせずに失敗させる
+USER_WAIT_TIMEOUT = float(os.environ.get("SHEETS_USER_WAIT_TIMEOUT", "20"))
+MAX_RETRIES = 5
+MAX_BACKOFF_SECONDS = 32
+# この間隔ごとに待ち状況をログに出す
+STATS_LOG_SECONDS = 60
+
+
+def _parse_quota(value, workers):
+    count, per = value.split("/")
+    return max(float(count) / workers, 1.0), float(per)
+
+
+class QuotaTimeout(Exception):
+    """Raised when a call could not get quota within its wait limit."""
+
+
+class _Bucket:
+    def __init__(self, count, per):
+        self.capacity = count
+        self.tokens = count
+        self.rate = count / per
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0   # 429 を受けたらこの時刻まで出さない
+
+    def wait_time(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+
+class QuotaScheduler:
+    def __init__(self, read_quota, write_quota):
+        self._buckets = {READ: _Bucket(*read_quota), WRITE: _Bucket(*write_quota)}
+        self._waiters = {READ: [], WRITE: []}   # heap of (priority, virtual time, seq)
+        # テナント（partition）ごとの公平な順番: 各呼び出しに仮想時刻を振り、同じ優先度なら小さい順に通す。
+        # 連続して呼ぶ partition の仮想時刻は先へ進むので、他の partition の呼び出しが割り込める。
+        self._clock = {READ: 0, WRITE: 0}
+        self._next_vtime = {}                    # (kind, partition) -> 次の仮想時刻
+        self._cond = threading.Condition()
+        self._seq = itertools.count()
+        self._local = threading.local()
+        self._logged_at = time.monotonic()
+        self.counters = {
+            "calls": 0, "waited": 0, "wait_seconds": 0.0, "max_wait_seconds": 0.0,
+            "max_queue_depth": 0, "throttled": 0, "timeouts": 0,
+        }
+
+    @contextmanager
+    def priority(self, priority):
+        """Runs the block's Sheets calls (in this thread) at `priority`."""
+        previous = getattr(self._local, "priority", None)
+        self._local.priority = priority
+        try:
+            yield
+        finally:
+            self._local.priority = previous
+
+    def _current_priority(self, priority):
+        if priority is not None:
+            return priority
+        current = getattr(self._local, "priority", None)
+        return PRIORITY_USER if current is None else current
+
+    def _virtual_time(self, kind, partition):
+        key = (kind, partition)
+        vtime = max(self._next_vtime.get(key, 0), self._clock[kind])
+        self._next_vtime[key] = vtime + 1
+        return vtime
+
+    def acquire(self, kind, priority=PRIORITY_USER, partition=None):
+        bucket = self._buckets[kind]
+        waiters = self._waiters[kind]
+        started = time.monotonic()
+        deadline = started + USER_WAIT_TIMEOUT if priority == PRIORITY_USER else None
+        with self._cond:
+            me = (priority, self._virtual_time(kind, partition), next(self._seq))
+            heapq.heappush(waiters, me)
+            self.counters["max_queue_depth"] = max(self.counters["max_queue_depth"], len(waiters))
+            try:
+                while True:
+                    now = time.monotonic()
+                    wait = None
+                    if waiters[0] == me:
+                        wait = bucket.wait_time(now)
+                        if wait <= 0:
+                            bucket.tokens -= 1
+                            heapq.heappop(waiters)
+                            self._clock[kind] = max(self._clock[kind], me[1])
+                            self._cond.notify_all()
+                            break
+                    if deadline is not None:
+                        if now >= deadline:
+                            self.counters["timeouts"] += 1
+                            raise QuotaTimeout(f"Sheets {kind} quota wait exceeded {USER_WAIT_TIMEOUT}s")
+                        wait = min(wait, deadline - now) if wait is not None else deadline - now
+                    self._cond.wait(wait)
+            finally:
+                if me in waiters:
+                    waiters.remove(me)
+                    heapq.heapify(waiters)
+                    self._cond.notify_all()
+            waited = time.monotonic() - started
+            self.counters["calls"] += 1
+            if waited > 0.001:
+                self.counters["waited"] += 1
+                self.counters["wait_seconds"] += waited
+                self.counters["max_wait_seconds"] = max(self.counters["max_wait_seconds"], waited)
+        self._maybe_log()
+
+    def _throttle(self, kind, delay):
+        with self._cond:
+            bucket = self._buckets[kind]
+            bucket.blocked_until = max(bucket.blocked_until, time.monotonic() + delay)
+            bucket.tokens = min(bucket.tokens, 0)
+            self.counters["throttled"] += 1
+            self._cond.notify_all()
+
+    def call(self, kind, fn, *args, priority=None, partition=None, **kwargs):
+        """Runs fn(*args, **kwargs) once quota allows, retrying on 429. Partitions share the quota fairly."""
+        priority = self._current_priority(priority)
+        for attempt in range(MAX_RETRIES + 1):
+            self.acquire(kind, priority, partition)
+            try:
+                return fn(*args, **kwargs)
+            except Exception as e:
+                delay = _retry_after(e)
+                if delay is None or attempt == MAX_RETRIES:
+                    raise
+                if delay == 0:
+                    delay = min(2 ** attempt, MAX_BACKOFF_SECONDS) + random.random()
+                print(f"Sheets {kind} quota exceeded; retrying in {delay:.1f}s")
+                self._throttle(kind, delay)
+
+    def stats(self):
+        with self._cond:
+            stats = dict(self.counters)
+            stats["queue_depth"] = {kind: len(w) for kind, w in self._waiters.items()}
+            stats["tokens"] = {kind: round(b.tokens, 2) for kind, b in self._buckets.items()}
+        stats["avg_wait_seconds"] = stats["wait_seconds"] / stats["waited"] if stats["waited"] else 0.0
+        return stats
+
+    def _maybe_log(self):
+        now = time.monotonic()
+        if now - self._logged_at < STATS_LOG_SECONDS:
+            return
+        self._logged_at = now
+        s = self.stats()
+        if s["waited"] or s["throttled"]:
+            print(
+                f"Sheets quota: calls={s['calls']} waited={s['waited']} avg_wait={s['avg_wait_seconds']:.2f}s "
+                f"max_wait={s['max_wait_seconds']:.2f}s max_queue={s['max_queue_depth']} "
+                f"throttled={s['throttled']} timeouts={s['timeouts']}"
+            )
+
+
+def _retry_after(error):
+    """Seconds to wait for a quota error (0 = use backoff), or None if `error` is not retryable."""
+    response = getattr(error, "response", None)
+    status = getattr(response, "status_code", None)
+    if status not in (429, 503):
+        return None
+    try:
+        return float(response.headers.get("Retry-After", 0))
+    except (TypeError, ValueError):
+        return 0
+
+
+# gspread Worksheet のメソッドを読み取り・書き込みに分類する
+READ_METHODS = frozenset({
+    "get_all_values", "get_all_records", "get_values", "get", "row_values", "col_values",
+    "cell", "find", "findall", "batch_get", "acell",
+})
+WRITE_METHODS = frozenset({
+    "append_row", "append_rows", "update", "update_cell", "update_acell", "batch_update",
+    "delete_rows", "insert_row", "insert_rows", "clear", "batch_clear", "resize",
+})
+
+
+class QuotaTable:
+    """
+    Wraps a gspread Worksheet so every API call goes through the scheduler.
+    Attributes that are not API calls (id, title, ...) are passed through.
+    """
+
+    def __init__(self, worksheet, scheduler, priority=None, breaker=None, partition=None):
+        self._worksheet = worksheet
+        self._scheduler = scheduler
+        self._priority = priority
+        self._breaker = breaker       # circuit_breaker.CircuitBreaker（任意）
+        self._partition = partition   # テナントごとにクォータを公平に分ける単位（任意）
+
+    def _call(self, kind, fn, *args, **kwargs):
+        options = {"priority": self._priority, "partition": self._partition}
+        if kind == WRITE:
+            # 書き込みを出したイベントは、失敗しても再送で処理し直さない（event_dedup.py）
+            event_dedup.note_write()
+        if self._breaker is None:
+            return self._scheduler.call(kind, fn, *args, **options, **kwargs)
+        # 止まっている間はクォータも消費せずにすぐ失敗させる
+        return self._breaker.call(self._scheduler.call, kind, fn, *args, **options, **kwargs)
+
+    def __getattr__(self, name):
+        attr = getattr(self._worksheet, name)
+        if name in READ_METHODS:
+            kind = READ
+        elif name in WRITE_METHODS:
+            kind = WRITE
+        else:
+            return attr
+
+        def call(*args, **kwargs):
+            return self._call(kind, attr, *args, **kwargs)
+        return call
+
+    @property
+    def worksheet(self):
+        return self._worksheet
+
+    def with_priority(self, priority):
+        return QuotaTable(self._worksheet, self._scheduler, priority, self._breaker, self._partition)
+
+    def spreadsheet_batch_update(self, body):
+        """spreadsheets.batchUpdate on the worksheet's spreadsheet (one write)."""
+        return self._call(WRITE, self._worksheet.spreadsheet.batch_update, body)
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def get_scheduler():
+    """Process-wide scheduler built from the environment."""
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            workers = max(int(os.environ.get("WEB_CONCURRENCY", "1") or 1), 1)
+            _scheduler = QuotaScheduler(
+                _parse_quota(os.environ.get("SHEETS_READ_QUOTA", "60/60"), workers),
+                _parse_quota(os.environ.get("SHEETS_WRITE_QUOTA", "60/60"), workers),
+            )
+        return _scheduler
+
+
+def with_priority(table, priority):
+    """Returns a view of `table` whose calls run at `priority` (tables without quota are returned as is)."""
+    method = getattr(table, "with_priority", None)
+    return method(priority) if method else table
@@ -0,0 +1,53 @@
+# singleflight.py
+# 同じキーの重い処理が同時に呼ばれた場合、1回だけ実行して結果を共有する
+
+import threading
+
+
+class _Call:
+    __slots__ = ("done", "result", "error")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.counters = {"executed": 0, "shared": 0}
+
+    def do(self, key, fn, *args, **kwargs):
+        """
+        Runs fn(*args, **kwargs) unless a call with the same key is already
+        in flight, in which case it waits for that call and returns its result
+        (or re-raises its exception). Results are not cached after the call ends.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            if call is not None:
+                self.counters["shared"] += 1
+                leader = False
+            else:
+                call = self._calls[key] = _Call()
+                self.counters["executed"] += 1
+                leader = True
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn(*args, **kwargs)
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            call.done.set()
@@ -0,0 +1,464 @@
+# storage.py
+# ユーザー・停止リスト・申請禁止・IDT記録などの保存先を切り替えられるようにする層
+#
+# どのバックエンドも table(name) で「表」を返す。表は main.py が使っている
+# gspread Worksheet の操作だけを持つ:
+#   get_all_values / get / batch_get / row_values / append_row / update_cell / batch_update / delete_rows
+# 行番号は gspread と同じく 1 始まり（1行目がヘッダー）。
+#
+# 1人分・1件分だけ探すときは find_rows(table, value) を使う。どの表も1列目がキー
+# （停止リスト・申請禁止・潮位配信は user_id、IDT記録は名前）で、SQLite ではその列に索引がある。
+#
+# SQLite の表はスプレッドシートと同じ行番号で扱えるように、行を (表, 行番号) ごとの JSON で持つ。
+# そのため delete_rows は後ろの行の番号を詰め直す（消した行より後ろの行数に比例する）。
+# users のように全体を使う表は、main.py が共有スナップショットとして一定時間使い回す。
+#
+#   STORAGE_BACKEND=sheets (既定)  Google スプレッドシート
+#   STORAGE_BACKEND=sqlite          ローカルの SQLite (SQLITE_PATH)
+
+import datetime
+import json
+import os
+import re
+import sqlite3
+import threading
+
+import event_dedup
+from circuit_breaker import breaker
+from sheets_quota import QuotaTable, QuotaTimeout, get_scheduler
+
+# 論理的な表の名前
+USERS = "users"
+IDT_RECORDS = "database"
+ADMIN_RECORDS = "admin_database"
+
+# Sheets API 1回あたりの HTTP タイムアウト
+SHEETS_TIMEOUT_SECONDS = float(os.environ.get("SHEETS_TIMEOUT_SECONDS", "10"))
+
+_A1_RE = re.compile(r"^([A-Z]+)(\d+)$")
+_RANGE_RE = re.compile(r"^([A-Z]+\d+):([A-Z]+)(\d*)$")
+
+
+def a1_to_rowcol(label):
+    match = _A1_RE.match(label.upper())
+    if not match:
+        raise ValueError(f"Invalid A1 cell: {label}")
+    letters, row = match.groups()
+    col = 0
+    for ch in letters:
+        col = col * 26 + (ord(ch) - ord("A") + 1)
+    return int(row), col
+
+
+def rowcol_to_a1(row, col):
+    letters = ""
+    while col > 0:
+        col, rem = divmod(col - 1, 26)
+        letters = chr(ord("A") + rem) + letters
+    return f"{letters}{row}"
+
+
+def parse_range(label):
+    """Parses "A5:H9" or an open-ended "A5:H" into (first_row, first_col, last_row or None, last_col)."""
+    match = _RANGE_RE.match(label.upper())
+    if not match:
+        raise ValueError(f"Invalid A1 range: {label}")
+    start, end_letters, end_row = match.groups()
+    first_row, first_col = a1_to_rowcol(start)
+    _, last_col = a1_to_rowcol(f"{end_letters}1")
+    return first_row, first_col, int(end_row) if end_row else None, last_col
+
+
+class ConflictError(Exception):
+    """Raised when a table changed between the snapshot and apply_mutation()."""
+
+
+class RowMutation:
+    """
+    A set of cell updates and row deletions computed against one snapshot.
+    Row numbers refer to the snapshot. The key column of the snapshot is the
+    version check: apply_mutation() fails with ConflictError if it changed.
+    """
+
+    def __init__(self, snapshot, key_column):
+        header = [h.strip() for h in snapshot[0]] if snapshot else []
+        self.key_col = header.index(key_column) + 1
+        self.expected_keys = _strip_trailing([row[self.key_col - 1] if len(row) >= self.key_col else "" for row in snapshot[1:]])
+        self.cells = []           # (row, col, value)
+        self.deleted_rows = set()
+
+    def set_cell(self, row, col, value):
+        self.cells.append((row, col, value))
+
+    def delete_row(self, row):
+        self.deleted_rows.add(row)
+
+    @property
+    def empty(self):
+        return not self.cells and not self.deleted_rows
+
+
+def _strip_trailing(values):
+    values = list(values)
+    while values and values[-1] == "":
+        values.pop()
+    return values
+
+
+_NUMBER_RE = re.compile(r"^[+-]?(\d+\.?\d*|\.\d+)$")
+_DATETIME_RE = re.compile(r"^(\d{4})/(\d{2})/(\d{2})(?: (\d{2}):(\d{2})(?::(\d{2}))?)?$")
+# Sheets の日付シリアル値の起点
+_SHEETS_EPOCH = datetime.datetime(1899, 12, 30)
+# 日付の部分の数 -> 表示形式（入力と同じ形で読み戻せるように）
+_DATE_FORMATS = {
+    3: {"type": "DATE", "pattern": "yyyy/mm/dd"},
+    5: {"type": "DATE_TIME", "pattern": "yyyy/mm/dd hh:mm"},
+    6: {"type": "DATE_TIME", "pattern": "yyyy/mm/dd hh:mm:ss"},
+}
+
+
+def user_entered_cell(value):
+    """
+    (CellData, fields) for writing `value` with updateCells the way
+    USER_ENTERED input (update_cell / batch_update) would store it:
+    formulas, numbers, and "YYYY/MM/DD[ HH:MM[:SS]]" as a date serial with
+    the same display format. Anything else is stored as text.
+    """
+    text = str(value)
+    if text.startswith("="):
+        return {"userEnteredValue": {"formulaValue": text}}, "userEnteredValue"
+    if _NUMBER_RE.match(text):
+        return {"userEnteredValue": {"numberValue": float(text)}}, "userEnteredValue"
+    match = _DATETIME_RE.match(text)
+    if match:
+        parts = [int(p) for p in match.groups() if p is not None]
+        try:
+            when = datetime.datetime(*parts)
+        except ValueError:
+            return {"userEnteredValue": {"stringValue": text}}, "userEnteredValue"
+        cell = {
+            "userEnteredValue": {"numberValue": (when - _SHEETS_EPOCH).total_seconds() / 86400},
+            "userEnteredFormat": {"numberFormat": _DATE_FORMATS[len(parts)]},
+        }
+        return cell, "userEnteredValue,userEnteredFormat.numberFormat"
+    return {"userEnteredValue": {"stringValue": text}}, "userEnteredValue"
+
+
+def apply_mutation(table, mutation):
+    """
+    Applies `mutation` to `table` in a single write.
+    On SQLite the check and the write share one transaction. On Sheets the
+    check is best effort: the key column is re-read just before the
+    batchUpdate, and a change landing between those two calls (one round
+    trip) is not detected, as the Sheets API has no conditional writes.
+    """
+    # SqliteTable（およびそれを包んだ表）は自前のトランザクションで反映する
+    if hasattr(table, "apply_mutation"):
+        table.apply_mutation(mutation)
+        return
+    # Google Sheets: 確認から書き込みまでの間を短くするため、リクエストは先に組み立てておく
+    requests = []
+    for row, col, value in mutation.cells:
+        cell, fields = user_entered_cell(value)
+        requests.append({"updateCells": {
+            "range": {"sheetId": table.id, "startRowIndex": row - 1, "endRowIndex": row,
+                      "startColumnIndex": col - 1, "endColumnIndex": col},
+            "rows": [{"values": [cell]}],
+            "fields": fields,
+        }})
+    # 下の行から消せば、上の行番号はずれない
+    for row in sorted(mutation.deleted_rows, reverse=True):
+        requests.append({"deleteDimension": {
+            "range": {"sheetId": table.id, "dimension": "ROWS", "startIndex": row - 1, "endIndex": row},
+        }})
+    # キー列だけ読み直して確認し、1回の batchUpdate で反映する
+    current = _strip_trailing(table.col_values(mutation.key_col)[1:])
+    if current != mutation.expected_keys:
+        raise ConflictError(f"{table.title} changed since the snapshot")
+    table.spreadsheet_batch_update({"requests": requests})
+
+
+def find_rows(table, value):
+    """
+    [(row number, values)] of the data rows whose first column is `value`.
+    Uses the SQLite index where there is one; on Sheets the table is read.
+    """
+    if hasattr(table, "find_rows"):
+        return table.find_rows(value)
+    return [(i, row) for i, row in enumerate(table.get_all_values()[1:], start=2) if row and row[0] == value]
+
+
+def sheets_breaker(partition=None):
+    """The circuit breaker for Sheets calls (one per tenant partition)."""
+    name = "sheets" if partition is None else f"sheets:{partition}"
+    return breaker(name, ignore=(QuotaTimeout,))
+
+
+class SheetsBackend:
+    """
+    Google Sheets backend. Tables are the gspread worksheets wrapped in
+    QuotaTable, so every API call waits for the shared read/write quota
+    and fails fast while the "sheets" circuit breaker is open.
+    """
+
+    name = "sheets"
+
+    def __init__(self, client, user_db_url, idt_record_url, admin_record_url=None, partition=None):
+        self.client = client
+        self.user_db = client.open_by_url(user_db_url)
+        self.idt_record_url = idt_record_url
+        self.admin_record_url = admin_record_url
+        self.partition = partition   # テナント（tenants.py）ごとにクォータ・遮断器を分ける
+        self._tables = {}
+
+    @property
+    def has_admin_records(self):
+        return bool(self.admin_record_url)
+
+    def reset_connections(self):
+        # fork 前に開いた HTTP 接続を子プロセスで使い回さない（次の呼び出しで張り直す）
+        http = getattr(self.client, "http_client", self.client)
+        session = getattr(http, "session", None)
+        if session is not None:
+            session.close()
+
+    def table(self, name, header=None, rows=100):
+        table = self._tables.get(name)
+        if table is not None:
+            return table
+        import gspread
+        if name == USERS:
+            table = self.user_db.worksheet("users")
+        elif name == IDT_RECORDS:
+            table = self.client.open_by_url(self.idt_record_url).worksheet("database")
+        elif name == ADMIN_RECORDS:
+            table = self.client.open_by_url(self.admin_record_url).worksheet("database")
+        else:
+            try:
+                table = self.user_db.worksheet(name)
+            except gspread.exceptions.WorksheetNotFound:
+                table = self.user_db.add_worksheet(title=name, rows=rows, cols=len(header or []) or 4)
+                if header:
+                    table.append_row(header)
+        table = self._tables[name] = QuotaTable(
+            table, get_scheduler(), breaker=sheets_breaker(self.partition), partition=self.partition)
+        return table
+
+
+class SqliteTable:
+    """
+    One logical sheet stored in SQLite. Rows are kept with their 1-based
+    position so row numbers behave like the spreadsheet's.
+    """
+
+    def __init__(self, backend, name):
+        self.backend = backend
+        self.name = name
+        self.title = name
+
+    def _query(self, sql, params=()):
+        return self.backend.query(sql, params)
+
+    def get_all_values(self):
+        rows = [json.loads(data) for (data,) in self._query("SELECT data FROM sheet_rows WHERE sheet = ? ORDER BY pos", (self.name,))]
+        # gspread と同様に行の長さをそろえる
+        width = max((len(r) for r in rows), default=0)
+        return [r + [""] * (width - len(r)) for r in rows]
+
+    def get(self, range_name):
+        """Values in an A1 range; trailing empty cells and rows are dropped as in gspread."""
+        first_row, first_col, last_row, last_col = parse_range(range_name)
+        sql = "SELECT pos, data FROM sheet_rows WHERE sheet = ? AND pos >= ?"
+        params = [self.name, first_row]
+        if last_row is not None:
+            sql += " AND pos <= ?"
+            params.append(last_row)
+        rows = []
+        for pos, data in self._query(sql + " ORDER BY pos", params):
+            # 空の行は記録されていないことがあるので行番号をそろえる
+            rows.extend([] for _ in range(pos - first_row - len(rows)))
+            rows.append(_strip_trailing(json.loads(data)[first_col - 1:last_col]))
+        while rows and not rows[-1]:
+            rows.pop()
+        return rows
+
+    def batch_get(self, ranges):
+        return [self.get(range_name) for range_name in ranges]
+
+    def row_values(self, row):
+        found = self._query("SELECT data FROM sheet_rows WHERE sheet = ? AND pos = ?", (self.name, row))
+        if not found:
+            return []
+        values = json.loads(found[0][0])
+        while values and values[-1] == "":
+            values.pop()
+        return values
+
+    def append_row(self, values, value_input_option=None):
+        values = ["" if v is None else str(v) for v in values]
+        with self.backend.transaction() as conn:
+            (last,) = conn.execute("SELECT COALESCE(MAX(pos), 0) FROM sheet_rows WHERE sheet = ?", (self.name,)).fetchone()
+            conn.execute("INSERT INTO sheet_rows (sheet, pos, data) VALUES (?, ?, ?)", (self.name, last + 1, json.dumps(values)))
+
+    def _set_cells(self, conn, cells):
+        for row, col, value in cells:
+            found = conn.execute("SELECT data FROM sheet_rows WHERE sheet = ? AND pos = ?", (self.name, row)).fetchone()
+            if found:
+                data = json.loads(found[0])
+            else:
+                data = []
+                conn.execute("INSERT INTO sheet_rows (sheet, pos, data) VALUES (?, ?, '[]')", (self.name, row))
+            if len(data) < col:
+                data.extend([""] * (col - len(data)))
+            data[col - 1] = "" if value is None else str(value)
+            conn.execute("UPDATE sheet_rows SET data = ? WHERE sheet = ? AND pos = ?", (json.dumps(data), self.name, row))
+
+    def update_cell(self, row, col, value):
+        with self.backend.transaction() as conn:
+            self._set_cells(conn, [(row, col, value)])
+
+    def batch_update(self, data, value_input_option=None):
+        # 単一セルの範囲（例: "E5"）のみ対応
+        cells = []
+        for item in data:
+            row, col = a1_to_rowcol(item["range"])
+            cells.append((row, col, item["values"][0][0]))
+        with self.backend.transaction() as conn:
+            self._set_cells(conn, cells)
+
+    def _delete(self, conn, start_index, end_index):
+        count = end_index - start_index + 1
+        conn.execute("DELETE FROM sheet_rows WHERE sheet = ? AND pos BETWEEN ? AND ?", (self.name, start_index, end_index))
+        # 後ろの行を詰める（主キーの衝突を避けるため一旦負数にしてから戻す）
+        conn.execute("UPDATE sheet_rows SET pos = -(pos - ?) WHERE sheet = ? AND pos > ?", (count, self.name, end_index))
+        conn.execute("UPDATE sheet_rows SET pos = -pos WHERE sheet = ? AND pos < 0", (self.name,))
+
+    def delete_rows(self, start_index, end_index=None):
+        with self.backend.transaction() as conn:
+            self._delete(conn, start_index, end_index or start_index)
+
+    def find_rows(self, value):
+        # 1列目の索引（sheet_rows_key）で引く
+        found = self._query(
+            "SELECT pos, data FROM sheet_rows INDEXED BY sheet_rows_key"
+            " WHERE sheet = ? AND json_extract(data, '$[0]') = ? AND pos >= 2 ORDER BY pos",
+            (self.name, value),
+        )
+        return [(pos, json.loads(data)) for pos, data in found]
+
+    def col_values(self, col):
+        values = [json.loads(data) for (data,) in self._query("SELECT data FROM sheet_rows WHERE sheet = ? ORDER BY pos", (self.name,))]
+        return _strip_trailing([row[col - 1] if len(row) >= col else "" for row in values])
+
+    def apply_mutation(self, mutation):
+        with self.backend.transaction() as conn:
+            rows = conn.execute("SELECT data FROM sheet_rows WHERE sheet = ? AND pos >= 2 ORDER BY pos", (self.name,)).fetchall()
+            col = mutation.key_col
+            data_rows = [json.loads(d) for (d,) in rows]
+            current = _strip_trailing([r[col - 1] if len(r) >= col else "" for r in data_rows])
+            if current != mutation.expected_keys:
+                raise ConflictError(f"{self.name} changed since the snapshot")
+            self._set_cells(conn, mutation.cells)
+            for row in sorted(mutation.deleted_rows, reverse=True):
+                self._delete(conn, row, row)
+
+    def replace_all(self, rows):
+        """Replaces the whole table (used by the sync tool)."""
+        with self.backend.transaction() as conn:
+            conn.execute("DELETE FROM sheet_rows WHERE sheet = ?", (self.name,))
+            conn.executemany(
+                "INSERT INTO sheet_rows (sheet, pos, data) VALUES (?, ?, ?)",
+                [(self.name, i, json.dumps([str(v) for v in row])) for i, row in enumerate(rows, start=1)],
+            )
+
+
+class _Transaction:
+    def __init__(self, backend):
+        self.backend = backend
+
+    def __enter__(self):
+        # 書き込みを出したイベントは、失敗しても再送で処理し直さない（event_dedup.py）
+        event_dedup.note_write()
+        self.backend._lock.acquire()
+        try:
+            conn = self.backend.connection()
+            conn.execute("BEGIN IMMEDIATE")
+        except Exception:
+            self.backend._lock.release()
+            raise
+        return conn
+
+    def __exit__(self, exc_type, exc, tb):
+        conn = self.backend.connection()
+        try:
+            conn.execute("ROLLBACK" if exc_type else "COMMIT")
+        finally:
+            self.backend._lock.release()
+        return False
+
+
+class SqliteBackend:
+    """Local SQLite backend. Safe to share between gunicorn workers on one host."""
+
+    name = "sqlite"
+
+    def __init__(self, path, has_admin_records=True):
+        self.path = path
+        self.has_admin_records = has_admin_records
+        self._lock = threading.RLock()
+        self._conn = None
+        self._pid = None
+        self._tables = {}
+
+    def connection(self):
+        # fork 後のワーカーでは接続を開き直す
+        if self._conn is None or self._pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=10, check_same_thread=False, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS sheet_rows ("
+                " sheet TEXT NOT NULL, pos INTEGER NOT NULL, data TEXT NOT NULL,"
+                " PRIMARY KEY (sheet, pos))"
+            )
+            # 1列目（user_id・名前などのキー）で1件を探すための索引
+            conn.execute("CREATE INDEX IF NOT EXISTS sheet_rows_key ON sheet_rows (sheet, json_extract(data, '$[0]'))")
+            self._conn = conn
+            self._pid = os.getpid()
+        return self._conn
+
+    def reset_connections(self):
+        # 親プロセスの接続は閉じずに手放す（connection() が開き直す）
+        if self._pid != os.getpid():
+            self._conn = None
+            self._pid = None
+
+    def query(self, sql, params=()):
+        with self._lock:
+            return self.connection().execute(sql, params).fetchall()
+
+    def transaction(self):
+        return _Transaction(self)
+
+    def table(self, name, header=None, rows=100):
+        table = self._tables.get(name)
+        if table is None:
+            table = self._tables[name] = SqliteTable(self, name)
+            if header and not table.row_values(1):
+                table.append_row(header)
+        return table
+
+
+def open_storage(user_db_url, idt_record_url, admin_record_url=None, credentials=None, sqlite_path=None, partition=None):
+    """
+    Creates the backend selected by STORAGE_BACKEND.
+    `credentials` (google.oauth2 Credentials) is only needed for Sheets.
+    `sqlite_path` defaults to SQLITE_PATH; `partition` separates tenants'
+    Sheets quota share and circuit breaker.
+    """
+    backend = os.environ.get("STORAGE_BACKEND", "sheets")
+    if backend == "sqlite":
+        return SqliteBackend(sqlite_path or os.environ.get("SQLITE_PATH", "bot.db"), has_admin_records=bool(admin_record_url))
+    import gspread
+    client = gspread.authorize(credentials)
+    client.set_timeout(SHEETS_TIMEOUT_SECONDS)
+    return SheetsBackend(client, user_db_url, idt_record_url, admin_record_url, partition=partition)
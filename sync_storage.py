@@ -0,0 +1,109 @@
+# sync_storage.py
+# SQLite バックエンドと Google スプレッドシートの内容を同期するツール
+#
+#   python sync_storage.py export   SQLite → スプレッドシート（人が見る用のミラーを更新）
+#   python sync_storage.py import   スプレッドシート → SQLite（移行・初期投入）
+#
+#   --tenant ID   TENANTS_JSON のクラブ（tenants.py）のシートと SQLite ファイル（bot_<id>.db など）を同期する
+#
+# GOOGLE_CREDENTIALS_JSON, SQLITE_PATH, IDT_RECORD_URL, ADMIN_RECORD_URL, TENANTS_JSON,
+# SUSPEND_SHEET_NAME は main.py と同じ環境変数を使う。
+
+import argparse
+import json
+import os
+import sys
+
+import tenants
+from storage import SheetsBackend, SqliteBackend, rowcol_to_a1, USERS, IDT_RECORDS, ADMIN_RECORDS
+
+
+class Target:
+    """The sheets and SQLite file of one club."""
+
+    def __init__(self, user_database_url, idt_record_url, admin_record_url, sqlite_path, partition=None):
+        self.user_database_url = user_database_url
+        self.idt_record_url = idt_record_url
+        self.admin_record_url = admin_record_url
+        self.sqlite_path = sqlite_path
+        self.partition = partition
+
+
+def target_for(tenant_id=None):
+    """The club to sync: the TENANTS_JSON entry `tenant_id`, or the single club of the environment."""
+    if tenant_id is None:
+        # LINE のトークンは要らないので、tenants._from_env() と同じ値を環境変数から直接読む
+        return Target(
+            tenants.DEFAULT_USER_DATABASE_URL,
+            os.environ.get("IDT_RECORD_URL", tenants.DEFAULT_IDT_RECORD_URL),
+            os.environ.get("ADMIN_RECORD_URL"),
+            os.environ.get("SQLITE_PATH", "bot.db"),
+        )
+    tenant = tenants.load_registry().get(tenant_id)
+    if tenant is None:
+        raise ValueError(f"テナント {tenant_id!r} は TENANTS_JSON に登録されていません。")
+    return Target(tenant.user_database_url, tenant.idt_record_url, tenant.admin_record_url,
+                  tenant.sqlite_path, tenant.partition)
+
+
+def table_names(target):
+    names = [USERS, IDT_RECORDS, os.environ.get("SUSPEND_SHEET_NAME", "suspend_list"), "admin_request_ban", "tide_subscribers"]
+    if target.admin_record_url:
+        names.append(ADMIN_RECORDS)
+    return names
+
+
+def open_backends(target):
+    import gspread
+    from google.oauth2.service_account import Credentials
+    credentials_json_str = os.environ.get("GOOGLE_CREDENTIALS_JSON")
+    if credentials_json_str is None:
+        raise ValueError("GOOGLE_CREDENTIALS_JSON が設定されていません。")
+    creds = Credentials.from_service_account_info(
+        json.loads(credentials_json_str),
+        scopes=["https://www.googleapis.com/auth/spreadsheets", "https://www.googleapis.com/auth/drive"],
+    )
+    sheets = SheetsBackend(gspread.authorize(creds), target.user_database_url, target.idt_record_url,
+                           target.admin_record_url, partition=target.partition)
+    sqlite = SqliteBackend(target.sqlite_path, has_admin_records=bool(target.admin_record_url))
+    return sheets, sqlite
+
+
+def export_to_sheets(sheets, sqlite, target):
+    for name in table_names(target):
+        rows = sqlite.table(name).get_all_values()
+        ws = sheets.table(name)
+        # 先に消すと、書き込みに失敗したときミラーが空になる。上書きしてから、はみ出た分だけ消す
+        old_rows = ws.get_all_values()
+        width = max([len(r) for r in rows + old_rows] or [0])
+        if rows:
+            padded = [r + [""] * (width - len(r)) for r in rows]
+            ws.update(range_name="A1", values=padded, value_input_option="USER_ENTERED")
+        if len(old_rows) > len(rows):
+            ws.batch_clear([f"A{len(rows) + 1}:{rowcol_to_a1(len(old_rows), width)}"])
+        print(f"exported {name}: {len(rows)} rows")
+
+
+def import_from_sheets(sheets, sqlite, target):
+    for name in table_names(target):
+        rows = sheets.table(name).get_all_values()
+        sqlite.table(name).replace_all(rows)
+        print(f"imported {name}: {len(rows)} rows")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Sync the SQLite storage backend with Google Sheets.")
+    parser.add_argument("direction", choices=["export", "import"])
+    parser.add_argument("--tenant", help="id of the club in TENANTS_JSON (default: the single club of the environment)")
+    args = parser.parse_args(argv)
+    target = target_for(args.tenant)
+    sheets, sqlite = open_backends(target)
+    if args.direction == "export":
+        export_to_sheets(sheets, sqlite, target)
+    else:
+        import_from_sheets(sheets, sqlite, target)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,135 @@
+# table.py
+# gspread の list[list[str]] スナップショットを列指向の表に変換する
+# 列番号の解決・文字列の intern・日付や数値の変換はスナップショットごとに一度だけ行う
+
+import datetime
+import sys
+import threading
+
+import pytz
+
+JST = pytz.timezone('Asia/Tokyo')
+
+
+def _intern(value):
+    # 同じ値（学年・性別・admin番号など）が大量に並ぶので共有する
+    return sys.intern(value) if len(value) <= 32 else value
+
+
+class SheetTable:
+    """
+    Column-oriented view of one sheet snapshot (header row + data rows).
+    Data rows are addressed by position (0-based); sheet_row(pos) gives the
+    1-based gspread row number.
+    """
+
+    __slots__ = ("header", "col", "columns", "size", "_indexes")
+
+    def __init__(self, values):
+        values = values or []
+        self.header = [_intern(h.strip()) for h in values[0]] if values else []
+        self.col = {name: i for i, name in enumerate(self.header)}
+        rows = values[1:]
+        self.size = len(rows)
+        width = len(self.header)
+        self.columns = [
+            [_intern(row[c]) if c < len(row) else "" for row in rows]
+            for c in range(width)
+        ]
+        self._indexes = {}
+
+    def __len__(self):
+        return self.size
+
+    def has(self, name):
+        return name in self.col
+
+    def column(self, name):
+        return self.columns[self.col[name]]
+
+    def get(self, pos, name):
+        return self.columns[self.col[name]][pos]
+
+    def row(self, pos):
+        return [column[pos] for column in self.columns]
+
+    @staticmethod
+    def sheet_row(pos):
+        return pos + 2
+
+    def find(self, name, value):
+        """Returns the first row position whose `name` column equals value, or None."""
+        index = self._indexes.get(name)
+        if index is None:
+            index = {}
+            for pos, v in enumerate(self.column(name)):
+                index.setdefault(v, pos)
+            self._indexes[name] = index
+        return index.get(value)
+
+    def find_all(self, **criteria):
+        """Yields row positions matching every name=value pair."""
+        cols = [(self.column(name), value) for name, value in criteria.items()]
+        for pos in range(self.size):
+            if all(column[pos] == value for column, value in cols):
+                yield pos
+
+
+class UsersTable(SheetTable):
+    """users シート。admin 番号は int（管理者でなければ None）に変換済み。"""
+
+    __slots__ = ("admin_numbers",)
+
+    def __init__(self, values):
+        super().__init__(values)
+        admin = self.column("admin") if self.has("admin") else [""] * self.size
+        self.admin_numbers = [int(v) if v.isdigit() else None for v in admin]
+
+    def find_user(self, user_id):
+        return self.find("user_id", user_id)
+
+    def admin_number(self, pos):
+        return self.admin_numbers[pos] if pos is not None else None
+
+
+class SuspendTable(SheetTable):
+    """suspend_list シート。until は JST の datetime（不正な値は None）に変換済み。"""
+
+    __slots__ = ("until",)
+
+    def __init__(self, values):
+        super().__init__(values)
+        self.until = [_parse_jst(v, "%Y/%m/%d %H:%M") for v in self.column("until")] if self.has("until") else []
+
+
+class BanTable(SheetTable):
+    """admin_request_ban シート。until は JST の datetime に変換済み。"""
+
+    __slots__ = ("until",)
+
+    def __init__(self, values):
+        super().__init__(values)
+        self.until = [_parse_jst(v, "%Y/%m/%d") for v in self.column("until")] if self.has("until") else []
+
+
+def _parse_jst(value, fmt):
+    try:
+        return datetime.datetime.strptime(value, fmt).replace(tzinfo=JST)
+    except (TypeError, ValueError):
+        return None
+
+
+# 直近に変換したスナップショットを覚えておき、同じリストなら再変換しない
+_cache = {}
+_cache_lock = threading.Lock()
+
+
+def table_for(values, cls=SheetTable):
+    with _cache_lock:
+        cached = _cache.get(cls)
+        if cached is not None and cached[0] is values:
+            return cached[1]
+    table = cls(values)
+    with _cache_lock:
+        _cache[cls] = (values, table)
+    return table
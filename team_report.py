@@ -0,0 +1,162 @@
+# team_report.py
+# チームのIDT集計レポートをバックグラウンドで作成し、データ版ごとにキャッシュする
+
+import contextvars
+import os
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+from idt_index import COL_NAME, COL_GRADE, COL_GENDER, COL_TIME, COL_WEIGHT
+from idt_parser import parse_time_str, calc_idt, round_score
+
+# 管理者記録シートの列: date, name, gender, time, weight, score
+ADMIN_COL_DATE, ADMIN_COL_NAME, ADMIN_COL_GENDER, ADMIN_COL_TIME, ADMIN_COL_WEIGHT = range(5)
+
+# LINEのテキストメッセージは5000文字まで
+MAX_REPORT_CHARS = 4800
+# 他ワーカーの追記を取り込むため、この秒数を過ぎたキャッシュは使わない
+CACHE_SECONDS = int(os.environ.get("REPORT_CACHE_SECONDS", "600"))
+
+
+def score_columns(times, weights, genders):
+    """
+    Scores whole columns at once. Returns a list of scores (None where the
+    row cannot be parsed), aligned with the input columns.
+    """
+    parsed_times = [parse_time_str(t.strip()) if t else None for t in times]
+    scores = []
+    for t, w, g in zip(parsed_times, weights, genders):
+        if t is None or not g or g.lower() not in ("m", "w"):
+            scores.append(None)
+            continue
+        try:
+            weight = float(w)
+        except (TypeError, ValueError):
+            scores.append(None)
+            continue
+        scores.append(round_score(calc_idt(t[0], t[1], t[2], weight, 0.0 if g.lower() == "m" else 1.0)))
+    return scores
+
+
+def _column(rows, col):
+    return [row[col] if len(row) > col else "" for row in rows]
+
+
+def aggregate(rows, key_cols, time_col, weight_col, gender_col):
+    """Returns {athlete_key: {"gender", "count", "best", "latest"}} for the given rows."""
+    scores = score_columns(_column(rows, time_col), _column(rows, weight_col), _column(rows, gender_col))
+    athletes = {}
+    for row, score in zip(rows, scores):
+        if score is None:
+            continue
+        key = tuple(row[c] for c in key_cols)
+        stats = athletes.get(key)
+        if stats is None:
+            athletes[key] = {"gender": row[gender_col].lower(), "count": 1, "best": score, "latest": score}
+        else:
+            stats["count"] += 1
+            stats["best"] = max(stats["best"], score)
+            stats["latest"] = score
+    return athletes
+
+
+def render_text(athletes, admin_athletes):
+    lines = ["📊 チームIDTレポート"]
+    for gender, label in (("m", "男子"), ("w", "女子")):
+        members = sorted(
+            ((key, s) for key, s in athletes.items() if s["gender"] == gender),
+            key=lambda item: item[1]["best"], reverse=True,
+        )
+        if not members:
+            continue
+        avg = sum(s["best"] for _, s in members) / len(members)
+        lines.append(f"\n【{label}】{len(members)}名 ベスト平均 {avg:.2f}%")
+        for rank, ((name, grade), s) in enumerate(members, start=1):
+            lines.append(f"{rank}. {name}({grade}) ベスト{s['best']:.2f}% 最新{s['latest']:.2f}% {s['count']}回")
+    if admin_athletes:
+        lines.append("\n【管理者登録分】")
+        for (name,), s in sorted(admin_athletes.items(), key=lambda item: item[1]["best"], reverse=True):
+            lines.append(f"{name} ベスト{s['best']:.2f}% {s['count']}回")
+    text = "\n".join(lines)
+    if len(text) > MAX_REPORT_CHARS:
+        text = text[:MAX_REPORT_CHARS] + "\n…（以下省略）"
+    return text
+
+
+class ReportService:
+    def __init__(self, idt_index, admin_sheet, push):
+        self.idt_index = idt_index
+        self.admin_sheet = admin_sheet
+        self.push = push                 # push(user_id, text)
+        self.cache = {}                  # data_version -> report text
+        self.built_at = None
+        self.dirty = True
+        self._waiters = []
+        self._running = False
+        self._lock = threading.Lock()
+        self._executor = None
+        self._pid = None
+
+    def _submit(self, fn):
+        # スレッドは fork を越えられないのでワーカーごとに作る
+        if self._executor is None or self._pid != os.getpid():
+            self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="team-report")
+            self._pid = os.getpid()
+        # 依頼したテナント（tenants.py）のまま作る
+        self._executor.submit(contextvars.copy_context().run, fn)
+
+    def invalidate(self):
+        # 記録を追加したら呼ぶ。次のリクエストでデータ版を確認し直す
+        self.dirty = True
+
+    def cached_report(self):
+        """Returns the last report if no record was added since and it is recent enough."""
+        if self.dirty or self.built_at is None:
+            return None
+        if time.monotonic() - self.built_at > CACHE_SECONDS:
+            return None
+        return next(iter(self.cache.values()), None)
+
+    def request(self, user_id):
+        """Queues a report for user_id. Returns False if a job was already running."""
+        with self._lock:
+            self._waiters.append(user_id)
+            if self._running:
+                return False
+            self._running = True
+        self._submit(self._run)
+        return True
+
+    def build(self):
+        self.dirty = False
+        self.idt_index.ensure_fresh()
+        entries = self.idt_index.all_entries()
+        admin_rows = self.admin_sheet.get_all_values() if self.admin_sheet else []
+        version = (self.idt_index.version, len(admin_rows))
+        text = self.cache.get(version)
+        if text is None:
+            idt_rows = [[e.name, e.grade, e.gender, e.date, e.time_str, e.weight] for e in entries]
+            athletes = aggregate(idt_rows, (COL_NAME, COL_GRADE), COL_TIME, COL_WEIGHT, COL_GENDER)
+            admin_athletes = aggregate(admin_rows, (ADMIN_COL_NAME,), ADMIN_COL_TIME, ADMIN_COL_WEIGHT, ADMIN_COL_GENDER)
+            text = render_text(athletes, admin_athletes)
+            self.cache = {version: text}
+        self.built_at = time.monotonic()
+        return text
+
+    def _run(self):
+        try:
+            text = self.build()
+        except Exception:
+            traceback.print_exc()
+            self.dirty = True
+            text = "レポートの作成に失敗しました。時間をおいて再試行してください。"
+        with self._lock:
+            waiters, self._waiters = self._waiters, []
+            self._running = False
+        for user_id in dict.fromkeys(waiters):
+            try:
+                self.push(user_id, text)
+            except Exception:
+                traceback.print_exc()
@@ -0,0 +1,247 @@
+# tenants.py
+# 1つのプロセスで複数のクラブ（LINE チャネル）を受け持つためのテナント登録
+#
+# TENANTS_JSON が無ければ従来どおり環境変数の1チャネルだけを扱う（テナント "default"）。
+# TENANTS_JSON には次の形のリスト（JSON 文字列、またはそのファイルのパス）を書く:
+#
+#   [{"id": "kc", "channel_access_token": "...", "channel_secret": "...",
+#     "user_database_url": "...", "idt_record_url": "...", "admin_record_url": "...",
+#     "destination": "U0123...", "export_token": "..."}, ...]
+#
+# destination（ボットのユーザーID）は任意。webhook は /callback/<id> か、本文の destination、
+# それも無ければ署名が合うチャネルでテナントを決める。
+# export_token（そのクラブの記録だけを /export で書き出すためのトークン）も任意で、無ければ書き出せない。
+#
+# テナントごとの状態（シート接続・キャッシュ・会話状態など）は tenant_local() で作り、
+# 処理中のテナント（current()）に応じて切り替える。current() は contextvars で持つので、
+# 処理中に起動したスレッドにテナントを引き継ぐには contextvars.copy_context() を使う。
+
+import contextvars
+import json
+import os
+import threading
+from contextlib import contextmanager
+
+from linebot import WebhookHandler, WebhookParser
+
+from shared_snapshot import SNAPSHOT_DIR
+
+# ユーザデータ用スプレッドシート（TENANTS_JSON を使わないときの既定値）
+DEFAULT_USER_DATABASE_URL = "https://docs.google.com/spreadsheets/d/1wZR1Tdupldp0RVOm00QAbE9-muz47unt_WhxagdirFA/"
+DEFAULT_IDT_RECORD_URL = "https://docs.google.com/spreadsheets/d/11ZlpV2yl9aA3gxpS-JhBxgNniaxlDP1NO_4XmpGvg54/edit"
+
+_current = contextvars.ContextVar("tenant", default=None)
+
+
+class Tenant:
+    def __init__(self, id, channel_access_token, channel_secret, user_database_url, idt_record_url,
+                 admin_record_url=None, destination=None, sqlite_path=None, state_dir=None, partition=None,
+                 export_token=None):
+        self.id = id
+        self.channel_access_token = channel_access_token
+        self.channel_secret = channel_secret
+        self.user_database_url = user_database_url
+        self.idt_record_url = idt_record_url
+        self.admin_record_url = admin_record_url
+        self.destination = destination
+        self.sqlite_path = sqlite_path
+        self.state_dir = state_dir       # スナップショット・保存ファイルなどの置き場所（None なら共通の場所）
+        self.partition = partition       # Sheets のクォータ・遮断器を分ける単位（None なら共通）
+        self.export_token = export_token # /export の bearer トークン（None なら書き出し不可）
+        self.webhook_parser = WebhookParser(channel_secret)
+        self.values = {}                 # TenantLocal -> そのテナントでの値
+        self.lock = threading.RLock()
+
+    @contextmanager
+    def activate(self):
+        """Makes this the current tenant for the block (and threads started with its context)."""
+        token = _current.set(self)
+        try:
+            yield self
+        finally:
+            _current.reset(token)
+
+    def iterate(self, iterable):
+        """Yields from `iterable`, producing each item with this tenant current (for streamed responses)."""
+        iterator = iter(iterable)
+        while True:
+            with self.activate():
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def __repr__(self):
+        return f"Tenant({self.id!r})"
+
+
+class Registry:
+    def __init__(self, tenants):
+        if not tenants:
+            raise ValueError("テナントが1つも登録されていません。")
+        self.tenants = list(tenants)
+        self._by_id = {t.id: t for t in self.tenants}
+        if len(self._by_id) != len(self.tenants):
+            raise ValueError("テナントの id が重複しています。")
+
+    def __iter__(self):
+        return iter(self.tenants)
+
+    def __len__(self):
+        return len(self.tenants)
+
+    def get(self, tenant_id):
+        return self._by_id.get(tenant_id)
+
+    def for_webhook(self, body, signature, tenant_id=None):
+        """
+        The tenant a webhook is for: the one named in the path, else the
+        one whose destination matches the body, else the only tenant whose
+        channel secret validates the signature. None if there is none.
+        """
+        if tenant_id is not None:
+            return self.get(tenant_id)
+        if len(self.tenants) == 1:
+            return self.tenants[0]
+        try:
+            destination = json.loads(body).get("destination")
+        except (ValueError, AttributeError):
+            destination = None
+        for tenant in self.tenants:
+            if destination and tenant.destination == destination:
+                return tenant
+        matches = [t for t in self.tenants if t.webhook_parser.signature_validator.validate(body, signature)]
+        return matches[0] if len(matches) == 1 else None
+
+
+def _from_env():
+    return Tenant(
+        "default",
+        os.environ["LINE_CHANNEL_ACCESS_TOKEN"],
+        os.environ["LINE_CHANNEL_SECRET"],
+        DEFAULT_USER_DATABASE_URL,
+        os.environ.get("IDT_RECORD_URL", DEFAULT_IDT_RECORD_URL),
+        os.environ.get("ADMIN_RECORD_URL"),
+        sqlite_path=os.environ.get("SQLITE_PATH", "bot.db"),
+        export_token=os.environ.get("EXPORT_TOKEN"),
+    )
+
+
+def _from_config(item):
+    tenant_id = str(item["id"])
+    base, ext = os.path.splitext(os.environ.get("SQLITE_PATH", "bot.db"))
+    return Tenant(
+        tenant_id,
+        item["channel_access_token"],
+        item["channel_secret"],
+        item["user_database_url"],
+        item["idt_record_url"],
+        item.get("admin_record_url"),
+        destination=item.get("destination"),
+        sqlite_path=item.get("sqlite_path") or f"{base}_{tenant_id}{ext or '.db'}",
+        state_dir=os.path.join(SNAPSHOT_DIR, tenant_id),
+        partition=tenant_id,
+        export_token=item.get("export_token"),
+    )
+
+
+def load_registry():
+    """Builds the registry from TENANTS_JSON, or a single tenant from the LINE_* variables."""
+    config = os.environ.get("TENANTS_JSON", "").strip()
+    if not config:
+        return Registry([_from_env()])
+    if not config.startswith("["):
+        with open(config, encoding="utf-8") as f:
+            config = f.read()
+    return Registry([_from_config(item) for item in json.loads(config)])
+
+
+registry = None
+
+
+def init_registry():
+    """Loads the registry on first call and returns it."""
+    global registry
+    if registry is None:
+        registry = load_registry()
+    return registry
+
+
+def current():
+    """The tenant being served. With a single tenant it is used even outside a request."""
+    tenant = _current.get()
+    if tenant is not None:
+        return tenant
+    if registry is not None and len(registry) == 1:
+        return registry.tenants[0]
+    raise RuntimeError("No tenant is active (wrap the call in tenant.activate())")
+
+
+class TenantLocal:
+    """
+    Proxy to a per-tenant value built by factory() on first use while that
+    tenant is current. Attribute access, calls and the usual container
+    operations are forwarded to the current tenant's value.
+    """
+
+    __slots__ = ("_factory", "__weakref__")
+
+    def __init__(self, factory):
+        self._factory = factory
+
+    def _tenant_value(self):
+        tenant = current()
+        try:
+            return tenant.values[self]
+        except KeyError:
+            pass
+        with tenant.lock:
+            if self not in tenant.values:
+                tenant.values[self] = self._factory()
+            return tenant.values[self]
+
+    def __getattr__(self, name):
+        return getattr(self._tenant_value(), name)
+
+    def __call__(self, *args, **kwargs):
+        return self._tenant_value()(*args, **kwargs)
+
+    def __contains__(self, item):
+        return item in self._tenant_value()
+
+    def __getitem__(self, key):
+        return self._tenant_value()[key]
+
+    def __setitem__(self, key, value):
+        self._tenant_value()[key] = value
+
+    def __delitem__(self, key):
+        del self._tenant_value()[key]
+
+    def __iter__(self):
+        return iter(self._tenant_value())
+
+    def __len__(self):
+        return len(self._tenant_value())
+
+    def __bool__(self):
+        return bool(self._tenant_value())
+
+
+def tenant_local(factory):
+    """Decorator form: the function becomes the per-tenant factory of a TenantLocal."""
+    return TenantLocal(factory)
+
+
+class TenantWebhookHandler(WebhookHandler):
+    """WebhookHandler that checks signatures with the current tenant's channel secret."""
+
+    def __init__(self):
+        # 署名の確認はテナントごとの parser で行うので、ここではハンドラーの登録先だけを持つ
+        self._handlers = {}
+        self._default = None
+
+    @property
+    def parser(self):
+        return current().webhook_parser
@@ -0,0 +1,123 @@
+# 再送イベントの重複判定と、処理に失敗したときに印を消す（消さない）条件を確かめる
+
+import pytest
+import requests
+
+import event_dedup
+from circuit_breaker import CircuitBreaker, WriteQueue, QUEUED
+from event_dedup import MemoryDedup, SqliteDedup
+from storage import SqliteBackend, IDT_RECORDS
+
+
+class Event:
+    def __init__(self, event_id):
+        self.webhook_event_id = event_id
+
+
+class ReplyError(Exception):
+    """Stands in for reply_message failing (e.g. an expired reply token)."""
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def backend(request, tmp_path, monkeypatch):
+    if request.param == "memory":
+        dedup = MemoryDedup()
+    else:
+        dedup = SqliteDedup(str(tmp_path / "dedup.db"))
+    monkeypatch.setattr(event_dedup, "_backend", dedup)
+    monkeypatch.setattr(event_dedup, "counters", dict.fromkeys(event_dedup.counters, 0))
+    return dedup
+
+
+@pytest.fixture
+def sheet(tmp_path):
+    table = SqliteBackend(str(tmp_path / "bot.db")).table(IDT_RECORDS)
+    table.append_row(["name", "score"])
+    return table
+
+
+def test_mark_and_unmark(backend):
+    assert backend.mark("e1")
+    assert not backend.mark("e1")
+    assert backend.mark("e2")
+    backend.unmark("e1")
+    assert backend.mark("e1")
+    # 無い印を消しても何もしない
+    backend.unmark("missing")
+
+
+def test_expired_marks_are_forgotten(backend):
+    backend.ttl = -1
+    assert backend.mark("e1")
+    assert backend.mark("e1")
+
+
+def test_memory_dedup_keeps_at_most_max_entries():
+    dedup = MemoryDedup(max_entries=2)
+    for event_id in ("e1", "e2", "e3"):
+        assert dedup.mark(event_id)
+    # 一番古い e1 が押し出される
+    assert list(dedup._seen) == ["e2", "e3"]
+
+
+def test_first_delivery_and_release(backend):
+    event = Event("e1")
+    assert event_dedup.first_delivery(event)
+    assert not event_dedup.first_delivery(event)
+    event_dedup.release(event)
+    assert event_dedup.first_delivery(event)
+    assert event_dedup.counters["duplicates"] == 1
+    assert event_dedup.counters["released"] == 1
+
+
+def test_events_without_id_are_always_processed(backend):
+    event = Event(None)
+    assert event_dedup.first_delivery(event)
+    assert event_dedup.first_delivery(event)
+
+
+def test_failure_before_write_releases(backend):
+    event = Event("e1")
+    assert event_dedup.first_delivery(event)
+    with pytest.raises(ReplyError):
+        with event_dedup.handling(event):
+            raise ReplyError()
+    assert event_dedup.first_delivery(event)
+
+
+def test_reply_failure_after_append_keeps_mark(backend, sheet):
+    event = Event("e1")
+    assert event_dedup.first_delivery(event)
+    with pytest.raises(ReplyError):
+        with event_dedup.handling(event):
+            sheet.append_row(["taro", "80"])
+            raise ReplyError()
+    # 再送は重複として捨てられ、行は1回だけ書かれている
+    assert not event_dedup.first_delivery(event)
+    assert sheet.get_all_values() == [["name", "score"], ["taro", "80"]]
+    assert event_dedup.counters["kept"] == 1
+
+
+def test_queued_append_keeps_mark(backend):
+    class Down:
+        def append_row(self, *args, **kwargs):
+            raise requests.exceptions.ConnectTimeout("sheets is down")
+
+    queue = WriteQueue(CircuitBreaker("test"), retry_seconds=3600)
+    event = Event("e1")
+    assert event_dedup.first_delivery(event)
+    with pytest.raises(ReplyError):
+        with event_dedup.handling(event):
+            assert queue.append("idt", Down(), (["taro", "80"],), {}) == QUEUED
+            raise ReplyError()
+    assert not event_dedup.first_delivery(event)
+
+
+def test_note_write_outside_handling_is_ignored(backend, sheet):
+    sheet.append_row(["taro", "80"])
+    event = Event("e1")
+    assert event_dedup.first_delivery(event)
+    with pytest.raises(ReplyError):
+        with event_dedup.handling(event):
+            raise ReplyError()
+    assert event_dedup.first_delivery(event)
@@ -0,0 +1,126 @@
+# /export の書き出し（CSV インジェクション対策・絞り込み・シートの分割読み込み）を確かめる
+
+import csv
+import io
+import json
+
+import pytest
+
+import export
+from export import Filters
+from storage import SqliteBackend, ADMIN_RECORDS
+
+
+class BadRequest(Exception):
+    def __init__(self):
+        super().__init__("exceeds grid limits")
+        self.response = type("Response", (), {"status_code": 400})()
+
+
+class ChunkedTable:
+    """Serves get(range) from a list of rows, like a worksheet with `size` rows."""
+
+    def __init__(self, rows, size=None, error=None):
+        self.rows = rows
+        self.size = size
+        self.error = error
+        self.ranges = []
+
+    def get(self, range_name):
+        self.ranges.append(range_name)
+        first, last = range_name.split(":")
+        start, end = int(first[1:]), int(last[1:])
+        if self.size is not None and start > self.size:
+            raise self.error or BadRequest()
+        return self.rows[start - 2:end - 1]
+
+
+def read_csv(chunks):
+    return list(csv.reader(io.StringIO(b"".join(chunks).decode("utf-8"), newline="")))
+
+
+@pytest.mark.parametrize("value", ["=HYPERLINK(\"http://x\")", "+1+1", "-2+3", "@SUM(A1)", "\tx", "\rx"])
+def test_csv_escapes_formula_like_text(value):
+    assert export._csv_value(value) == "'" + value
+    assert read_csv(export.csv_chunks(["name"], [[value]]))[1] == ["'" + value]
+
+
+def test_csv_keeps_numbers_and_plain_text():
+    assert export._csv_value(-3.0) == "-3"
+    assert export._csv_value(61.25) == "61.25"
+    assert export._csv_value(None) == ""
+    assert export._csv_value("太郎") == "太郎"
+    assert export._csv_value("a=b") == "a=b"
+
+
+def test_csv_flushes_in_chunks(monkeypatch):
+    monkeypatch.setattr(export, "FLUSH_BYTES", 16)
+    chunks = list(export.csv_chunks(["name"], [[f"athlete{i}"] for i in range(10)]))
+    assert len(chunks) > 2
+    assert len(read_csv(chunks)) == 11
+
+
+def test_ndjson_converts_numbers():
+    lines = b"".join(export.ndjson_chunks(["name", "weight", "score"], [["太郎", "60", "81.5"], ["花子", "", "x"]]))
+    items = [json.loads(line) for line in lines.decode("utf-8").splitlines()]
+    assert items == [{"name": "太郎", "weight": 60.0, "score": 81.5}, {"name": "花子", "weight": None, "score": "x"}]
+
+
+def test_filters_from_args():
+    filters = Filters.from_args({"from": "2024-04-01", "to": "2025/3/31", "grade": "2", "gender": "M"})
+    assert (filters.date_from, filters.date_to, filters.grade, filters.gender) == ((2024, 4, 1), (2025, 3, 31), "2", "m")
+    empty = Filters.from_args({})
+    assert (empty.date_from, empty.date_to, empty.grade, empty.gender) == (None, None, None, None)
+
+
+@pytest.mark.parametrize("args", [{"from": "yesterday"}, {"to": "2024.05.01"}, {"gender": "x"}])
+def test_filters_reject_invalid_args(args):
+    with pytest.raises(ValueError):
+        Filters.from_args(args)
+
+
+def test_date_bounds_are_inclusive():
+    filters = Filters.from_args({"from": "2024-04-01", "to": "2024-04-30"})
+    assert filters.matches("2024/04/01", "m")
+    assert filters.matches("2024/4/30", "w")
+    assert not filters.matches("2024/03/31", "m")
+    assert not filters.matches("2024/05/01", "m")
+    # 日付の読めない記録は期間を指定したときだけ除く
+    assert not filters.matches("", "m")
+    assert Filters().matches("", "m")
+
+
+def test_grade_and_gender_filters():
+    filters = Filters.from_args({"grade": "2", "gender": "w"})
+    assert filters.matches("2024/04/01", "W", grade=2)
+    assert not filters.matches("2024/04/01", "m", grade="2")
+    assert not filters.matches("2024/04/01", "w", grade="3")
+
+
+def test_sheet_rows_stops_on_empty_chunk():
+    table = ChunkedTable([[str(i)] for i in range(5)])
+    assert list(export.sheet_rows(table, chunk=2)) == [[str(i)] for i in range(5)]
+    assert table.ranges == ["A2:F3", "A4:F5", "A6:F7", "A8:F9"]
+
+
+def test_sheet_rows_stops_on_bad_request_past_the_end():
+    table = ChunkedTable([[str(i)] for i in range(4)], size=5)
+    assert list(export.sheet_rows(table, chunk=2)) == [[str(i)] for i in range(4)]
+
+
+def test_sheet_rows_raises_other_errors():
+    error = RuntimeError("sheets is down")
+    table = ChunkedTable([["a"]], size=1, error=error)
+    with pytest.raises(RuntimeError):
+        list(export.sheet_rows(table, chunk=2))
+
+
+def test_admin_records_from_sqlite(tmp_path):
+    table = SqliteBackend(str(tmp_path / "bot.db")).table(ADMIN_RECORDS, header=export.ADMIN_FIELDS)
+    table.append_row(["2024/04/02", "=cmd", "m", "7:30.0", "60", "80"])
+    table.append_row(["", "", "", "", "", ""])
+    table.append_row(["2024/05/02", "花子", "w", "8:00.0", "50", "75"])
+    filters = Filters.from_args({"from": "2024-04-01", "to": "2024-04-30"})
+    records = list(export.admin_records(table, filters))
+    assert records == [["2024/04/02", "=cmd", "m", "7:30.0", "60", "80"]]
+    assert read_csv(export.csv_chunks(export.ADMIN_FIELDS, records))[1][1] == "'=cmd"
@@ -0,0 +1,148 @@
+# idt_index の追記分の読み込み（sync）と、変更を見つけたときの全体読み直しを SqliteTable で確かめる
+
+import pytest
+
+import idt_index
+from idt_index import IdtIndex, row_hash
+from storage import SqliteBackend, IDT_RECORDS
+
+HEADER = ["name", "grade", "gender", "date", "time", "weight", "score", "admin"]
+
+
+def record(i, score=80.0):
+    return [f"athlete{i}", "2", "m", f"2024/05/{i % 28 + 1:02d}", "7:30.0", "60", str(score), ""]
+
+
+class CountingTable:
+    """Wraps a table and counts the reads made through it."""
+
+    def __init__(self, table):
+        self.table = table
+        self.calls = []
+
+    def get_all_values(self):
+        self.calls.append("get_all_values")
+        return self.table.get_all_values()
+
+    def batch_get(self, ranges):
+        self.calls.append(("batch_get", tuple(ranges)))
+        return self.table.batch_get(ranges)
+
+
+class BadRequest(Exception):
+    def __init__(self):
+        super().__init__("range exceeds grid limits")
+        self.response = type("Response", (), {"status_code": 400})()
+
+
+@pytest.fixture
+def sheet(tmp_path):
+    table = SqliteBackend(str(tmp_path / "idt.db")).table(IDT_RECORDS)
+    table.append_row(HEADER)
+    for i in range(1, 21):
+        table.append_row(record(i))
+    return table
+
+
+@pytest.fixture
+def index(sheet):
+    counting = CountingTable(sheet)
+    index = IdtIndex(counting)
+    index.refresh()
+    counting.calls.clear()
+    return index
+
+
+def test_row_hash_ignores_trailing_empty_cells():
+    assert row_hash(["a", "1", "", ""]) == row_hash(["a", "1"])
+    assert row_hash(["a", "1"]) != row_hash(["a", "2"])
+    # I 列より右は見ない
+    assert row_hash(record(1) + ["extra"]) == row_hash(record(1))
+
+
+def test_sync_reads_only_appended_rows(sheet, index):
+    sheet.append_row(record(21))
+    sheet.append_row(record(22))
+    index.sync()
+    assert index.sheet.calls[0][0] == "batch_get"
+    assert index.sheet.calls[0][1][0] == "A21:H"
+    assert "get_all_values" not in index.sheet.calls
+    assert index.row_count == 23
+    assert len(index.entries) == 22
+    assert index.counters["tail"] == 1 and index.counters["tail_rows"] == 2
+
+
+def test_sync_without_new_rows_keeps_index(index):
+    generation = index.generation
+    index.sync()
+    assert index.row_count == 21
+    assert index.generation == generation
+    assert index.counters["mismatch"] == 0
+
+
+def test_sync_reloads_when_last_row_changed(sheet, index):
+    sheet.update_cell(21, 7, "90")
+    index.sync()
+    assert index.counters["mismatch"] == 1
+    assert index.counters["full"] == 2
+    assert index.entries[-1].score == 90.0
+
+
+def test_sync_reloads_when_sampled_row_changed(sheet, index, monkeypatch):
+    # 2〜6 行目を確かめる範囲として選ばせる
+    monkeypatch.setattr(idt_index.random, "randint", lambda a, b: 2)
+    sheet.update_cell(3, 7, "55")
+    index.sync()
+    assert ("batch_get", ("A21:H", "A2:H6")) in index.sheet.calls
+    assert index.counters["mismatch"] == 1
+    assert index.entries[1].score == 55.0
+
+
+def test_sync_reloads_when_sheet_shrunk(sheet, index):
+    sheet.delete_rows(2, 4)
+    index.sync()
+    assert index.counters["mismatch"] == 1
+    assert index.row_count == 18
+    assert len(index.entries) == 17
+
+
+def test_sync_reloads_on_out_of_range_error(sheet, index):
+    def out_of_range(ranges):
+        raise BadRequest()
+    index.sheet.batch_get = out_of_range
+    sheet.append_row(record(21))
+    index.sync()
+    assert index.counters["mismatch"] == 1
+    assert index.row_count == 22
+
+
+def test_sync_raises_other_errors(index):
+    def broken(ranges):
+        raise RuntimeError("network")
+    index.sheet.batch_get = broken
+    with pytest.raises(RuntimeError):
+        index.sync()
+
+
+def test_local_entry_kept_until_its_row_is_read(sheet, index):
+    row = ["queued", "1", "w", "2024/06/01", "8:00.0", "55", "77.77", ""]
+    index.add(row)
+    # 追記がまだシートに届いていない（保存待ち）間は、他の行を読んでも残る
+    sheet.append_row(record(21))
+    index.sync()
+    assert [e.name for e in index.unsynced_entries()] == ["queued"]
+    assert [e.score for e in index.records_for("queued", "1")] == [77.77]
+    # シートでは表示桁数で丸められていても同じ記録とみなす
+    sheet.append_row(row[:6] + ["77.8", ""])
+    index.sync()
+    assert index.unsynced_entries() == []
+    assert len(index.records_for("queued", "1")) == 1
+
+
+def test_local_entry_matched_by_full_reload(sheet, index):
+    row = ["queued", "1", "w", "2024/06/01", "8:00.0", "55", "70", ""]
+    index.add(row)
+    sheet.append_row(row)
+    index.refresh()
+    assert index.unsynced_entries() == []
+    assert len(index.all_entries()) == 21
@@ -0,0 +1,73 @@
+# SqliteTable の行番号の扱いと、1列目の索引で1件を探す find_rows を確かめる
+
+import pytest
+
+from storage import SqliteBackend, find_rows, user_entered_cell
+
+
+@pytest.fixture
+def backend(tmp_path):
+    return SqliteBackend(str(tmp_path / "bot.db"))
+
+
+@pytest.fixture
+def subscribers(backend):
+    table = backend.table("tide_subscribers", header=["user_id", "since"])
+    for i in range(1, 6):
+        table.append_row([f"U{i}", "2024/05/01"])
+    return table
+
+
+class ListTable:
+    """A table with only get_all_values, like a worksheet without an index."""
+
+    def __init__(self, rows):
+        self.rows = rows
+
+    def get_all_values(self):
+        return self.rows
+
+
+def test_find_rows_returns_row_numbers(subscribers):
+    assert find_rows(subscribers, "U3") == [(4, ["U3", "2024/05/01"])]
+    assert find_rows(subscribers, "missing") == []
+    # ヘッダー行は対象にしない
+    assert find_rows(subscribers, "user_id") == []
+
+
+def test_find_rows_follows_deletes_and_updates(subscribers):
+    subscribers.delete_rows(2)
+    assert find_rows(subscribers, "U3") == [(3, ["U3", "2024/05/01"])]
+    subscribers.update_cell(3, 1, "U9")
+    assert find_rows(subscribers, "U3") == []
+    assert find_rows(subscribers, "U9") == [(3, ["U9", "2024/05/01"])]
+    assert subscribers.get_all_values()[2] == ["U9", "2024/05/01"]
+
+
+def test_find_rows_uses_the_key_index(backend, subscribers):
+    plan = backend.query(
+        "EXPLAIN QUERY PLAN SELECT pos FROM sheet_rows INDEXED BY sheet_rows_key"
+        " WHERE sheet = ? AND json_extract(data, '$[0]') = ?", ("tide_subscribers", "U1"))
+    assert any("sheet_rows_key" in row[-1] for row in plan)
+
+
+def test_find_rows_on_tables_without_index():
+    table = ListTable([["user_id", "until"], ["U1", "x"], ["U2", "y"], ["U1", "z"], []])
+    assert find_rows(table, "U1") == [(2, ["U1", "x"]), (4, ["U1", "z"])]
+
+
+def test_tables_are_separate(backend, subscribers):
+    bans = backend.table("admin_request_ban", header=["user_id", "until", "last_request_date"])
+    bans.append_row(["U1", "2024/06/01", "2024/05/18"])
+    assert find_rows(bans, "U1") == [(2, ["U1", "2024/06/01", "2024/05/18"])]
+    assert find_rows(subscribers, "U1") == [(2, ["U1", "2024/05/01"])]
+
+
+def test_user_entered_cell_types():
+    assert user_entered_cell("=SUM(A1:A2)")[0] == {"userEnteredValue": {"formulaValue": "=SUM(A1:A2)"}}
+    assert user_entered_cell("12")[0] == {"userEnteredValue": {"numberValue": 12.0}}
+    assert user_entered_cell("taro")[0] == {"userEnteredValue": {"stringValue": "taro"}}
+    cell, fields = user_entered_cell("2024/05/01 08:30:00")
+    assert cell["userEnteredFormat"]["numberFormat"]["pattern"] == "yyyy/mm/dd hh:mm:ss"
+    assert fields == "userEnteredValue,userEnteredFormat.numberFormat"
+    assert user_entered_cell("2024/13/01")[0] == {"userEnteredValue": {"stringValue": "2024/13/01"}}
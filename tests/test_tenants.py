@@ -0,0 +1,136 @@
+# webhook をどのテナントに振り分けるかと、テナントごとの状態（TenantLocal）が混ざらないことを確かめる
+
+import base64
+import contextvars
+import hashlib
+import hmac
+import json
+import threading
+
+import pytest
+
+import sync_storage
+import tenants
+from tenants import Registry, Tenant, tenant_local
+
+
+def make_tenant(tenant_id, destination=None):
+    return Tenant(tenant_id, f"token-{tenant_id}", f"secret-{tenant_id}", f"users-{tenant_id}",
+                  f"idt-{tenant_id}", destination=destination, sqlite_path=f"bot_{tenant_id}.db",
+                  partition=tenant_id)
+
+
+def sign(tenant, body):
+    digest = hmac.new(tenant.channel_secret.encode(), body.encode(), hashlib.sha256).digest()
+    return base64.b64encode(digest).decode()
+
+
+@pytest.fixture
+def clubs():
+    return make_tenant("a", destination="Ua"), make_tenant("b", destination="Ub"), make_tenant("c")
+
+
+@pytest.fixture
+def registry(clubs):
+    return Registry(clubs)
+
+
+def test_registry_rejects_empty_and_duplicate_ids():
+    with pytest.raises(ValueError):
+        Registry([])
+    with pytest.raises(ValueError):
+        Registry([make_tenant("a"), make_tenant("a")])
+
+
+def test_path_wins_over_destination_and_signature(registry, clubs):
+    a, b, _ = clubs
+    body = json.dumps({"destination": "Ua", "events": []})
+    assert registry.for_webhook(body, sign(a, body), tenant_id="b") is b
+    assert registry.for_webhook(body, sign(a, body), tenant_id="missing") is None
+
+
+def test_destination_wins_over_signature(registry, clubs):
+    a, b, _ = clubs
+    body = json.dumps({"destination": "Ub", "events": []})
+    assert registry.for_webhook(body, sign(a, body)) is b
+
+
+def test_unique_signature_match(registry, clubs):
+    _, _, c = clubs
+    body = json.dumps({"destination": "Uunknown", "events": []})
+    assert registry.for_webhook(body, sign(c, body)) is c
+    assert registry.for_webhook("not json", sign(c, "not json")) is c
+
+
+def test_no_or_ambiguous_signature_match(clubs):
+    a, _, _ = clubs
+    body = json.dumps({"events": []})
+    assert Registry(clubs).for_webhook(body, "bad signature") is None
+    # 同じシークレットのテナントが2つあると決められない
+    twin = Tenant("twin", "token", a.channel_secret, "users", "idt")
+    assert Registry([a, twin]).for_webhook(body, sign(a, body)) is None
+
+
+def test_single_tenant_takes_every_webhook():
+    only = make_tenant("only")
+    assert Registry([only]).for_webhook("{}", "bad signature") is only
+
+
+def test_tenant_local_values_are_isolated(clubs):
+    a, b, _ = clubs
+    built = []
+
+    @tenant_local
+    def cache():
+        built.append(tenants.current().id)
+        return {}
+
+    with a.activate():
+        cache["key"] = "a"
+    with b.activate():
+        assert "key" not in cache
+        cache["key"] = "b"
+    with a.activate():
+        assert cache["key"] == "a"
+        assert len(cache) == 1
+    assert built == ["a", "b"]
+
+
+def test_current_requires_activation_with_several_tenants(monkeypatch, registry, clubs):
+    monkeypatch.setattr(tenants, "registry", registry)
+    with pytest.raises(RuntimeError):
+        tenants.current()
+    with clubs[1].activate():
+        assert tenants.current() is clubs[1]
+    with pytest.raises(RuntimeError):
+        tenants.current()
+
+
+def test_threads_inherit_the_tenant_through_the_context(clubs):
+    a, _, _ = clubs
+    seen = []
+    with a.activate():
+        thread = threading.Thread(target=contextvars.copy_context().run, args=(lambda: seen.append(tenants.current()),))
+    thread.start()
+    thread.join()
+    assert seen == [a]
+
+
+def test_iterate_activates_the_tenant_for_each_item(clubs):
+    a, _, _ = clubs
+    items = a.iterate(tenants.current().id for _ in range(2))
+    assert list(items) == ["a", "a"]
+
+
+def test_sync_target_for_tenant(monkeypatch):
+    config = [{"id": "kc", "channel_access_token": "t", "channel_secret": "s", "user_database_url": "users-kc",
+               "idt_record_url": "idt-kc", "admin_record_url": "admin-kc"}]
+    monkeypatch.setenv("TENANTS_JSON", json.dumps(config))
+    monkeypatch.setenv("SQLITE_PATH", "/data/bot.db")
+    target = sync_storage.target_for("kc")
+    assert (target.user_database_url, target.idt_record_url, target.admin_record_url) == ("users-kc", "idt-kc", "admin-kc")
+    assert target.sqlite_path == "/data/bot_kc.db"
+    assert target.partition == "kc"
+    assert "admin_database" in sync_storage.table_names(target)
+    with pytest.raises(ValueError):
+        sync_storage.target_for("missing")
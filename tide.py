@@ -0,0 +1,378 @@
+# tide.py
+# 気象庁の潮位表PDF（高知: KC）の取得・解析と、毎朝の潮位配信
+
+import contextvars
+import fcntl
+import hashlib
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+import traceback
+import datetime
+
+import pytz
+import requests
+
+from circuit_breaker import CircuitOpenError, breaker
+from shared_snapshot import snapshots
+from singleflight import SingleFlight
+
+JST = pytz.timezone('Asia/Tokyo')
+_SPLIT_RE = re.compile(r'\s+')
+
+
+# JMA から取得したファイルのキャッシュ先（ワーカー間で共有される）
+JMA_CACHE_DIR = os.environ.get("JMA_CACHE_DIR", os.path.join(tempfile.gettempdir(), "jma_cache"))
+# この秒数以内に確認済みのキャッシュは再検証しない
+FRESH_SECONDS = int(os.environ.get("JMA_CACHE_FRESH_SECONDS", "3600"))
+# 気象庁への接続・読み取りのタイムアウト（秒）。ワーカーを長く塞がないようにする
+JMA_TIMEOUT_SECONDS = float(os.environ.get("JMA_TIMEOUT_SECONDS", "10"))
+JMA_USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36"
+
+
+_jma_breaker = breaker("jma")
+
+
+def _jma_get(url, **kwargs):
+    res = requests.get(url, **kwargs)
+    # 5xx は障害として扱い、ブレーカーの失敗に数える
+    if res.status_code >= 500:
+        res.close()
+        res.raise_for_status()
+    return res
+
+
+def _cache_meta_path(url):
+    return os.path.join(JMA_CACHE_DIR, hashlib.sha256(url.encode()).hexdigest() + ".json")
+
+
+def _read_cache_meta(url):
+    try:
+        with open(_cache_meta_path(url), encoding="utf-8") as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if not os.path.exists(os.path.join(JMA_CACHE_DIR, meta.get("file", ""))):
+        return None
+    return meta
+
+
+def _write_atomic(path, data):
+    tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+def fetch_cached(url, timeout=JMA_TIMEOUT_SECONDS):
+    """
+    Fetches `url` through the on-disk HTTP cache and returns the path of the
+    cached file, or None on failure.
+    Uses If-None-Match / If-Modified-Since so unchanged files cost a 304.
+    The body is streamed to a temp file and renamed to its sha256 name, and
+    a lock file keeps concurrent workers from downloading the same URL twice.
+    While the "jma" circuit breaker is open the cached copy is used without
+    contacting the server.
+    """
+    os.makedirs(JMA_CACHE_DIR, exist_ok=True)
+    lock_path = _cache_meta_path(url) + ".lock"
+    with open(lock_path, "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            return _fetch_locked(url, timeout)
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _fetch_locked(url, timeout):
+    meta = _read_cache_meta(url)
+    headers = {"User-Agent": JMA_USER_AGENT}
+    if meta:
+        # 他のワーカーが直前に取得済みならそのまま使う
+        if time.time() - meta.get("checked_at", 0) < FRESH_SECONDS:
+            return os.path.join(JMA_CACHE_DIR, meta["file"])
+        if meta.get("etag"):
+            headers["If-None-Match"] = meta["etag"]
+        if meta.get("last_modified"):
+            headers["If-Modified-Since"] = meta["last_modified"]
+
+    tmp_path = None
+    try:
+        with _jma_breaker.call(_jma_get, url, headers=headers, stream=True, timeout=timeout) as res:
+            if res.status_code == 304 and meta:
+                meta["checked_at"] = time.time()
+                _write_atomic(_cache_meta_path(url), json.dumps(meta))
+                return os.path.join(JMA_CACHE_DIR, meta["file"])
+            if res.status_code != 200:
+                print(f"Error downloading PDF: Status {res.status_code} for URL {url}")
+                return None
+            digest = hashlib.sha256()
+            fd, tmp_path = tempfile.mkstemp(dir=JMA_CACHE_DIR, suffix=".part")
+            with os.fdopen(fd, "wb") as f:
+                for chunk in res.iter_content(chunk_size=8192):
+                    digest.update(chunk)
+                    f.write(chunk)
+            filename = digest.hexdigest() + os.path.splitext(url)[1]
+            os.replace(tmp_path, os.path.join(JMA_CACHE_DIR, filename))
+            tmp_path = None
+            new_meta = {
+                "url": url,
+                "file": filename,
+                "etag": res.headers.get("ETag"),
+                "last_modified": res.headers.get("Last-Modified"),
+                "checked_at": time.time(),
+            }
+            _write_atomic(_cache_meta_path(url), json.dumps(new_meta))
+            # 内容が変わった場合は古いファイルを消す
+            if meta and meta["file"] != filename:
+                try:
+                    os.remove(os.path.join(JMA_CACHE_DIR, meta["file"]))
+                except OSError:
+                    pass
+            return os.path.join(JMA_CACHE_DIR, filename)
+    except (requests.exceptions.RequestException, CircuitOpenError) as e:
+        print(f"RequestException while downloading PDF from {url}: {e}")
+        # 取得できなくても前回のファイルがあればそれを使う
+        return os.path.join(JMA_CACHE_DIR, meta["file"]) if meta else None
+    except Exception as e:
+        print(f"An unexpected error occurred while downloading or writing PDF from {url}: {e}")
+        return None
+    finally:
+        if tmp_path and os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def download_tide_pdf(year: int) -> str | None:
+    """
+    Downloads the hourly tide data PDF for Kochi for a given year.
+    Returns the filepath of the cached PDF file, or None on failure.
+    The file is shared through the cache and must not be deleted by the caller.
+    KC.pdf is the code for Kochi.
+    """
+    url = f"https://www.data.jma.go.jp/kaiyou/data/db/tide/suisan/pdf_hourly/{year}/KC.pdf"
+    return _flight.do(("download", url), fetch_cached, url)
+
+
+def parse_tide_page(text):
+    """
+    Parses one month page of the JMA hourly tide PDF.
+    Returns {day: [tide_cm or None for hours 0..23]}.
+    """
+    days = {}
+    for line in text.split('\n'):
+        # 行頭が数字で始まっている行を対象とする (例: " 1 ", "10 ")
+        line_strip = line.strip()
+        if not line_strip or not line_strip[0].isdigit():
+            continue
+        parts = _SPLIT_RE.split(line_strip)
+        try:
+            day = int(parts[0])
+        except (ValueError, IndexError):
+            continue
+        # 同じ日の行が複数あれば最初の行を使う
+        if day in days:
+            continue
+        # parts[0]は日付、0時のデータは parts[1] に対応
+        days[day] = [int(v) if v.isdigit() else None for v in parts[1:25]]
+    return days
+
+
+def _pdf_reader(pdf_filepath):
+    # PyPDF2 は潮位の機能で初めて使うときに読み込む（起動を速くするため）
+    from PyPDF2 import PdfReader
+    return PdfReader(pdf_filepath)
+
+
+def extract_tide_from_pdf(pdf_filepath: str, target_month: int, target_day: int, target_hour: int) -> int | None:
+    """
+    Extracts the tide level for a specific date and hour from a JMA PDF file.
+    """
+    try:
+        # PdfReader は1つのストリームを読み進めるので、スレッド間で共有せず呼び出しごとに作る
+        reader = _pdf_reader(pdf_filepath)
+
+        # 月はPDFのページ番号に対応 (1月 -> 0ページ目)
+        if not (0 <= target_month - 1 < len(reader.pages)):
+            print(f"Error: Invalid month {target_month} for PDF with {len(reader.pages)} pages.")
+            return None
+
+        hours = parse_tide_page(reader.pages[target_month - 1].extract_text()).get(target_day)
+        if hours and 0 <= target_hour < len(hours):
+            return hours[target_hour]
+        return None
+
+    except Exception as e:
+        error_details = traceback.format_exc()
+        print(f"Error during PDF processing with PyPDF2 for {pdf_filepath}: {e}\n{error_details}")
+        return None
+
+
+def parse_tide_table(pdf_filepath):
+    """Parses every month page into {(month, day): [hourly values]}."""
+    reader = _pdf_reader(pdf_filepath)
+    table = {}
+    for month, page in enumerate(reader.pages[:12], start=1):
+        for day, hours in parse_tide_page(page.extract_text()).items():
+            table[(month, day)] = hours
+    return table
+
+
+# 年ごとの潮位表（一度解析すれば全ユーザーで共有する）
+_tide_tables = {}
+# 同時に来た潮位リクエストは1回のダウンロード・解析にまとめる
+_flight = SingleFlight()
+
+
+def _encode_tide_table(table):
+    return {f"{month}/{day}": hours for (month, day), hours in table.items()}
+
+
+def _decode_tide_table(data):
+    return {tuple(int(n) for n in key.split("/")): hours for key, hours in data.items()}
+
+
+def _parse_year(year):
+    pdf_filepath = download_tide_pdf(year)
+    if not pdf_filepath:
+        return None
+    try:
+        return parse_tide_table(pdf_filepath)
+    except Exception as e:
+        print(f"Error parsing tide table for {year}: {e}\n{traceback.format_exc()}")
+        return None
+
+
+def _build_tide_table(year):
+    table = _tide_tables.get(year)
+    if table is not None:
+        return table
+    # 解析済みの表は他のワーカーと共有する（PDF の解析は1ワーカーだけが行う）
+    table = snapshots.get(f"tide_{year}", lambda: _parse_year(year),
+                          encode=_encode_tide_table, decode=_decode_tide_table)
+    if table is None:
+        return None
+    _tide_tables[year] = table
+    return table
+
+
+def dump_tide_tables():
+    """Parsed tables as JSON-able data for the warm-start file."""
+    return {str(year): _encode_tide_table(table) for year, table in list(_tide_tables.items())} or None
+
+
+def restore_tide_tables(data):
+    for year, table in data.items():
+        _tide_tables.setdefault(int(year), _decode_tide_table(table))
+
+
+def load_tide_table(year):
+    """Returns the parsed tide table for `year`, downloading it on first use. None on failure."""
+    table = _tide_tables.get(year)
+    if table is not None:
+        return table
+    return _flight.do(("tide_table", year), _build_tide_table, year)
+
+
+def get_tide_curve(year, month, day):
+    table = load_tide_table(year)
+    if table is None:
+        return None
+    return table.get((month, day))
+
+
+def format_daily_summary(date, hours):
+    known = [(h, v) for h, v in enumerate(hours) if v is not None]
+    if not known:
+        return None
+    high_hour, high = max(known, key=lambda hv: hv[1])
+    low_hour, low = min(known, key=lambda hv: hv[1])
+    lines = [f"🌊 {date.month}/{date.day} 高知港の潮位"]
+    lines.append(f"最高 {high} cm（{high_hour}時頃） / 最低 {low} cm（{low_hour}時頃）")
+    # 練習時間帯（5時〜19時）を2時間おきに
+    lines.append(" ".join(f"{h}時:{v}" for h, v in known if 5 <= h <= 19 and h % 2 == 1))
+    return "\n".join(lines)
+
+
+class TideScheduler:
+    """
+    Pushes the day's tide summary to subscribers once each morning.
+    A marker file per day makes sure only one gunicorn worker sends it.
+    The marker is removed again when nothing could be sent (no tide data,
+    or the first multicast failed), so the next minute of the hour retries.
+    """
+
+    MULTICAST_LIMIT = 500  # LINE multicast の1回あたりの上限
+
+    def __init__(self, get_subscribers, multicast, hour, marker_dir=None):
+        self.get_subscribers = get_subscribers
+        self.multicast = multicast   # multicast(user_ids, text)
+        self.hour = hour
+        self.marker_dir = marker_dir or tempfile.gettempdir()
+        self._thread = None
+        self._batches_sent = 0
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        # 起動したテナント（tenants.py）のまま動かす
+        self._thread = threading.Thread(target=contextvars.copy_context().run, args=(self._loop,),
+                                        name="tide-scheduler", daemon=True)
+        self._thread.start()
+
+    def _marker_path(self, date):
+        return os.path.join(self.marker_dir, f"tide_push_{date:%Y%m%d}")
+
+    def _claim(self, date):
+        os.makedirs(self.marker_dir, exist_ok=True)
+        try:
+            os.close(os.open(self._marker_path(date), os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            return True
+        except FileExistsError:
+            return False
+
+    def _release(self, date):
+        try:
+            os.remove(self._marker_path(date))
+        except FileNotFoundError:
+            pass
+
+    def _loop(self):
+        while True:
+            try:
+                now = datetime.datetime.now(JST)
+                # 再起動で二重送信しないよう、指定時刻の1時間内だけ送る
+                if now.hour == self.hour and self._claim(now.date()):
+                    self._send_claimed(now.date())
+            except Exception:
+                traceback.print_exc()
+            time.sleep(60)
+
+    def _send_claimed(self, date):
+        try:
+            sent = self.send(date)
+        except Exception:
+            # 1通も送れていなければ次の1分でやり直す（一部でも送れていたら二重送信を避けてやめる）
+            if not self._batches_sent:
+                self._release(date)
+            raise
+        if sent is None:
+            self._release(date)
+
+    def send(self, date):
+        """Sends the day's summary. Returns the number of subscribers, or None without tide data."""
+        self._batches_sent = 0
+        hours = get_tide_curve(date.year, date.month, date.day)
+        if not hours:
+            print(f"No tide data for {date}")
+            return None
+        text = format_daily_summary(date, hours)
+        if not text:
+            return None
+        user_ids = list(self.get_subscribers())
+        for i in range(0, len(user_ids), self.MULTICAST_LIMIT):
+            self.multicast(user_ids[i:i + self.MULTICAST_LIMIT], text)
+            self._batches_sent += 1
+        return len(user_ids)
@@ -0,0 +1,176 @@
+# warm_start.py
+# 再起動直後から温まったキャッシュで応答するための保存ファイル
+#
+# users / 停止リスト / 申請禁止 / IDT 索引 / 潮位表などの内容を1つのファイルにまとめて保存し、
+# 次の起動時に読み込む。保存は終了時と一定間隔ごと。
+# 読み込んだ内容は保存時点のものなので、起動後にバックグラウンドで読み直す（revalidate）。
+# 読み直しが済むまでは読み込んだ内容で応答する。
+#
+# ファイルには FORMAT_VERSION を書いておき、版が違うファイルや古すぎるファイルは使わない。
+#
+#   WARM_START_PATH       保存先（空文字で無効）
+#   WARM_START_INTERVAL   定期保存の間隔秒 (既定 300)
+#   WARM_START_MAX_AGE    これより古いファイルは読み込まない秒数 (既定 86400)
+
+import contextvars
+import gzip
+import json
+import os
+import tempfile
+import threading
+import time
+import traceback
+
+from shared_snapshot import SNAPSHOT_DIR
+
+WARM_START_PATH = os.environ.get("WARM_START_PATH", os.path.join(SNAPSHOT_DIR, "warm_start.json.gz"))
+WARM_START_INTERVAL = float(os.environ.get("WARM_START_INTERVAL", "300"))
+WARM_START_MAX_AGE = float(os.environ.get("WARM_START_MAX_AGE", "86400"))
+# 保存形式を変えたら上げる（古い形式のファイルは読み捨てる）
+FORMAT_VERSION = 2
+# 読み直しに失敗したときの再試行間隔
+REVALIDATE_RETRY_SECONDS = 15
+
+
+class _Section:
+    __slots__ = ("dump", "restore", "revalidate")
+
+    def __init__(self, dump, restore, revalidate):
+        self.dump = dump
+        self.restore = restore
+        self.revalidate = revalidate
+
+
+class WarmStart:
+    """
+    Saves registered caches to one versioned file and restores them at
+    start-up. Each section provides dump() -> JSON data (None to skip),
+    restore(data), and optionally revalidate(), which reloads the section
+    from its source in the background after a restore.
+    """
+
+    def __init__(self, path=WARM_START_PATH, interval=WARM_START_INTERVAL, max_age=WARM_START_MAX_AGE):
+        self.path = path
+        self.interval = interval
+        self.max_age = max_age
+        self._sections = {}
+        self._pending = set()       # 読み込んだが、まだ読み直していない section
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        self.counters = {"restored": 0, "revalidated": 0, "saved": 0}
+
+    @property
+    def enabled(self):
+        return bool(self.path)
+
+    def register(self, name, dump, restore, revalidate=None):
+        self._sections[name] = _Section(dump, restore, revalidate)
+
+    def save(self):
+        if not self.enabled:
+            return False
+        sections = {}
+        for name, section in self._sections.items():
+            try:
+                data = section.dump()
+            except Exception:
+                traceback.print_exc()
+                continue
+            if data is not None:
+                sections[name] = data
+        if not sections:
+            return False
+        payload = {"version": FORMAT_VERSION, "saved_at": time.time(), "sections": sections}
+        directory = os.path.dirname(self.path) or "."
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=directory, prefix=".warm_start.", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as raw, gzip.GzipFile(fileobj=raw, mode="wb", compresslevel=1) as f:
+                f.write(json.dumps(payload, ensure_ascii=False, separators=(",", ":")).encode("utf-8"))
+            os.replace(tmp, self.path)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        self.counters["saved"] += 1
+        return True
+
+    def _read(self):
+        try:
+            with gzip.open(self.path, "rb") as f:
+                payload = json.loads(f.read())
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, EOFError) as e:
+            print(f"Ignoring unreadable warm-start file {self.path}: {e}")
+            return None
+        if not isinstance(payload, dict) or payload.get("version") != FORMAT_VERSION:
+            print(f"Ignoring warm-start file {self.path}: format version {payload.get('version') if isinstance(payload, dict) else None}")
+            return None
+        age = time.time() - payload.get("saved_at", 0)
+        if age > self.max_age:
+            print(f"Ignoring warm-start file {self.path}: saved {age / 3600:.1f}h ago")
+            return None
+        return payload["sections"]
+
+    def load(self):
+        """Restores every registered section found in the file. Returns the restored names."""
+        if not self.enabled:
+            return []
+        sections = self._read() or {}
+        restored = []
+        for name, data in sections.items():
+            section = self._sections.get(name)
+            if section is None:
+                continue
+            try:
+                section.restore(data)
+            except Exception:
+                traceback.print_exc()
+                continue
+            restored.append(name)
+            if section.revalidate is not None:
+                with self._lock:
+                    self._pending.add(name)
+        self.counters["restored"] += len(restored)
+        return restored
+
+    def pending(self):
+        with self._lock:
+            return sorted(self._pending)
+
+    def revalidate(self):
+        """Reloads restored sections from their sources. Returns True when none are left."""
+        for name in self.pending():
+            try:
+                self._sections[name].revalidate()
+            except Exception as e:
+                print(f"Warm-start revalidation of '{name}' failed: {e}")
+                continue
+            with self._lock:
+                self._pending.discard(name)
+            self.counters["revalidated"] += 1
+        return not self.pending()
+
+    def start(self):
+        """Starts this process's background thread: revalidation, then periodic saves."""
+        if not self.enabled:
+            return
+        # fork 後のワーカーではスレッドを作り直す
+        if self._thread is None or self._pid != os.getpid() or not self._thread.is_alive():
+            self._pid = os.getpid()
+            # 読み直し・保存は起動したテナント（tenants.py）のキャッシュに対して行う
+            self._thread = threading.Thread(target=contextvars.copy_context().run, args=(self._loop,),
+                                            name="warm-start", daemon=True)
+            self._thread.start()
+
+    def _loop(self):
+        while not self.revalidate():
+            time.sleep(REVALIDATE_RETRY_SECONDS)
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.save()
+            except Exception:
+                traceback.print_exc()
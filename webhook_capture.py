@@ -0,0 +1,115 @@
+# webhook_capture.py
+# 受け取った webhook の本文を負荷試験用に記録する（WEBHOOK_CAPTURE_PATH を設定したときだけ）
+#
+# 署名を確認済みの本文を、ユーザーID等を仮名化して gzip の追記ファイルに1行1件の JSON で書く。
+# 仮名は HMAC なので同じユーザーは同じ仮名になり、会話の流れはそのまま再現できる。
+# メッセージ本文はログインキーや名前を含みうるので、コマンドと返事（yes / end など）以外は
+# 形だけ残して書く（文字は x、数字は 0 に置き換え、空白や記号・長さはそのまま）。
+#
+#   WEBHOOK_CAPTURE_PATH  記録先（例: /tmp/webhooks.jsonl.gz）
+#   WEBHOOK_CAPTURE_KEY   仮名化の鍵（未設定なら処理中のテナントのチャネルシークレットから導出。
+#                         どちらも無ければ、誰でも分かる鍵で仮名化することになるので記録しない）
+
+import fcntl
+import gzip
+import hashlib
+import hmac
+import json
+import os
+import time
+import traceback
+
+import tenants
+from profiler import COMMANDS
+
+CAPTURE_PATH = os.environ.get("WEBHOOK_CAPTURE_PATH")
+# LINE の ID を持つフィールド
+_ID_FIELDS = frozenset({"userId", "groupId", "roomId"})
+# そのまま残すメッセージ（コマンドは後ろの引数だけ形にする）
+_COMMANDS = sorted(COMMANDS, key=len, reverse=True)
+_REPLIES = frozenset({"r", "end", "ok", "yes", "yes.", "y", "no", "n", "はい", "はい。", "いいえ"})
+
+
+def enabled():
+    return bool(CAPTURE_PATH)
+
+
+def _key():
+    """The pseudonymization key, or None if there is no secret to derive it from."""
+    key = os.environ.get("WEBHOOK_CAPTURE_KEY")
+    if key:
+        return key.encode()
+    secret = tenants.current().channel_secret
+    if not secret:
+        return None
+    return hmac.new(secret.encode(), b"webhook-capture", hashlib.sha256).digest()
+
+
+def pseudonymize_id(value, key):
+    # 先頭の種別文字（U/C/R）は残し、LINE の ID と同じ長さの16進にする
+    digest = hmac.new(key, value.encode(), hashlib.sha256).hexdigest()[:32]
+    return value[:1] + digest
+
+
+def text_shape(text):
+    """Letters become "x" and digits "0"; spaces, symbols and length are kept."""
+    return "".join("0" if c.isdigit() else "x" if c.isalpha() else c for c in text)
+
+
+def redact_text(text):
+    """Message text safe to store: commands and short replies as is, anything else as its shape."""
+    stripped = text.strip()
+    lowered = stripped.lower()
+    if lowered in _REPLIES:
+        return text
+    for command in _COMMANDS:
+        if lowered == command:
+            return text
+        if lowered.startswith(command + " "):
+            return stripped[:len(command)] + text_shape(stripped[len(command):])
+    return text_shape(text)
+
+
+def pseudonymize(payload, key):
+    """Returns a copy of a webhook payload with every user/group/room id replaced and message texts redacted."""
+    if isinstance(payload, dict):
+        redact = payload.get("type") == "text" and isinstance(payload.get("text"), str)
+        return {
+            k: pseudonymize_id(v, key) if k in _ID_FIELDS and isinstance(v, str)
+            else redact_text(v) if redact and k == "text"
+            else pseudonymize(v, key)
+            for k, v in payload.items()
+        }
+    if isinstance(payload, list):
+        return [pseudonymize(v, key) for v in payload]
+    return payload
+
+
+def capture(body, received_at=None):
+    """Appends one verified webhook body of the current tenant to the capture file. Never raises."""
+    if not CAPTURE_PATH:
+        return
+    try:
+        key = _key()
+        if key is None:
+            print("Webhook capture skipped: set WEBHOOK_CAPTURE_KEY (no channel secret to derive a key from)")
+            return
+        record = {"t": received_at or time.time(), "body": pseudonymize(json.loads(body), key)}
+        # gzip は複数メンバーを連結しても1つのファイルとして読めるので、1件ずつ圧縮して追記する
+        data = gzip.compress((json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n").encode("utf-8"))
+        with open(CAPTURE_PATH, "ab") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                f.write(data)
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+    except Exception:
+        traceback.print_exc()
+
+
+def read_capture(path):
+    """Yields captured records ({"t": unix time, "body": payload}) in file order."""
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)